@@ -0,0 +1,181 @@
+# Copyright 2023 Hendrik Wingbermuehle, Denys Serdyukov
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Generates a reproducible synthetic bplist17 corpus for the benchmarks.
+
+Every corpus is created from a fixed seed, so the same scale always yields
+byte-identical files. Usage:
+
+  python3 benchmarks/generate_corpus.py [--scale <n>] [--output <dir>]
+"""
+
+import os
+import sys
+import getopt
+import random
+from io import BytesIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from plist17lib import _BinaryPlist17Writer
+
+SEED = 17
+
+WORDS = ['alpha', 'bravo', 'charlie', 'delta', 'echo', 'foxtrot', 'golf', 'hotel',
+         'india', 'juliett', 'kilo', 'lima', 'mike', 'november', 'oscar', 'papa']
+WIDE_WORDS = ['Grüße', 'naïve', 'café', 'Ünïcödé', '日本語', 'Ελληνικά', 'русский', 'emoji ✓']
+
+
+def _word(r):
+    return r.choice(WORDS) + str(r.randrange(1000))
+
+def wide_dict(r, scale):
+    """one flat dict with many keys and scalar values"""
+    d = {'$class': 'WideDict'}
+    for i in range(5000 * scale):
+        k = i % 4
+        if k == 0:
+            d['key%i' % i] = r.randrange(-2**31, 2**31)
+        elif k == 1:
+            d['key%i' % i] = _word(r)
+        elif k == 2:
+            d['key%i' % i] = r.random()
+        else:
+            d['key%i' % i] = r.choice([True, False, None])
+    return d, False
+
+def deep_nesting(r, scale):
+    """alternating arrays and dicts, nested two hundred levels deep"""
+    # the depth stays below the recursion limit of the writer, scale adds trees
+    trees = []
+    for _ in range(4 * scale):
+        value = r.randrange(100)
+        for i in range(200):
+            if i % 2:
+                value = [value, r.randrange(100)]
+            else:
+                value = {'$class': 'Node', 'level': i, 'child': value}
+        trees.append(value)
+    return {'$class': 'Root', 'trees': trees}, False
+
+def large_blobs(r, scale):
+    """a few large data objects"""
+    blobs = [{'type': 'data.hexstring', 'value': r.randbytes(256 * 1024).hex()} for _ in range(4 * scale)]
+    return {'type': 'dict', 'value': {
+        '$class': {'type': 'string_ascii', 'value': 'Blobs'},
+        'blobs': {'type': 'array', 'value': blobs},
+    }}, True
+
+def shared_references(r, scale):
+    """many repetitions of few distinct objects, written as references"""
+    shared = [{'$class': 'Shared', 'name': _word(r), 'values': [r.randrange(100) for _ in range(8)]}
+              for _ in range(16)]
+    items = [r.choice(shared) for _ in range(2000 * scale)]
+    return {'$class': 'Root', 'items': items, 'names': [s['name'] for s in shared] * 50 * scale}, False
+
+def utf16_strings(r, scale):
+    """mostly UTF-16 encoded strings"""
+    strings = []
+    for _ in range(2000 * scale):
+        s = ' '.join(r.choice(WIDE_WORDS) for _ in range(r.randrange(1, 6)))
+        strings.append({'type': 'string_utf16le', 'value': s})
+    return {'type': 'dict', 'value': {
+        '$class': {'type': 'string_ascii', 'value': 'Strings'},
+        'strings': {'type': 'array', 'value': strings},
+    }}, True
+
+def keyed_archive(r, scale):
+    """NSDictionary objects with NS.keys and NS.objects, as found in keyed archives"""
+    def ns_dictionary(n):
+        keys = [_word(r) for _ in range(n)]
+        objects = [r.choice([r.randrange(10000), _word(r), r.random()]) for _ in range(n)]
+        return {'$class': 'NSDictionary', 'NS.keys': keys, 'NS.objects': objects}
+    objects = [ns_dictionary(r.randrange(1, 12)) for _ in range(300 * scale)]
+    return {'$class': 'NSMutableArray', 'NS.objects': objects}, False
+
+def nested_bplist17(r, scale):
+    """data objects that contain complete bplist17 documents"""
+    blobs = []
+    for _ in range(200 * scale):
+        inner, _ = keyed_archive(r, 0)
+        inner['NS.objects'] = [{'$class': 'Inner', 'value': r.randrange(1000), 'name': _word(r)}
+                               for _ in range(r.randrange(1, 8))]
+        blobs.append({'type': 'data.hexstring', 'value': encode(inner, False).hex()})
+    return {'type': 'dict', 'value': {
+        '$class': {'type': 'string_ascii', 'value': 'Nested'},
+        'documents': {'type': 'array', 'value': blobs},
+    }}, True
+
+def numeric_arrays(r, scale):
+    """sensor-style captures: long arrays of ints, uints, floats and doubles"""
+    def samples(type, n, value):
+        return {'type': 'array', 'value': [{'type': type, 'value': value()} for _ in range(n)]}
+    n = 5000 * scale
+    return {'type': 'dict', 'value': {
+        '$class': {'type': 'string_ascii', 'value': 'Samples'},
+        'timestamps': samples('int', n, lambda: -r.randrange(1, 2**62)),
+        'counters': samples('int', n, lambda: r.randrange(-2**15, 2**15)),
+        'totals': samples('uint', n, lambda: r.randrange(2**48)),
+        'temperatures': samples('float', n, lambda: r.uniform(-40, 80)),
+        'positions': samples('double', n, r.random),
+    }}, True
+
+CORPORA = {
+    'wide_dict': wide_dict,
+    'deep_nesting': deep_nesting,
+    'large_blobs': large_blobs,
+    'shared_references': shared_references,
+    'utf16_strings': utf16_strings,
+    'keyed_archive': keyed_archive,
+    'nested_bplist17': nested_bplist17,
+    'numeric_arrays': numeric_arrays,
+}
+
+
+def encode(value, with_type_info):
+    fp = BytesIO()
+    _BinaryPlist17Writer(fp).write(value, with_type_info=with_type_info)
+    return fp.getvalue()
+
+def generate(name, scale=1):
+    """return (value, with_type_info) of the corpus name"""
+    r = random.Random('%s-%i-%s' % (name, SEED, scale))
+    return CORPORA[name](r, scale)
+
+def write_corpus(outputpath, scale=1):
+    os.makedirs(outputpath, exist_ok=True)
+    for name in CORPORA:
+        value, typed = generate(name, scale)
+        path = os.path.join(outputpath, '%s%s.bplist17' % (name, '.typed' if typed else ''))
+        with open(path, 'wb') as file:
+            file.write(encode(value, typed))
+        print('%-60s %10i bytes' % (path, os.path.getsize(path)))
+
+def main(argv):
+    scale = 1
+    outputpath = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus')
+    opts, args = getopt.getopt(argv, "hs:o:", ["help", "scale=", "output="])
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            print(__doc__.strip())
+            sys.exit(0)
+        elif opt in ("-s", "--scale"):
+            scale = int(arg)
+        elif opt in ("-o", "--output"):
+            outputpath = arg
+    write_corpus(outputpath, scale)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
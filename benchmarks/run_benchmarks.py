@@ -0,0 +1,220 @@
+# Copyright 2023 Hendrik Wingbermuehle, Denys Serdyukov
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Measures parse and write throughput and peak memory of plist17lib on the
+synthetic corpus of generate_corpus.py and compares it against a baseline.
+Documents are parsed from bytes in memory, so the results do not include
+the gain of mapping files (see the README).
+
+Usage:
+  python3 benchmarks/run_benchmarks.py [options]
+
+Options:
+  -s, --scale <n>        corpus scale (default 1)
+  -n, --repeat <n>       timing runs per corpus, the fastest run counts (default 5)
+  -c, --corpus <name>    only run the given corpus, can be repeated
+  -b, --baseline <file>  baseline to compare against (default benchmarks/baseline.json)
+  --save                 store the results as the new baseline
+  --check                exit with an error if a result regressed by more than the threshold
+  --threshold <pct>      allowed regression in percent (default 10)
+"""
+
+import os
+import sys
+import json
+import time
+import getopt
+import platform
+import tracemalloc
+from io import BytesIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from plist17lib import _BinaryPlist17Parser, _BinaryPlist17Writer
+from generate_corpus import CORPORA, generate, encode
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+# (key, label, higher is better)
+METRICS = [
+    ('parse_mb_s', 'parse MB/s', True),
+    ('parse_objects_s', 'parse obj/s', True),
+    ('parse_peak_kb', 'parse peak KB', False),
+    ('write_mb_s', 'write MB/s', True),
+    ('write_objects_s', 'write obj/s', True),
+    ('write_peak_kb', 'write peak KB', False),
+]
+
+
+def count_objects(data, typed):
+    """number of encoded objects, i.e. everything but the end of containers"""
+    p = _BinaryPlist17Parser(dict_type=dict)
+    return sum(1 for event in p.iter_events(data, with_type_info=typed, follow_references=False)
+               if not event[0].startswith('end_'))
+
+def parse(data, typed):
+    return _BinaryPlist17Parser(dict_type=dict).parse_buffer(data, with_type_info=typed)
+
+def write(value, typed):
+    _BinaryPlist17Writer(BytesIO()).write(value, with_type_info=typed)
+
+def round_trips(data, typed):
+    """whether the parsed document is written back as a document which parses to the same value"""
+    value = parse(data, typed)
+    fp = BytesIO()
+    _BinaryPlist17Writer(fp).write(value, with_type_info=typed)
+    return parse(fp.getvalue(), typed) == value
+
+def best_time(function, repeat, min_total=0.5):
+    """fastest of at least repeat runs, small corpora are repeated until min_total seconds passed"""
+    best = None
+    total = 0.0
+    runs = 0
+    while runs < repeat or total < min_total:
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+        total += elapsed
+        runs += 1
+    return best
+
+def peak_memory(function):
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def run_corpus(name, scale, repeat):
+    value, typed = generate(name, scale)
+    data = encode(value, typed)
+    objects = count_objects(data, typed)
+    mb = len(data) / 1e6
+    if not round_trips(data, typed):
+        raise ValueError("the corpus %s does not round-trip through the parser and writer" % name)
+
+    parse_s = best_time(lambda: parse(data, typed), repeat)
+    parse_peak = peak_memory(lambda: parse(data, typed))
+    write_s = best_time(lambda: write(value, typed), repeat)
+    write_peak = peak_memory(lambda: write(value, typed))
+
+    return {
+        'bytes': len(data),
+        'objects': objects,
+        'parse_mb_s': round(mb / parse_s, 3),
+        'parse_objects_s': round(objects / parse_s),
+        'parse_peak_kb': round(parse_peak / 1024),
+        'write_mb_s': round(mb / write_s, 3),
+        'write_objects_s': round(objects / write_s),
+        'write_peak_kb': round(write_peak / 1024),
+    }
+
+def compare(results, baseline, threshold):
+    """print the change against the baseline, return the list of regressions"""
+    regressions = []
+    print()
+    print('%-20s %-15s %14s %14s %9s' % ('corpus', 'metric', 'baseline', 'current', 'change'))
+    for name, result in results.items():
+        old = baseline.get(name)
+        if old is None:
+            print('%-20s (not in baseline)' % name)
+            continue
+        for key, label, higher_is_better in METRICS:
+            if not old.get(key):
+                continue
+            change = (result[key] - old[key]) / old[key] * 100
+            regressed = (change < -threshold) if higher_is_better else (change > threshold)
+            print('%-20s %-15s %14s %14s %+8.1f%%%s' % (name, label, old[key], result[key], change,
+                                                      '  REGRESSION' if regressed else ''))
+            if regressed:
+                regressions.append((name, label, change))
+    return regressions
+
+def main(argv):
+    scale = 1
+    repeat = 5
+    names = []
+    baseline_path = DEFAULT_BASELINE
+    save = False
+    check = False
+    threshold = 10.0
+    opts, args = getopt.getopt(argv, "hs:n:c:b:", ["help", "scale=", "repeat=", "corpus=", "baseline=",
+                                                  "save", "check", "threshold="])
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            print(__doc__.strip())
+            sys.exit(0)
+        elif opt in ("-s", "--scale"):
+            scale = int(arg)
+        elif opt in ("-n", "--repeat"):
+            repeat = int(arg)
+        elif opt in ("-c", "--corpus"):
+            if arg not in CORPORA:
+                print('Unknown corpus %s, available: %s' % (arg, ', '.join(CORPORA)), file=sys.stderr)
+                sys.exit(1)
+            names.append(arg)
+        elif opt in ("-b", "--baseline"):
+            baseline_path = arg
+        elif opt == "--save":
+            save = True
+        elif opt == "--check":
+            check = True
+        elif opt == "--threshold":
+            threshold = float(arg)
+
+    results = {}
+    print('%-20s %10s %9s' % ('corpus', 'bytes', 'objects') + ''.join(' %14s' % label for _, label, _ in METRICS))
+    for name in names or CORPORA:
+        result = run_corpus(name, scale, repeat)
+        results[name] = result
+        print('%-20s %10i %9i' % (name, result['bytes'], result['objects'])
+              + ''.join(' %14s' % result[key] for key, _, _ in METRICS))
+
+    baseline = None
+    if os.path.isfile(baseline_path):
+        with open(baseline_path) as file:
+            baseline = json.load(file)
+
+    regressions = []
+    if baseline is not None and not save:
+        if baseline.get('scale') != scale:
+            print('\nThe baseline was recorded with scale %s, not comparing.' % baseline.get('scale'))
+        else:
+            regressions = compare(results, baseline['results'], threshold)
+
+    if save:
+        if baseline is not None and baseline.get('scale') == scale:
+            # keep results of corpora that were not run
+            results = dict(baseline['results'], **results)
+        with open(baseline_path, 'w') as file:
+            json.dump({
+                'scale': scale,
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'input': 'bytes',
+                'results': results,
+            }, file, indent=4)
+            file.write('\n')
+        print('\nSaved baseline to %s' % baseline_path)
+
+    if check and regressions:
+        print('\n%i results regressed by more than %s%%.' % (len(regressions), threshold))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,111 @@
+# Copyright 2023 Hendrik Wingbermuehle, Denys Serdyukov
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from .manifest import MANIFEST_NAME, Manifest, find_inputs
+
+
+def parse_jobs(arg):
+    """parse the argument of --jobs, 0 means one job per CPU"""
+    jobs = int(arg)
+    if jobs < 0:
+        raise ValueError("the number of jobs must not be negative")
+    if jobs == 0:
+        jobs = os.cpu_count() or 1
+    return jobs
+
+def run_batch(function, tasks, jobs=1):
+    """
+    Call function(*task) for every task, in up to jobs worker processes.
+
+    Yields (task, result, error) tuples in the order of tasks, independent
+    of the order in which the workers finish. A task that raises an
+    exception yields it as error, the remaining tasks are still run.
+    """
+    if jobs <= 1 or len(tasks) <= 1:
+        for task in tasks:
+            try:
+                yield task, function(*task), None
+            except Exception as e:
+                yield task, None, e
+        return
+
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(function, *task) for task in tasks]
+        for task, future in zip(tasks, futures):
+            try:
+                yield task, future.result(), None
+            except Exception as e:
+                yield task, None, e
+
+def report_error(path, error):
+    print('Failed to convert %s: %s' % (path, repr(error)), file=sys.stderr)
+
+def convert_directory(function, inputpath, outputpath, in_suffix, out_suffix, typed,
+                      jobs=1, recursive=False, manifest_path=None, on_result=None, args=(), options=None):
+    """
+    Call function(in_filepath, out_filepath, typed, *args) for all files in inputpath
+    ending with in_suffix. The output file name replaces in_suffix by out_suffix,
+    subdirectories are mirrored into outputpath. Without an outputpath, out_filepath
+    is empty. on_result(in_filepath, out_filepath, result) is called for every
+    converted file.
+
+    If manifest_path is given, inputs that did not change since the last run are
+    skipped and outputs of deleted inputs are removed. options (a dict) are output
+    options besides typed and recursive that invalidate the manifest when they change.
+
+    Returns (converted, skipped, failed).
+    """
+    relpaths = find_inputs(inputpath, in_suffix, recursive)
+    manifest_options = {'typed': typed, 'recursive': recursive}
+    manifest_options.update(options or {})
+    manifest = Manifest(manifest_path, manifest_options) if manifest_path else None
+
+    tasks = []
+    skipped = 0
+    for relpath in relpaths:
+        in_filepath = os.path.join(inputpath, relpath)
+        if outputpath:
+            out_filepath = os.path.join(outputpath, relpath[:-len(in_suffix)] + out_suffix)
+        else:
+            out_filepath = ''
+        if manifest is not None and manifest.is_current(relpath, in_filepath, out_filepath):
+            skipped += 1
+            continue
+        if out_filepath:
+            os.makedirs(os.path.dirname(out_filepath), exist_ok=True)
+        tasks.append((in_filepath, out_filepath, typed) + tuple(args))
+
+    failed = 0
+    for (in_filepath, out_filepath, *_), result, error in run_batch(function, tasks, jobs=jobs):
+        relpath = os.path.relpath(in_filepath, inputpath)
+        if error is not None:
+            report_error(in_filepath, error)
+            failed += 1
+            if manifest is not None:
+                manifest.forget(relpath)
+            continue
+        if on_result is not None:
+            on_result(in_filepath, out_filepath, result)
+        if manifest is not None:
+            manifest.record(relpath, in_filepath, out_filepath)
+
+    if manifest is not None:
+        for out_filepath in manifest.remove_stale(relpaths, inputpath, outputpath):
+            print('Removed stale output %s' % out_filepath)
+        manifest.save()
+
+    return len(tasks) - failed, skipped, failed
@@ -12,21 +12,33 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from plist17lib import _BinaryPlist17Writer
+from plist17lib import _BinaryPlist17Writer, Plist17Stats
 import sys, getopt
 import os
 import json
 from . import prog_name
+from .batch import parse_jobs, convert_directory, MANIFEST_NAME
 
 from io import BytesIO
 
-def create_from_json(json_in_path, plist_file_path, with_type_info):
+def create_from_json(json_in_path, plist_file_path, with_type_info, collect_stats=False, optimize=False):
+    """returns the writer statistics if collect_stats is set, else None"""
     with open(json_in_path, 'r') as json_file:
         data = json.load(json_file)
-        f = open(plist_file_path, 'wb') # will overwrite file
-        p = _BinaryPlist17Writer(f)
-        p.write(data, with_type_info=with_type_info)
-        f.close()
+    try:
+        with open(plist_file_path, 'wb') as f: # will overwrite file
+            p = _BinaryPlist17Writer(f, collect_stats=collect_stats, optimize=optimize)
+            p.write(data, with_type_info=with_type_info)
+    except BaseException:
+        # don't leave a truncated file behind
+        if os.path.exists(plist_file_path):
+            os.remove(plist_file_path)
+        raise
+    return p.stats
+
+def print_stats(stats):
+    print("Writer statistics:", file=sys.stderr)
+    print(stats.format(), file=sys.stderr)
 
 def printHelp(isError=False):
     if isError:
@@ -34,10 +46,18 @@ def printHelp(isError=False):
     else:
         out = sys.stdout
     print('Usage:', file=out)
-    print('  %s [-t] -i <input> -o <output>' % prog_name, file=out)
-    print('  %s [--typed] --input <input> --output <output>' % prog_name, file=out)
+    print('  %s [-t] [-j <jobs>] -i <input> -o <output>' % prog_name, file=out)
+    print('  %s [--typed] [--jobs <jobs>] --input <input> --output <output>' % prog_name, file=out)
     print('Input and output can either both be file paths, or both be directories.', file=out)
     print('The output contains additional type information if the option --typed or -t is used.', file=out)
+    print('With --optimize, the output is made as small as possible without changing its content.', file=out)
+    print('With --stats, object counts, sizes and timings per type are printed to stderr.', file=out)
+    print('Directories are converted by <jobs> worker processes (default 1, 0 for one per CPU).', file=out)
+    print('Options for directories:', file=out)
+    print('  -r, --recursive      also convert files in subdirectories, mirroring them in the output', file=out)
+    print('  --incremental        skip inputs unchanged since the last run and remove outputs of', file=out)
+    print('                       deleted inputs, tracked in <output>/%s' % MANIFEST_NAME, file=out)
+    print('  --manifest <file>    like --incremental, but with the given manifest file', file=out)
 
 def main(argv = None):
     if argv == None:
@@ -45,7 +65,13 @@ def main(argv = None):
     inputpath = ''
     outputpath = ''
     typed = False
-    opts, args = getopt.getopt(argv,"hti:o:",["help","typed","input=","output="])
+    jobs = 1
+    recursive = False
+    incremental = False
+    manifestpath = ''
+    stats = False
+    optimize = False
+    opts, args = getopt.getopt(argv,"hti:o:j:r",["help","typed","input=","output=","jobs=","recursive","incremental","manifest=","stats","optimize"])
     for opt, arg in opts:
         if opt in ("-h", "--help"):
             printHelp()
@@ -58,6 +84,24 @@ def main(argv = None):
         elif opt in ("-o", "--output"):
             outputpath = arg
             # print('Output is: ', outputpath)
+        elif opt in ("-j", "--jobs"):
+            try:
+                jobs = parse_jobs(arg)
+            except ValueError:
+                print('Invalid number of jobs: %s' % arg)
+                printHelp(isError=True)
+                sys.exit(1)
+        elif opt in ("-r", "--recursive"):
+            recursive = True
+        elif opt == "--incremental":
+            incremental = True
+        elif opt == "--manifest":
+            incremental = True
+            manifestpath = arg
+        elif opt == "--stats":
+            stats = True
+        elif opt == "--optimize":
+            optimize = True
 
     if not inputpath: 
         print('No input specified.')
@@ -75,7 +119,9 @@ def main(argv = None):
             printHelp(isError=True)
             sys.exit(1)
         else:
-            create_from_json(inputpath, outputpath, typed)
+            file_stats = create_from_json(inputpath, outputpath, typed, stats, optimize)
+            if stats:
+                print_stats(file_stats)
     else:
         if os.path.isfile(outputpath):
             print('The specified input is a directory, so the output path must be also a directory.')
@@ -86,14 +132,24 @@ def main(argv = None):
             os.makedirs(outputpath)
 
         # create *.bplist17 files for all *.json files in directory
-        for file in sorted(os.listdir(inputpath)): 
-            if file.endswith(".json"):
-                in_filepath = os.path.join(inputpath, file)
-                # use file name without 'bplist17' at the end, i.e. file[:-4], and append 'bplist17' instead
-                out_filepath = os.path.join(outputpath, file[:-4] + 'bplist17')
-                # print('Input file path is:  ', in_filepath)
-                # print('Output file path is: ', out_filepath)
-                create_from_json(in_filepath, out_filepath, typed)
+        if incremental and not manifestpath:
+            manifestpath = os.path.join(outputpath, MANIFEST_NAME)
+        total_stats = Plist17Stats()
+        def on_result(in_filepath, out_filepath, file_stats):
+            if file_stats is not None:
+                total_stats.update(file_stats)
+
+        converted, skipped, failed = convert_directory(create_from_json, inputpath, outputpath, ".json", ".bplist17", typed,
+                                                       jobs=jobs, recursive=recursive,
+                                                       manifest_path=manifestpath, on_result=on_result,
+                                                       args=(stats, optimize), options={'optimize': optimize})
+        if stats:
+            print_stats(total_stats)
+        if skipped:
+            print('Skipped %i unchanged files.' % skipped)
+        if failed:
+            print('Failed to convert %i of %i files.' % (failed, converted + failed))
+            sys.exit(1)
 
     print('Done.')
 
@@ -0,0 +1,137 @@
+# Copyright 2023 Hendrik Wingbermuehle, Denys Serdyukov
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import json
+import hashlib
+
+MANIFEST_NAME = '.bplist17-manifest'
+MANIFEST_VERSION = 1
+
+
+def find_inputs(inputpath, suffix, recursive=False):
+    """return the paths of all files ending with suffix, relative to inputpath and sorted"""
+    if not recursive:
+        return [file for file in sorted(os.listdir(inputpath))
+                if file.endswith(suffix) and os.path.isfile(os.path.join(inputpath, file))]
+    result = []
+    for root, dirs, files in os.walk(inputpath):
+        dirs.sort()
+        for file in sorted(files):
+            if file.endswith(suffix):
+                result.append(os.path.relpath(os.path.join(root, file), inputpath))
+    return result
+
+def prune_empty_dirs(directory, root):
+    """remove directory and its parents up to (excluding) root as long as they are empty"""
+    root = os.path.abspath(root)
+    directory = os.path.abspath(directory)
+    while directory != root and directory.startswith(root + os.sep):
+        try:
+            os.rmdir(directory)
+        except OSError:
+            # not empty
+            return
+        directory = os.path.dirname(directory)
+
+def file_hash(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class Manifest:
+    """
+    Records size, mtime and content hash of every converted input file
+    together with the output it produced, so unchanged inputs can be
+    skipped when a directory is converted again.
+
+    The manifest is only valid for the options it was written with, a
+    manifest written with different options is discarded.
+    """
+
+    def __init__(self, path, options):
+        self.path = path
+        self.options = options
+        self.entries = {}
+        try:
+            with open(path, 'r') as file:
+                content = json.load(file)
+        except (OSError, ValueError):
+            return
+        if (isinstance(content, dict) and content.get('version') == MANIFEST_VERSION
+                and content.get('options') == options and isinstance(content.get('files'), dict)):
+            self.entries = content['files']
+
+    def is_current(self, relpath, in_filepath, out_filepath):
+        entry = self.entries.get(relpath)
+        if entry is None or entry.get('output') != out_filepath or not os.path.isfile(out_filepath):
+            return False
+        st = os.stat(in_filepath)
+        if st.st_size != entry.get('size'):
+            return False
+        if st.st_mtime_ns == entry.get('mtime'):
+            return True
+        # touched, but possibly not modified
+        if file_hash(in_filepath) != entry.get('sha256'):
+            return False
+        entry['mtime'] = st.st_mtime_ns
+        return True
+
+    def record(self, relpath, in_filepath, out_filepath):
+        st = os.stat(in_filepath)
+        self.entries[relpath] = {
+            'size': st.st_size,
+            'mtime': st.st_mtime_ns,
+            'sha256': file_hash(in_filepath),
+            'output': out_filepath,
+        }
+
+    def forget(self, relpath):
+        self.entries.pop(relpath, None)
+
+    def remove_stale(self, relpaths, inputpath, outputpath):
+        """
+        forget the entries of inputs that are not in relpaths anymore, and
+        remove their outputs if the input file was deleted, together with
+        mirrored directories in outputpath that become empty. Returns the
+        removed outputs.
+        """
+        relpaths = set(relpaths)
+        removed = []
+        for relpath in sorted(self.entries):
+            if relpath in relpaths:
+                continue
+            out_filepath = self.entries.pop(relpath).get('output')
+            if os.path.exists(os.path.join(inputpath, relpath)):
+                # still there, just not converted this time
+                continue
+            if out_filepath and os.path.isfile(out_filepath):
+                os.remove(out_filepath)
+                removed.append(out_filepath)
+                prune_empty_dirs(os.path.dirname(out_filepath), outputpath)
+        return removed
+
+    def save(self):
+        content = {
+            'version': MANIFEST_VERSION,
+            'options': self.options,
+            'files': self.entries,
+        }
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump(content, file, indent=4, sort_keys=True)
+        os.replace(tmp_path, self.path)
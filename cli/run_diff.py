@@ -0,0 +1,107 @@
+# Copyright 2023 Hendrik Wingbermuehle, Denys Serdyukov
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from plist17lib import _BinaryPlist17Parser, InvalidFileException
+import json
+import sys, getopt
+import os
+from . import prog_name
+from .run_parser import json_default
+
+MARKERS = {'changed': '~', 'added': '+', 'removed': '-'}
+
+def format_path(path):
+    """the path in the form extract() accepts, / for the root object"""
+    return '/'.join(str(component) for component in path) or '/'
+
+def format_value(value):
+    return json.dumps(value, separators=(',', ':'), default=json_default)
+
+def print_differences(differences, out):
+    for difference in differences:
+        marker = MARKERS[difference.kind]
+        if difference.kind == 'changed':
+            print('%s %s: %s -> %s' % (marker, format_path(difference.path),
+                                       format_value(difference.old), format_value(difference.new)), file=out)
+        else:
+            value = difference.new if difference.kind == 'added' else difference.old
+            print('%s %s: %s' % (marker, format_path(difference.path), format_value(value)), file=out)
+
+def write_json(differences, out):
+    json.dump([{'path': difference.path, 'kind': difference.kind,
+                'old': difference.old, 'new': difference.new} for difference in differences],
+              out, indent=4, default=json_default)
+    print(file=out)
+
+def printHelp(isError=False):
+    if isError:
+        out = sys.stderr
+    else:
+        out = sys.stdout
+    print('Usage:', file=out)
+    print('  %s [-t] [-j] <old> <new>' % prog_name, file=out)
+    print('  %s [--typed] [--json] <old> <new>' % prog_name, file=out)
+    print('Prints the paths at which the bplist17 files <old> and <new> differ, one per line:', file=out)
+    print('  ~ <path>: <old value> -> <new value>    the value was changed', file=out)
+    print('  + <path>: <new value>                   the value was added', file=out)
+    print('  - <path>: <old value>                   the value was removed', file=out)
+    print('The values contain additional type information if the option --typed or -t is used.', file=out)
+    print('With --json or -j, the differences are written as a JSON array instead.', file=out)
+    print('The exit status is 0 if the files are equal, 1 if they differ and 2 on errors.', file=out)
+
+def main(argv = None):
+    if argv == None:
+        argv = sys.argv[1:]
+    typed = False
+    as_json = False
+    try:
+        opts, args = getopt.getopt(argv,"htj",["help","typed","json"])
+    except getopt.GetoptError as error:
+        print(error)
+        printHelp(isError=True)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            printHelp()
+            sys.exit(0)
+        elif opt in ("-t", "--typed"):
+            typed = True
+        elif opt in ("-j", "--json"):
+            as_json = True
+
+    if len(args) != 2:
+        print('Two files to compare must be specified.')
+        printHelp(isError=True)
+        sys.exit(2)
+    for path in args:
+        if not os.path.isfile(path):
+            print('The specified file does not exist: %s' % path)
+            printHelp(isError=True)
+            sys.exit(2)
+
+    p = _BinaryPlist17Parser(dict_type=dict)
+    try:
+        differences = p.diff(args[0], args[1], with_type_info=typed)
+    except (InvalidFileException, OSError) as error:
+        print('Failed to compare the files: %s' % error, file=sys.stderr)
+        sys.exit(2)
+    if as_json:
+        write_json(differences, sys.stdout)
+    else:
+        print_differences(differences, sys.stdout)
+    sys.exit(1 if differences else 0)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -12,30 +12,97 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from plist17lib import _BinaryPlist17Parser
+from plist17lib import _BinaryPlist17Parser, Plist17Stats, TypedNode
 import plistlib
 import json
+import datetime
 import sys, getopt
 import os
 from . import prog_name
-from io import BytesIO
-
-def parse_file(plist_file_path, json_out_path, with_type_info):
-    with open(plist_file_path, 'rb') as file:
-        p = _BinaryPlist17Parser(dict_type=dict)
-        result = p.parse(file, with_type_info=with_type_info)
-        jsonString = json.dumps(result, indent=4)
-        # write to output if specified, else write to stdout
-        if json_out_path:
-             f = open(json_out_path, "w") # will overwrite file
-             f.write(jsonString)
-             f.close()
-        else:
-            print("================================================================================")
-            print("Parsing: ", plist_file_path)
-            print("--------------------------------------------------------------------------------")
-            print(jsonString)
-            print("================================================================================\n\n")
+from .batch import parse_jobs, convert_directory, MANIFEST_NAME
+from io import StringIO
+
+def json_default(value):
+    """JSON representation of typed nodes and of the values nested bplist00 documents may contain"""
+    if isinstance(value, TypedNode):
+        return value.as_dict()
+    if isinstance(value, (bytes, bytearray)):
+        return value.hex()
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    if isinstance(value, plistlib.UID):
+        return {'CF$UID': value.data}
+    raise TypeError("Object of type %s is not JSON serializable" % type(value).__name__)
+
+def write_json(parser, plist_file_path, out, with_type_info, compact=False):
+    """write the JSON for plist_file_path (or a binary stream) to the text file out"""
+    indent, separators = (None, (',', ':')) if compact else (4, None)
+    if parser.stats is not None:
+        # statistics are collected while the tree is built, streams like
+        # stdin are read into memory for it
+        result = parser.parse_buffer(plist_file_path, with_type_info=with_type_info)
+        json.dump(result, out, indent=indent, separators=separators, default=json_default)
+    elif not isinstance(plist_file_path, str):
+        # streams like stdin are decoded forward-only if they can't seek
+        result = parser.parse(plist_file_path, with_type_info=with_type_info)
+        json.dump(result, out, indent=indent, separators=separators, default=json_default)
+    else:
+        parser.transcode(plist_file_path, out, with_type_info=with_type_info,
+                         indent=indent, separators=separators, default=json_default)
+
+def convert_file(plist_file_path, json_out_path, with_type_info, collect_stats=False, compact=False):
+    """
+    write the JSON for plist_file_path to json_out_path, returns (jsonString, stats).
+    jsonString is None if an output path is given, stats is None unless collect_stats is set.
+    """
+    p = _BinaryPlist17Parser(dict_type=dict, collect_stats=collect_stats)
+    if json_out_path:
+        try:
+            with open(json_out_path, "w") as f: # will overwrite file
+                write_json(p, plist_file_path, f, with_type_info, compact)
+        except BaseException:
+            # don't leave a truncated file behind
+            if os.path.exists(json_out_path):
+                os.remove(json_out_path)
+            raise
+        return None, p.stats
+    out = StringIO()
+    write_json(p, plist_file_path, out, with_type_info, compact)
+    return out.getvalue(), p.stats
+
+def print_header(plist_file_path):
+    print("================================================================================")
+    print("Parsing: ", plist_file_path)
+    print("--------------------------------------------------------------------------------")
+
+def print_footer():
+    print("================================================================================\n\n")
+
+def print_result(plist_file_path, jsonString):
+    print_header(plist_file_path)
+    print(jsonString)
+    print_footer()
+
+def parse_file(plist_file_path, json_out_path, with_type_info, collect_stats=False, compact=False):
+    # write to output if specified, else write to stdout. '-' is stdin as
+    # input, and stdout without the decoration as output
+    source = sys.stdin.buffer if plist_file_path == '-' else plist_file_path
+    if json_out_path and json_out_path != '-':
+        return convert_file(source, json_out_path, with_type_info, collect_stats, compact)[1]
+    p = _BinaryPlist17Parser(dict_type=dict, collect_stats=collect_stats)
+    if json_out_path == '-':
+        write_json(p, source, sys.stdout, with_type_info, compact)
+        print()
+        return p.stats
+    print_header(plist_file_path)
+    write_json(p, source, sys.stdout, with_type_info, compact)
+    print()
+    print_footer()
+    return p.stats
+
+def print_stats(stats):
+    print("Parser statistics:", file=sys.stderr)
+    print(stats.format(), file=sys.stderr)
 
 def printHelp(isError=False):
     if isError:
@@ -43,10 +110,19 @@ def printHelp(isError=False):
     else:
         out = sys.stdout
     print('Usage:', file=out)
-    print('  %s [-t] -i <input> [-o <output>]' % prog_name, file=out)
-    print('  %s [--typed] --input <input> [--output <output>]' % prog_name, file=out)
+    print('  %s [-t] [-j <jobs>] -i <input> [-o <output>]' % prog_name, file=out)
+    print('  %s [--typed] [--jobs <jobs>] --input <input> [--output <output>]' % prog_name, file=out)
     print('Input and output can either both be file paths, or both be directories.', file=out)
+    print('A file path can be - for stdin or stdout, stdout then only receives the JSON.', file=out)
     print('The output contains additional type information if the option --typed or -t is used.', file=out)
+    print('With --compact, the JSON is written without indentation and spaces.', file=out)
+    print('With --stats, object counts, sizes and timings per type are printed to stderr.', file=out)
+    print('Directories are converted by <jobs> worker processes (default 1, 0 for one per CPU).', file=out)
+    print('Options for directories:', file=out)
+    print('  -r, --recursive      also convert files in subdirectories, mirroring them in the output', file=out)
+    print('  --incremental        skip inputs unchanged since the last run and remove outputs of', file=out)
+    print('                       deleted inputs, tracked in <output>/%s' % MANIFEST_NAME, file=out)
+    print('  --manifest <file>    like --incremental, but with the given manifest file', file=out)
 
 def main(argv = None):
     if argv == None:
@@ -54,7 +130,13 @@ def main(argv = None):
     inputpath = ''
     outputpath = ''
     typed = False
-    opts, args = getopt.getopt(argv,"hti:o:",["help","typed","input=","output="])
+    jobs = 1
+    recursive = False
+    incremental = False
+    manifestpath = ''
+    stats = False
+    compact = False
+    opts, args = getopt.getopt(argv,"hti:o:j:r",["help","typed","input=","output=","jobs=","recursive","incremental","manifest=","stats","compact"])
     for opt, arg in opts:
         if opt in ("-h", "--help"):
             printHelp()
@@ -67,21 +149,45 @@ def main(argv = None):
         elif opt in ("-o", "--output"):
             outputpath = arg
             # print('Output is: ', outputpath)
+        elif opt in ("-j", "--jobs"):
+            try:
+                jobs = parse_jobs(arg)
+            except ValueError:
+                print('Invalid number of jobs: %s' % arg)
+                printHelp(isError=True)
+                sys.exit(1)
+        elif opt in ("-r", "--recursive"):
+            recursive = True
+        elif opt == "--incremental":
+            incremental = True
+        elif opt == "--manifest":
+            incremental = True
+            manifestpath = arg
+        elif opt == "--stats":
+            stats = True
+        elif opt == "--compact":
+            compact = True
 
     if not inputpath: 
         print('No input specified.')
         printHelp(isError=True)
         sys.exit(1)
 
-    if os.path.isfile(inputpath):
+    if inputpath == '-' or os.path.isfile(inputpath):
         if outputpath and (not os.path.basename(outputpath) or os.path.isdir(outputpath)):
             print('The specified input is not a directory, so the output path must also not be a directory.')
             printHelp(isError=True)
             sys.exit(1)
         else:
-            parse_file(inputpath, outputpath, typed)
+            file_stats = parse_file(inputpath, outputpath, typed, stats, compact)
+            if stats:
+                print_stats(file_stats)
     else:
         if outputpath: # if an output path was specified, check it
+            if outputpath == '-':
+                print('The specified input is a directory, so the output can not be stdout.')
+                printHelp(isError=True)
+                sys.exit(1)
             if os.path.isfile(outputpath):
                 print('The specified input is a directory, so the output path must be also a directory.')
                 printHelp(isError=True)
@@ -90,20 +196,36 @@ def main(argv = None):
                 # Create new output directory since it does not exist
                 os.makedirs(outputpath)
 
+        if incremental and not outputpath:
+            print('Incremental conversion requires an output directory.')
+            printHelp(isError=True)
+            sys.exit(1)
+
         # parse all *.bplist17 files in directory
-        for file in sorted(os.listdir(inputpath)): 
-            if file.endswith(".bplist17"):
-                in_filepath = os.path.join(inputpath, file)
-                if outputpath:
-                    # use file name without 'bplist17' at the end, i.e. file[:-8], and append 'json' instead
-                    out_filepath = os.path.join(outputpath, file[:-8] + 'json')
-                else:
-                    out_filepath = ''
-                # print('Input file path is:  ', in_filepath)
-                # print('Output file path is: ', out_filepath)
-                parse_file(in_filepath, out_filepath, typed)
-
-    print('Done.')
+        if incremental and not manifestpath:
+            manifestpath = os.path.join(outputpath, MANIFEST_NAME)
+        total_stats = Plist17Stats()
+        def on_result(in_filepath, out_filepath, result):
+            jsonString, file_stats = result
+            if not out_filepath:
+                print_result(in_filepath, jsonString)
+            if file_stats is not None:
+                total_stats.update(file_stats)
+
+        converted, skipped, failed = convert_directory(convert_file, inputpath, outputpath, ".bplist17", ".json", typed,
+                                                       jobs=jobs, recursive=recursive,
+                                                       manifest_path=manifestpath, on_result=on_result,
+                                                       args=(stats, compact), options={'compact': compact})
+        if stats:
+            print_stats(total_stats)
+        if skipped:
+            print('Skipped %i unchanged files.' % skipped)
+        if failed:
+            print('Failed to convert %i of %i files.' % (failed, converted + failed))
+            sys.exit(1)
+
+    if outputpath != '-':
+        print('Done.')
 
 
 if __name__ == "__main__":
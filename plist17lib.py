@@ -17,291 +17,3184 @@
 
 from plistlib import InvalidFileException, PlistFormat
 from plistlib import load as plistlibLoad
+from plistlib import loads as plistlibLoads, dumps as plistlibDumps, FMT_BINARY
 import struct
-from io import BytesIO
+from io import BytesIO, BufferedReader, FileIO
 import math
+import mmap
+import os
+import copy
+import hashlib
+import base64
+import time
 import json
+import array
+import bisect
+import operator
+import re
+import sys
+from json.encoder import encode_basestring_ascii as _json_string
+from collections import OrderedDict, namedtuple, Counter
+from collections.abc import Mapping, Sequence
+from itertools import accumulate, compress, count
+
+try:
+    import numpy
+except ImportError: # optional, see numpy_arrays
+    numpy = None
 
 __version__="0.0.3"
 
-__all__ = [
-    "_BinaryPlist17Parser",
-    "_BinaryPlist17Writer"
-]
+__all__ = [
+    "_BinaryPlist17Parser",
+    "_BinaryPlist17Writer",
+    "_BinaryPlist17Builder",
+    "Plist17Stats",
+    "Plist17Index",
+    "TypedNode"
+]
+
+class _BinaryPlist17Parser:
+    """
+    Read or write a bplist17 file.
+    Raise InvalidFileException in case of error, otherwise return the
+    root object.
+    """
+
+    def __init__(self, dict_type, cache_references=False, cache_size=None,
+                 copy_cached=False, collect_stats=False, data_mode='hex',
+                 data_threshold=None, max_nested_depth=16, lazy_nested=False,
+                 numpy_arrays=False, typed_nodes=False, preserve_layout=False,
+                 nested_bplist00=False):
+        """
+        If cache_references is set, objects behind 0x80 references are
+        decoded once per document and then served from an address keyed
+        cache. cache_size bounds the cache (least recently used entries are
+        evicted first) and copy_cached returns deep copies instead of shared
+        objects on cache hits.
+
+        If collect_stats is set, parse() and parse_buffer() count objects,
+        bytes and decoding time per type in self.stats (see Plist17Stats).
+
+        data_mode selects how data objects (0x4X) are returned:
+
+            'hex'           hex string, type 'data.hexstring' (default)
+            'base64'        base64 string, type 'data.base64'
+            'bytes'         bytes, type 'data.bytes'
+            'memoryview'    read-only zero-copy slice of the parsed buffer,
+                            type 'data.memoryview'. A mapped file stays open
+                            as long as slices of it are referenced.
+
+        Data objects longer than data_threshold bytes are not decoded at all
+        but returned as DataReference(offset, length) into the document,
+        type 'data.reference'.
+
+        Data objects that contain a bplist17 document are parsed (type
+        'data.bplist17') with the same options, directly from their window of
+        the parent buffer, up to max_nested_depth levels deep. Deeper
+        documents are returned as data. With lazy_nested, they are returned
+        as _LazyNestedPlist placeholders which are parsed on first access.
+
+        With nested_bplist00, data objects that contain a bplist00 document
+        are parsed with plistlib as well (type 'data.bplist00'). Its UIDs,
+        data and dates have no JSON representation the writer can read back,
+        so by default they are returned as data.
+
+        With numpy_arrays (requires numpy), non-empty arrays that consist
+        only of ints, only of uints, only of floats or only of doubles are
+        returned as numpy arrays of dtype int64, uint64, float32 or float64,
+        filled directly from the buffer. This does not apply to lazy parsing.
+
+        With typed_nodes, with_type_info wraps values in TypedNode objects
+        instead of {'type': ..., 'value': ...} dicts of dict_type, which
+        take a fraction of the memory. The writer accepts both.
+
+        With preserve_layout, parse() and parse_buffer() return arrays, dicts
+        and typed nodes that remember the bytes they were decoded from until
+        they (or their children) are modified. The writer copies unmodified
+        ones as they are instead of encoding them again, so writing back a
+        document after a small change costs little more than the copy. This
+        does not apply to lazy parsing, numpy_arrays, cache_references and
+        collect_stats, and the document is held in memory.
+        """
+        if data_mode not in _DATA_MODES:
+            raise ValueError("unsupported data mode: %s" % data_mode)
+        if numpy_arrays and numpy is None:
+            raise ImportError("numpy_arrays requires numpy")
+        self._dict_type = dict_type
+        self._data_mode = data_mode
+        self._data_threshold = data_threshold
+        self._max_nested_depth = max_nested_depth
+        self._lazy_nested = lazy_nested
+        self._numpy_arrays = numpy_arrays
+        self._preserve_layout = preserve_layout
+        self._nested_bplist00 = nested_bplist00
+        self._node_factory = TypedNode if typed_nodes else None
+        self._nested_level = 0
+        if cache_references:
+            self._reference_cache = _ReferenceCache(maxsize=cache_size, copy_hits=copy_cached)
+        else:
+            self._reference_cache = None
+        self.stats = Plist17Stats() if collect_stats else None
+
+    def cache_info(self):
+        """return hit and miss counters of the reference cache, or None if disabled"""
+        if self._reference_cache is None:
+            return None
+        return self._reference_cache.info()
+
+    def cache_clear(self):
+        """drop cached objects and reset the counters of the reference cache"""
+        if self._reference_cache is not None:
+            self._reference_cache.reset()
+
+    def parse(self, fp, with_type_info=False):
+        # The basic file format:
+        # MAGIC (6 bytes)
+        # VERSION (2 bytes)
+
+        # ROOT Object
+
+        # regular files are mapped into memory, see _open_buffer(), pipes
+        # and sockets are read forward-only
+        if hasattr(fp, 'seekable') and not fp.seekable() and not self._preserve_layout:
+            return self.parse_stream(fp, with_type_info=with_type_info)
+        return self.parse_buffer(fp, with_type_info=with_type_info)
+
+    def parse_buffer(self, buffer, with_type_info=False, lazy=False):
+        """
+        Parse a bplist17 document directly from memory.
+
+        `buffer` may be bytes, a bytearray, a memoryview or a path, in which
+        case the file is mapped with mmap. Objects are decoded straight from
+        their offsets in the buffer, so no seeks or intermediate copies are
+        needed. The result is the same as the one of parse().
+
+        With lazy=True, arrays and dicts are returned as read-only sequence
+        and mapping proxies which decode an element only when it is accessed
+        (see _LazyArray and _LazyDict). The buffer is kept open as long as
+        the proxies are referenced.
+        """
+        if lazy:
+            return self._parse_lazy(buffer, with_type_info=with_type_info)
+        if self._preserve_layout:
+            return self._parse_with_layout(buffer, with_type_info=with_type_info)
+        if self._reference_cache is not None:
+            self._reference_cache.clear()
+        if self.stats is not None:
+            return self._parse_buffer_with_stats(buffer, with_type_info=with_type_info)
+        buf = mapped = None
+        try:
+            buf, mapped = _open_buffer(buffer)
+            self._buf = buf
+            return self._decode_object_at(0x8, with_type_info=with_type_info)[0]
+
+        except InvalidFileException:
+            raise
+        except (OSError, IndexError, struct.error, OverflowError,
+                ValueError):
+            raise InvalidFileException()
+        finally:
+            self._buf = None
+            _close_buffer(buf, mapped)
+
+    def _parse_with_layout(self, buffer, with_type_info=False):
+        buf = mapped = None
+        try:
+            buf, mapped = _open_buffer(buffer)
+            # the copy keeps the document valid while its file is overwritten
+            data = memoryview(buf.obj) if isinstance(buf.obj, bytes) else memoryview(bytes(buf))
+            return self._spawn(data)._decode_source_at(0x8, with_type_info=with_type_info)[0]
+
+        except InvalidFileException:
+            raise
+        except (OSError, IndexError, struct.error, OverflowError,
+                ValueError):
+            raise InvalidFileException()
+        finally:
+            _close_buffer(buf, mapped)
+
+    def _parse_buffer_with_stats(self, buffer, with_type_info=False):
+        stats = self.stats
+        start = time.perf_counter()
+        buf = mapped = None
+        try:
+            buf, mapped = _open_buffer(buffer)
+            self._buf = buf
+            result = self._decode_object_at_with_stats(0x8, with_type_info=with_type_info)[0]
+            stats.documents += 1
+            return result
+
+        except InvalidFileException:
+            raise
+        except (OSError, IndexError, struct.error, OverflowError,
+                ValueError):
+            raise InvalidFileException()
+        finally:
+            self._buf = None
+            _close_buffer(buf, mapped)
+            stats.seconds += time.perf_counter() - start
+
+    def extract(self, source, path, with_type_info=False, index=None):
+        """
+        Return the value at path without decoding the rest of the document.
+
+        source is a file object or anything parse_buffer() accepts. path is
+        a list of dict keys and array indices, e.g. ["$objects", 3, "NS.keys"],
+        or a string with the components separated by '/', e.g. "$objects/3".
+        The path is resolved against the tree parse() would return (type
+        info wrappers are skipped), so extract(fp, [a, b]) equals
+        parse(fp)[a][b]. Sibling subtrees are skipped using the end address
+        of their containers and references are only followed along the path.
+        Raise KeyError, IndexError or TypeError if the path does not exist.
+
+        With a Plist17Index of the document (see build_index()), arrays and
+        dicts on the path are looked up in the index instead of being walked.
+        """
+        if isinstance(path, str):
+            path = path.split('/') if path else []
+
+        if self._reference_cache is not None:
+            self._reference_cache.clear()
+        buf = mapped = None
+        try:
+            buf, mapped = _open_buffer(source)
+            self._buf = buf
+            if index is None:
+                addr, error = self._find_path(0x8, path, with_type_info=with_type_info)
+            elif index.size != len(buf):
+                error = ValueError("the index does not belong to this document")
+            else:
+                ordinal, error = self._find_path_indexed(index, 0, path, with_type_info=with_type_info)
+                if error is None:
+                    addr = index.offsets[ordinal]
+            if error is None:
+                return self._decode_object_at(addr, with_type_info=with_type_info)[0]
+
+        except InvalidFileException:
+            raise
+        except (OSError, IndexError, struct.error, OverflowError,
+                ValueError):
+            raise InvalidFileException()
+        finally:
+            self._buf = None
+            _close_buffer(buf, mapped)
+        raise error
+
+    def _find_path(self, addr, path, with_type_info=False):
+        """
+        return (address, None) of the object at path, starting at the object
+        at addr, or (None, exception) if the path does not exist.
+        """
+        buf = self._buf
+        for component in path:
+            addr = self._resolve_reference_at(addr)
+            tokenH = buf[addr] & 0xF0
+            endAddress = None
+            if tokenH == 0xA0 or tokenH == 0xD0:
+                endAddress = int.from_bytes(self._slice(addr + 1, 0x8), 'little')
+
+            if tokenH == 0xA0:  # array
+                if isinstance(component, str) and component.lstrip('-').isdigit():
+                    component = int(component)
+                if not isinstance(component, int) or isinstance(component, bool):
+                    return None, TypeError("array indices must be integers, not %s" % type(component).__name__)
+                offsets = []
+                pos = addr + 9
+                while pos <= endAddress and (component < 0 or len(offsets) <= component):
+                    offsets.append(pos)
+                    pos = self._skip_object_at(pos)
+                try:
+                    addr = offsets[component]
+                except IndexError:
+                    return None, IndexError("array index %i out of range" % component)
+
+            elif tokenH == 0xD0:  # dict
+                found = {}
+                pos = addr + 9
+                try:
+                    while pos <= endAddress:
+                        key, pos = self._decode_object_at(pos, with_type_info=False)
+                        if key == component or (not with_type_info and key in ("$class", "NS.keys", "NS.objects")):
+                            found[key] = pos
+                        pos = self._skip_object_at(pos)
+                except TypeError:
+                    raise InvalidFileException()
+
+                if not with_type_info:
+                    # apply _transformDictionary() to the looked up key
+                    class_value = self._decode_object_at(found["$class"])[0]
+                    if (class_value == "NSDictionary" or class_value == "NSMutableDictionary") and component != "$class":
+                        keys = self._decode_object_at(found["NS.keys"])[0]
+                        index = None
+                        for i in range(len(keys)):
+                            if keys[i] == component:
+                                index = i
+                        if index is None:
+                            return None, KeyError(component)
+                        found[component], error = self._find_path(found["NS.objects"], [index])
+                        if error is not None:
+                            raise InvalidFileException()
+                if component not in found:
+                    return None, KeyError(component)
+                addr = found[component]
+
+            else:
+                return None, TypeError("cannot look up %r in a scalar object at: %s" % (component, addr))
+
+        return addr, None
+
+    def _resolve_reference_at(self, addr):
+        """return the address of the object a (chain of) 0x80 references at addr points to"""
+        buf = self._buf
+        token = buf[addr]
+        seen = set()
+        while (token & 0xF0) == 0x80:
+            if addr in seen:
+                raise InvalidFileException() # a cycle of references
+            seen.add(addr)
+            size, pos = self._decode_dynamic_size(addr, addr + 1, token & 0x0F)
+            addr = int.from_bytes(buf[pos:pos + size], 'little')
+            token = buf[addr]
+        return addr
+
+    def parse_stream(self, fp, with_type_info=False):
+        """
+        Parse a bplist17 document from a forward-only binary stream, like a
+        pipe or socket, without seeking and without reading it into memory
+        first. parse() does this for streams that are not seekable.
+
+        Objects are decoded in the order they are read. Every decoded object
+        is registered with its address, so backward 0x80 references are
+        resolved from the registry instead of being decoded again (the
+        objects behind references are shared, like with cache_references).
+        References to objects that have not been read yet make the document
+        invalid. Reading stops at the end of the root object. numpy_arrays
+        and collect_stats do not apply.
+        """
+        reader = _StreamReader(fp)
+        try:
+            reader.read(0x8) # magic and version
+            return self._decode_stream(reader, with_type_info=with_type_info)
+
+        except InvalidFileException:
+            raise
+        except (OSError, IndexError, struct.error, OverflowError,
+                ValueError):
+            raise InvalidFileException()
+
+    def _decode_stream(self, reader, with_type_info=False):
+        """
+        _decode_object_at() for the object at the position of reader.
+
+        This is a loop of its own, as the stream is only read forward: a
+        reference can only point to an object that was read completely
+        before, which is taken from the registry instead of being decoded
+        again.
+        """
+        dict_type = self._dict_type
+        decoders = _SCALAR_DECODERS
+        read = reader.read
+        # scalars are decoded from a buffer holding just the object
+        scalars = self._spawn(b'')
+        # address -> (type, value, with_type_info) of every decoded object
+        registry = {}
+        # like in _decode_object_at(), plus the start address of the array/dict
+        stack = []
+        push, pop = stack.append, stack.pop
+        kind, start, end, container, ctyped, key = 0, 0, -1, None, with_type_info, _MISSING
+        typed = with_type_info
+        try:
+            while True:
+                addr = reader.pos
+                token = read(1)[0]
+                tokenH = token & 0xF0
+
+                if tokenH == 0x80:  # Referenced Object
+                    size, _ = self._read_stream_size(reader, token)
+                    address = int.from_bytes(read(size), 'little')
+                    entry = registry.get(address)
+                    if entry is None:
+                        raise InvalidFileException("reference at: %s to %s, which is not the start of an object read before"
+                                                   % (addr, address))
+                    result_type, result_value, entry_typed = entry
+                    if entry_typed != typed and (result_type == 'array' or result_type == 'dict'
+                                                 or result_type == 'data.bplist17'):
+                        raise InvalidFileException("reference at: %s to %s, which was read %s type info before"
+                                                   % (addr, address, 'with' if entry_typed else 'without'))
+                    result = self._with_type_info(result_type, result_value) if typed else result_value
+
+                elif tokenH == 0xA0 or tokenH == 0xD0:  # array, dict
+                    endAddress = int.from_bytes(read(0x8), 'little')
+                    push((kind, start, end, container, ctyped, key))
+                    kind, start, end, ctyped, key = tokenH, addr, endAddress, typed, _MISSING
+                    container = [] if tokenH == 0xA0 else dict_type()
+                    result = _MISSING
+
+                elif tokenH == 0x10:  # int, fast path
+                    result = int.from_bytes(read(token & 0x0F), 'little', signed=True)
+                    registry[addr] = ('int', result, typed)
+                    if typed:
+                        result = self._with_type_info('int', result)
+
+                elif token == 0x22 or token == 0x23:  # float, double, fast path
+                    result_type = 'float' if token == 0x22 else 'double'
+                    result = struct.unpack('<f' if token == 0x22 else '<d', read(4 if token == 0x22 else 8))[0]
+                    registry[addr] = (result_type, result, typed)
+                    if typed:
+                        result = self._with_type_info(result_type, result)
+
+                elif tokenH == 0x70 and token != 0x7F:  # short ascii string, fast path
+                    result = str(read(token & 0x0F), 'ascii').rstrip('\x00')
+                    registry[addr] = ('string_ascii', result, typed)
+                    if typed:
+                        result = self._with_type_info('string_ascii', result)
+
+                else:
+                    decoder = decoders[token]
+                    if decoder is None:
+                        raise TypeError("unsupported type: %02x at: %s" % (token, addr))
+                    # read the whole object, then decode it as if it were at address 0
+                    if tokenH == 0x40 or tokenH == 0x60 or tokenH == 0x70:
+                        size, header = self._read_stream_size(reader, token)
+                        data = header + read(size * 2 if tokenH == 0x60 else size)
+                    else:
+                        data = bytes((token,)) + read(_STREAM_SCALAR_SIZES[token])
+                    scalars._buf = memoryview(data)
+                    result_type, result_value, _ = decoder(scalars, 0, typed)
+                    if result_type == 'data.reference':
+                        result_value = DataReference(addr + result_value.offset, result_value.length)
+                    registry[addr] = (result_type, result_value, typed)
+                    result = self._with_type_info(result_type, result_value) if typed else result_value
+
+                while True:
+                    pos = reader.pos
+                    if result is not _MISSING:
+                        # hand the completed object to its parent
+                        if kind == 0xA0:
+                            container.append(result)
+                        elif kind == 0xD0:
+                            if key is _MISSING:
+                                key = result
+                            else:
+                                container[key] = result
+                                key = _MISSING
+                        else:
+                            return result
+                        result = _MISSING
+
+                    # read the next child of the innermost container or close it
+                    if pos <= end:
+                        typed = ctyped and (kind == 0xA0 or key is not _MISSING)
+                        break
+                    if pos != (end + 1):
+                        raise _end_address_error(kind, start, end, pos)
+                    if kind == 0xA0:
+                        result_type, result_value = 'array', container
+                    else:
+                        result_type = 'dict'
+                        result_value = self._transformDictionary(container, with_type_info=ctyped)
+                    registry[start] = (result_type, result_value, ctyped)
+                    result = self._with_type_info(result_type, result_value) if ctyped else result_value
+                    kind, start, end, container, ctyped, key = pop()
+
+        except TypeError:
+            # like unhashable keys, unsupported types inside of a dict make the file invalid
+            if kind == 0xD0 or any(frame[0] == 0xD0 for frame in stack):
+                raise InvalidFileException()
+            raise
+
+    def _read_stream_size(self, reader, token):
+        """_decode_dynamic_size() for the token just read from reader, returns (size, header bytes)"""
+        if (token & 0x0F) != 0xF:
+            return token & 0x0F, bytes((token,))
+        token2 = reader.read(1)[0]
+        length = token2 & 0xF
+        if length != 0 and ((token2 & 0xF0) == 0x10):
+            size_bytes = reader.read(length)
+            return int.from_bytes(size_bytes, 'little'), bytes((token, token2)) + size_bytes
+        raise TypeError("unsupported type: %02x%02x" % (token, token2))
+
+    def build_index(self, source):
+        """
+        Scan the document once and return its Plist17Index, without decoding
+        any object. source is a file object or anything parse_buffer()
+        accepts. Documents nested in data objects are not indexed.
+        """
+        mtime_ns = 0
+        if isinstance(source, (str, os.PathLike)):
+            mtime_ns = os.stat(source).st_mtime_ns
+        buf = mapped = None
+        try:
+            buf, mapped = _open_buffer(source)
+            self._buf = buf
+            index = self._scan_at(0x8)
+
+        except InvalidFileException:
+            raise
+        except (OSError, IndexError, struct.error, OverflowError,
+                ValueError, TypeError):
+            raise InvalidFileException()
+        finally:
+            self._buf = None
+            _close_buffer(buf, mapped)
+        index.mtime_ns = mtime_ns
+        return index
+
+    def _scan_at(self, addr):
+        buf = self._buf
+        size_buf = len(buf)
+        unsigned, signed = ('I', 'i') if size_buf < (1 << 31) else ('Q', 'q')
+        offsets, ends, parents = array.array(unsigned), array.array(unsigned), array.array(signed)
+        tokens = bytearray()
+        skip = self._skip_object_at
+        # the innermost open array/dict is parent (with the address behind
+        # it in parent_end), the outer ones are pushed to the stack
+        stack = []
+        parent, parent_end = -1, size_buf
+        pos = addr
+        while True:
+            token = buf[pos]
+            ordinal = len(tokens)
+            offsets.append(pos)
+            tokens.append(token)
+            parents.append(parent)
+            if (token & 0xF0) == 0xA0 or (token & 0xF0) == 0xD0:
+                end = int.from_bytes(self._slice(pos + 1, 0x8), 'little') + 1
+                if end > size_buf:
+                    raise InvalidFileException("token %02x at: %s has end address %s beyond the end of the file"
+                                               % (token, pos, end - 1))
+                ends.append(end)
+                stack.append((parent, parent_end))
+                parent, parent_end = ordinal, end
+                pos += 9
+            else:
+                pos = skip(pos)
+                ends.append(pos)
+
+            while parent != -1 and pos >= parent_end:
+                if pos != parent_end:
+                    raise _end_address_error(tokens[parent], offsets[parent], parent_end - 1, pos)
+                parent, parent_end = stack.pop()
+            if parent == -1:
+                return Plist17Index(offsets, tokens, ends, parents, size_buf)
+
+    def extract_ordinal(self, source, index, ordinal, with_type_info=False):
+        """
+        Return the object with ordinal in index (see Plist17Index), without
+        decoding the rest of the document. The ordinal of a reference yields
+        the referenced object.
+        """
+        addr = index.offsets[ordinal]
+        if self._reference_cache is not None:
+            self._reference_cache.clear()
+        buf = mapped = None
+        try:
+            buf, mapped = _open_buffer(source)
+            self._buf = buf
+            if index.size != len(buf):
+                error = ValueError("the index does not belong to this document")
+            else:
+                return self._decode_object_at(addr, with_type_info=with_type_info)[0]
+
+        except InvalidFileException:
+            raise
+        except (OSError, IndexError, struct.error, OverflowError,
+                ValueError):
+            raise InvalidFileException()
+        finally:
+            self._buf = None
+            _close_buffer(buf, mapped)
+        raise error
+
+    def _find_path_indexed(self, index, ordinal, path, with_type_info=False):
+        """
+        _find_path() with a Plist17Index, returns (ordinal, None) of the
+        object at path, starting at the object with ordinal, or (None, exception).
+        """
+        offsets, tokens = index.offsets, index.tokens
+        for component in path:
+            if (tokens[ordinal] & 0xF0) == 0x80:
+                ordinal = index.ordinal_at(self._resolve_reference_at(offsets[ordinal]))
+            tokenH = tokens[ordinal] & 0xF0
+            children = index.children_of(ordinal)
+
+            if tokenH == 0xA0:  # array
+                if isinstance(component, str) and component.lstrip('-').isdigit():
+                    component = int(component)
+                if not isinstance(component, int) or isinstance(component, bool):
+                    return None, TypeError("array indices must be integers, not %s" % type(component).__name__)
+                try:
+                    ordinal = children[component]
+                except IndexError:
+                    return None, IndexError("array index %i out of range" % component)
+
+            elif tokenH == 0xD0:  # dict
+                found = {}
+                try:
+                    for i in range(0, len(children) - 1, 2):
+                        key = self._decode_key_at(offsets[children[i]])[0]
+                        if key == component or (not with_type_info and key in ("$class", "NS.keys", "NS.objects")):
+                            found[key] = children[i + 1]
+                except TypeError:
+                    raise InvalidFileException()
+
+                if not with_type_info:
+                    # apply _transformDictionary() to the looked up key
+                    class_value = self._decode_object_at(offsets[found["$class"]])[0]
+                    if (class_value == "NSDictionary" or class_value == "NSMutableDictionary") and component != "$class":
+                        keys = self._decode_object_at(offsets[found["NS.keys"]])[0]
+                        position = None
+                        for i in range(len(keys)):
+                            if keys[i] == component:
+                                position = i
+                        if position is None:
+                            return None, KeyError(component)
+                        found[component], error = self._find_path_indexed(index, found["NS.objects"], [position])
+                        if error is not None:
+                            raise InvalidFileException()
+                if component not in found:
+                    return None, KeyError(component)
+                ordinal = found[component]
+
+            else:
+                return None, TypeError("cannot look up %r in a scalar object at: %s" % (component, offsets[ordinal]))
+
+        return ordinal, None
+
+    def diff(self, old, new, with_type_info=False):
+        """
+        Compare the documents old and new and return their differences as a
+        list of Difference(path, kind, old, new), in document order.
+
+        old and new are file objects or anything parse_buffer() accepts.
+        path is a list of dict keys and array indices like the ones
+        extract() takes, kind is 'changed', 'added' or 'removed', and old
+        and new are the decoded values (None on the missing side). Arrays
+        are compared by index and dicts by key, documents nested in data
+        objects like the rest of the document.
+
+        Both documents are scanned once to compute a digest of every array
+        and dict (see _container_digests()). Subtrees with equal digests are
+        skipped without decoding them, so only the parts that differ are
+        decoded and no tree is built. Shared objects compare equal to copies
+        of them. The scan costs about as much as parsing both documents, so
+        this is not faster than parsing and comparing them, except for
+        equal nested bplist17 documents, which are skipped as a whole.
+        """
+        old_buf = old_mapped = new_buf = new_mapped = None
+        try:
+            old_buf, old_mapped = _open_buffer(old)
+            new_buf, new_mapped = _open_buffer(new)
+            differences = []
+            if not _same_bytes(old_buf, new_buf):
+                self._spawn(old_buf)._diff_at(self._spawn(new_buf), 0x8, 0x8, with_type_info, differences)
+            return differences
+
+        except InvalidFileException:
+            raise
+        except (OSError, IndexError, struct.error, OverflowError,
+                ValueError, TypeError):
+            raise InvalidFileException()
+        finally:
+            _close_buffer(old_buf, old_mapped)
+            _close_buffer(new_buf, new_mapped)
+
+    def _diff_at(self, other, addr, other_addr, with_type_info, differences):
+        """
+        append the differences between the object at addr and the object at
+        other_addr in the buffer of the parser other to differences.
+        """
+        # work items are (old parser, digests, address, new parser, digests,
+        # address, path), the address is None on the side a value is missing
+        work = [(self, self._container_digests(addr), addr,
+                 other, other._container_digests(other_addr), other_addr, [])]
+        while work:
+            old, old_digests, a, new, new_digests, b, path = work.pop()
+            if a is None:
+                differences.append(Difference(path, 'added', None, new._decode_object_at(b, with_type_info)[0]))
+                continue
+            if b is None:
+                differences.append(Difference(path, 'removed', old._decode_object_at(a, with_type_info)[0], None))
+                continue
+
+            old_buf, new_buf = old._buf, new._buf
+            a, b = old._resolve_reference_at(a), new._resolve_reference_at(b)
+            tokenH, new_tokenH = old_buf[a] & 0xF0, new_buf[b] & 0xF0
+            old_scalar = tokenH != 0xA0 and tokenH != 0xD0
+            new_scalar = new_tokenH != 0xA0 and new_tokenH != 0xD0
+
+            if tokenH == new_tokenH and not old_scalar:
+                digest = old_digests.get(a)
+                if digest is not None and digest == new_digests.get(b):
+                    continue
+                old_summaries, old_offsets = old._children_at(a, old_digests)
+                new_summaries, new_offsets = new._children_at(b, new_digests)
+                if tokenH == 0xA0:
+                    old_count, new_count = len(old_offsets), len(new_offsets)
+                    items = [(index, old_offsets[index], new_offsets[index])
+                             for index in compress(count(), map(operator.ne, old_summaries, new_summaries))]
+                    items += [(index, old_offsets[index] if index < old_count else None,
+                               new_offsets[index] if index < new_count else None)
+                              for index in range(min(old_count, new_count), max(old_count, new_count))]
+                elif with_type_info or not (old._is_flattened(old_summaries, old_offsets)
+                                            or new._is_flattened(new_summaries, new_offsets)):
+                    items = old._diff_items(new, old_summaries, old_offsets, new_summaries, new_offsets)
+                else:
+                    # compare NSDictionaries the way parse() returns them
+                    old_items = old._dict_items_at(a, int.from_bytes(old._slice(a + 1, 0x8), 'little'))
+                    new_items = new._dict_items_at(b, int.from_bytes(new._slice(b + 1, 0x8), 'little'))
+                    items = [(key, pos, new_items.get(key)) for key, pos in old_items.items()]
+                    items += [(key, None, pos) for key, pos in new_items.items() if key not in old_items]
+                for key, pos, new_pos in reversed(items):
+                    work.append((old, old_digests, pos, new, new_digests, new_pos, path + [key]))
+                continue
+
+            if old_scalar and new_scalar:
+                if _same_bytes(old_buf[a:old._skip_object_at(a)], new_buf[b:new._skip_object_at(b)]):
+                    continue
+                old_nested, new_nested = old._nested_parser_at(a), new._nested_parser_at(b)
+                if old_nested is not None and new_nested is not None:
+                    # compare nested documents like the rest, not as one value
+                    work.append((old_nested, old_nested._container_digests(0x8), 0x8,
+                                 new_nested, new_nested._container_digests(0x8), 0x8, path))
+                    continue
+
+            old_value = old._decode_object_at(a, with_type_info)[0]
+            new_value = new._decode_object_at(b, with_type_info)[0]
+            if old_scalar and new_scalar and old_value == new_value \
+                    and (with_type_info or type(old_value) is type(new_value)):
+                # e.g. ints of different sizes, or a float and a double without type info
+                continue
+            differences.append(Difference(path, 'changed', old_value, new_value))
+
+    def _diff_items(self, other, summaries, offsets, other_summaries, other_offsets):
+        """
+        return (key, address, other address) of the entries which differ
+        between two dicts, given their _children_at() in this and the other
+        parser. Keys are matched by their bytes and only decoded if their
+        entry differs.
+        """
+        keys, other_keys = summaries[0::2], other_summaries[0::2]
+        differing = {key for key, _ in dict(zip(keys, summaries[1::2])).items()
+                     ^ dict(zip(other_keys, other_summaries[1::2])).items()}
+        if not differing:
+            return []
+        key_offsets, values = dict(zip(keys, offsets[0::2])), dict(zip(keys, offsets[1::2]))
+        other_key_offsets, other_values = dict(zip(other_keys, other_offsets[0::2])), dict(zip(other_keys, other_offsets[1::2]))
+
+        # keys which are encoded differently are matched by their value
+        added = {}
+        for key in dict.fromkeys(key for key in other_keys if key in differing):
+            if key not in values:
+                added[other._decode_key_at(other_key_offsets[key])[0]] = other_values[key]
+        items = []
+        for key in dict.fromkeys(key for key in keys if key in differing):
+            name = self._decode_key_at(key_offsets[key])[0]
+            if key in other_values:
+                items.append((name, values[key], other_values[key]))
+            else:
+                items.append((name, values[key], added.pop(name, None)))
+        items += [(name, None, pos) for name, pos in added.items()]
+        return items
+
+    def _is_flattened(self, summaries, offsets):
+        """whether the dict with these _children_at() is one _transformDictionary() flattens"""
+        keys = summaries[0::2]
+        for key in (b'\x77$class\x00', b'\x76$class'):  # as written by _BinaryPlist17Writer, or unterminated
+            if key in keys:
+                value = self._decode_key_at(offsets[2 * keys.index(key) + 1])[0]
+                return value == "NSDictionary" or value == "NSMutableDictionary"
+        # an unusual encoding of the key, _dict_items_at() finds it
+        return True
+
+    def _children_at(self, addr, digests):
+        """
+        return (summaries, addresses) of the children of the array or dict at
+        addr, with the keys and values of a dict alternating.
+
+        The summary of a scalar is its bytes, that of an array or dict its
+        token and digest (see _container_digests()), references are replaced
+        by the summary of their target. Children are equal if their summaries
+        are, arrays and dicts without a digest are equal to nothing. Runs of
+        scalars are split by _DIFF_SCALARS.
+        """
+        buf = self._buf
+        end = int.from_bytes(self._slice(addr + 1, 0x8), 'little') + 1
+        match, split = _DIFF_TOKENS.match, _DIFF_SCALARS.findall
+        summaries, offsets = [], []
+        pos = addr + 9
+        while pos < end:
+            m = match(buf, pos, end)
+            kind = m.lastgroup
+            at = m.end() if kind == 's' else m.start(kind)
+            if at > pos:
+                scalars = split(buf, pos, at)
+                summaries += scalars
+                offsets += accumulate(map(len, scalars[:-1]), initial=pos)
+            if kind == 's':
+                if at != end:
+                    raise InvalidFileException()
+                return summaries, offsets
+
+            if kind == 'container':
+                summary = self._summary_at(at, digests)
+                pos = int.from_bytes(buf[at + 1:at + 9], 'little') + 1
+            elif kind == 'long' and buf[at] != 0x8F:
+                pos = self._skip_object_at(at)
+                summary = bytes(buf[at:pos])
+            else:
+                summary = self._summary_at(self._resolve_reference_at(at), digests)
+                pos = m.end() if kind == 'reference' else self._skip_object_at(at)
+            summaries.append(summary)
+            offsets.append(at)
+        if pos != end:
+            raise InvalidFileException()
+        return summaries, offsets
+
+    def _summary_at(self, addr, digests):
+        """the summary of the object at addr for _children_at()"""
+        buf = self._buf
+        tokenH = buf[addr] & 0xF0
+        if tokenH != 0xA0 and tokenH != 0xD0:
+            return bytes(buf[addr:self._skip_object_at(addr)])
+        digest = digests.get(addr)
+        return bytes((tokenH,)) + digest if digest is not None else object()
+
+    def _nested_parser_at(self, addr):
+        """return a parser for the bplist17 document in the data object at addr, or None"""
+        token = self._buf[addr]
+        if (token & 0xF0) != 0x40:
+            return None
+        size, pos = self._decode_dynamic_size(addr, addr + 1, token & 0x0F)
+        if self._data_threshold is not None and size > self._data_threshold:
+            return None
+        data = self._slice(pos, size)
+        if self._nested_type(data) != 'data.bplist17':
+            return None
+        parser = self._spawn(data)
+        parser._nested_level = self._nested_level + 1
+        return parser
+
+    def _container_digests(self, addr):
+        """
+        return a dict with the digest of every array and dict in the object
+        at addr (or behind a reference at addr), by address.
+
+        A digest covers the bytes of the array or dict, with the arrays and
+        dicts in it and the targets of its references replaced by their
+        summary (see _summary_at()). Equal content thus has equal digests at
+        any address, whether it is shared or not. Arrays and dicts with a
+        reference to one that is not complete yet (a forward reference) get
+        None.
+
+        _DIFF_TOKENS matches whole runs of scalars, so there is one Python
+        step per array, dict, reference and string or data object with a
+        size behind its token instead of one per object.
+        """
+        buf = self._buf
+        digests = {}
+        summaries = {}  # of the targets of references
+        addr = self._resolve_reference_at(addr)
+        tokenH = buf[addr] & 0xF0
+        if tokenH != 0xA0 and tokenH != 0xD0:
+            return digests
+        end = int.from_bytes(self._slice(addr + 1, 0x8), 'little') + 1
+        if end > len(buf) or end < addr + 9:
+            raise InvalidFileException()
+        match = _DIFF_TOKENS.match
+        blake2b = hashlib.blake2b
+        # The innermost open array/dict is kept in local variables, the outer
+        # ones are pushed to the stack:
+        #   hasher      hash of the bytes up to segment, None without digest
+        #   end         address behind the array/dict
+        #   token       b'\xa0' or b'\xd0'
+        #   start       address of the array/dict
+        stack = []
+        hasher, token, start = blake2b(digest_size=16), bytes((tokenH,)), addr
+        segment = pos = addr + 9
+        while True:
+            m = match(buf, pos)
+            kind = m.lastgroup
+            at = m.end() if kind == 's' else m.start(kind)
+
+            # close the arrays and dicts which end before the next token
+            while end <= at:
+                digest = None
+                if hasher is not None:
+                    hasher.update(buf[segment:end])
+                    digest = hasher.digest()
+                digests[start] = digest
+                segment = end
+                if not stack:
+                    return digests
+                summary = token + digest if hasher is not None else None
+                hasher, end, token, start = stack.pop()
+                if hasher is not None:
+                    # (a parent has no hasher if its child has none)
+                    hasher.update(summary)
+            if kind == 's':
+                # unsupported type or truncated document
+                raise InvalidFileException()
+
+            if kind == 'container':
+                if hasher is not None:
+                    hasher.update(buf[segment:at])
+                child_end = int.from_bytes(buf[at + 1:at + 9], 'little') + 1
+                if child_end > end or child_end < at + 9:
+                    raise InvalidFileException()
+                stack.append((hasher, end, token, start))
+                hasher, end, token, start = blake2b(digest_size=16), child_end, bytes((buf[at] & 0xF0,)), at
+                segment = pos = at + 9
+                continue
+            if kind == 'long' and buf[at] != 0x8F:
+                # the string or data object is hashed with the rest of the segment
+                pos = self._skip_object_at(at)
+                continue
+
+            if kind == 'reference':
+                pos = m.end()
+                target = int.from_bytes(buf[at + 1:pos], 'little')
+            else:
+                pos = self._skip_object_at(at)
+                target = self._resolve_reference_at(at)
+            if hasher is not None:
+                hasher.update(buf[segment:at])
+                summary = summaries.get(target)
+                if summary is None:
+                    summary = self._summary_at(self._resolve_reference_at(target), digests)
+                    if summary.__class__ is bytes:
+                        summaries[target] = summary
+                if summary.__class__ is bytes:
+                    hasher.update(summary)
+                else:
+                    # a forward reference, neither this nor the enclosing
+                    # arrays and dicts get a digest
+                    hasher = None
+                    for index in range(len(stack) - 1, -1, -1):
+                        if stack[index][0] is None:
+                            break
+                        stack[index] = (None,) + stack[index][1:]
+            segment = pos
+
+    def _parse_lazy(self, buffer, with_type_info=False):
+        try:
+            buf, mapped = _open_buffer(buffer)
+            # the proxies keep decoding after this call returned, so they get
+            # their own parser instead of sharing the state of this one
+            return self._spawn(buf)._decode_lazy_at(0x8, with_type_info=with_type_info)
+
+        except InvalidFileException:
+            raise
+        except (OSError, IndexError, struct.error, OverflowError,
+                ValueError):
+            raise InvalidFileException()
+
+    def _spawn(self, buf):
+        """return a parser with the same options that decodes from buf"""
+        # like copy.copy(self), without its overhead for every nested document
+        parser = object.__new__(type(self))
+        parser.__dict__.update(self.__dict__)
+        parser._buf = buf
+        if self._reference_cache is not None:
+            parser._reference_cache = _ReferenceCache(maxsize=self._reference_cache.maxsize,
+                                                      copy_hits=self._reference_cache.copy_hits)
+        return parser
+
+    def iter_events(self, source, with_type_info=False, follow_references=True):
+        """
+        Walk the document and yield parse events instead of building a tree.
+
+        source is a file object or anything parse_buffer() accepts. Events
+        are tuples, the first item names the event:
+
+            ('start_array', address)    ('end_array', address)
+            ('start_dict', address)     ('end_dict', address)
+            ('key', key)                the next event(s) describe its value
+            ('scalar', type, value)     type as in the typed output
+            ('reference', address)
+
+        If follow_references is set, a reference event is followed by the
+        events of the referenced object. Dicts are reported as they are
+        stored, i.e. NSDictionary objects are not flattened. with_type_info
+        only applies to nested bplist17 documents in data objects. Only the
+        open containers are kept track of, so memory use depends on the
+        nesting depth and not on the size of the document.
+        """
+        buf = mapped = None
+        try:
+            buf, mapped = _open_buffer(source)
+            yield from self._spawn(buf)._iter_events_at(0x8, with_type_info, follow_references)
+
+        except InvalidFileException:
+            raise
+        except (OSError, IndexError, struct.error, OverflowError,
+                ValueError):
+            raise InvalidFileException()
+        finally:
+            _close_buffer(buf, mapped)
+
+    def _iter_events_at(self, pos, with_type_info, follow_references):
+        buf = self._buf
+        # open arrays and dicts as [token, start address, end address], and
+        # followed references as [0x80, resume address, target address]
+        stack = []
+        following = set() # target addresses of the followed references
+        while True:
+            addr = pos
+            token = buf[addr]
+            tokenH = token & 0xF0
+
+            if tokenH == 0x80:
+                size, pos = self._decode_dynamic_size(addr, addr + 1, token & 0x0F)
+                address = int.from_bytes(buf[pos:pos + size], 'little')
+                pos += size
+                yield ('reference', address)
+                if follow_references:
+                    if address in following:
+                        raise InvalidFileException("reference at: %s to %s, which contains it" % (addr, address))
+                    following.add(address)
+                    stack.append([0x80, pos, address])
+                    pos = address
+                    continue
+
+            elif tokenH == 0xA0 or tokenH == 0xD0:
+                endAddress = int.from_bytes(self._slice(addr + 1, 0x8), 'little')
+                yield ('start_array' if tokenH == 0xA0 else 'start_dict', addr)
+                stack.append([tokenH, addr, endAddress])
+                pos = addr + 9
+
+            else:
+                result_type, result_value, pos = self._decode_scalar_at(addr, with_type_info=with_type_info)
+                yield ('scalar', result_type, result_value)
+
+            # the object at addr is complete (or a container was opened),
+            # close finished containers and find the next object to read
+            while stack:
+                frame = stack[-1]
+                if frame[0] == 0x80:
+                    stack.pop()
+                    following.remove(frame[2])
+                    pos = frame[1]
+                elif pos <= frame[2]:
+                    if frame[0] == 0xD0:
+                        try:
+                            key, pos = self._decode_object_at(pos, with_type_info=False)
+                        except TypeError:
+                            raise InvalidFileException()
+                        yield ('key', key)
+                    break
+                else:
+                    if pos != (frame[2] + 1):
+                        raise _end_address_error(frame[0], frame[1], frame[2], pos)
+                    stack.pop()
+                    yield ('end_array' if frame[0] == 0xA0 else 'end_dict', frame[1])
+            else:
+                return
+
+    def transcode(self, source, fp, with_type_info=False, indent=None, separators=None, default=None):
+        """
+        Write the document as JSON to the text file fp while walking it.
+
+        source is a file object or anything parse_buffer() accepts. The
+        output is the same as the one of json.dump(self.parse(source,
+        with_type_info), fp, indent=indent, separators=separators,
+        default=default), but no tree is built: only the open arrays and
+        dicts (with the value addresses of their keys) are kept in memory.
+        NSDictionary objects are flattened like by parse() and nested
+        bplist17 documents are transcoded in place. lazy_nested,
+        numpy_arrays and collect_stats do not apply.
+        """
+        if indent is not None and not isinstance(indent, str):
+            indent = ' ' * indent
+        if separators is None:
+            separators = (',', ': ') if indent is not None else (', ', ': ')
+
+        buf = mapped = None
+        out = []
+        try:
+            buf, mapped = _open_buffer(source)
+            parser = self._spawn(buf)
+            parser._lazy_nested = False
+            parser._transcode_at(0x8, fp, out, 0, with_type_info, (indent, separators[0], separators[1], default))
+            fp.write(''.join(out))
+
+        except InvalidFileException:
+            raise
+        except (OSError, IndexError, struct.error, OverflowError,
+                ValueError):
+            raise InvalidFileException()
+        finally:
+            _close_buffer(buf, mapped)
+
+    def _transcode_at(self, addr, fp, out, level, with_type_info, fmt):
+        """
+        append the JSON of the object at addr, indented for level, to out
+        and write out to fp whenever it grew large. fmt is a tuple of the
+        indent string (or None), item separator, key separator and default
+        function.
+        """
+        buf = self._buf
+        size_buf = len(buf)
+        decoders = _SCALAR_DECODERS
+        indent, item_sep, key_sep, default = fmt
+        write = out.append
+        # '\n' followed by the indent for each level, like the json module writes
+        newlines = []
+        def add_newlines(level):
+            while len(newlines) <= level:
+                newlines.append('' if indent is None else '\n' + indent * len(newlines))
+        add_newlines(level + 2)
+
+        # open arrays as [0xA0, next address, end address, level, with_type_info, empty, address],
+        # open dicts as [0xD0, iterator over (key, value address), level, with_type_info, empty, address]
+        # and typed nodes as [0, level]
+        stack = []
+        opened = set() # addresses of the open arrays and dicts
+        pos, typed = addr, with_type_info
+        while True:
+            # read the object at pos
+            parent = stack[-1] if stack and stack[-1][0] == 0xA0 else None
+            try:
+                token = buf[pos]
+                after = None # address behind a reference to the object
+                if (token & 0xF0) == 0x80:
+                    size, after = self._decode_dynamic_size(pos, pos + 1, token & 0x0F)
+                    pos = int.from_bytes(buf[after:after + size], 'little')
+                    after += size
+                    if (buf[pos] & 0xF0) == 0x80:
+                        pos = self._resolve_reference_at(pos)
+                    token = buf[pos]
+                tokenH = token & 0xF0
+                text = nested_type = None
+
+                if tokenH == 0xA0 or tokenH == 0xD0:
+                    if pos in opened:
+                        raise InvalidFileException("token %02x at: %s contains itself, through a reference" % (token, pos))
+                    end = int.from_bytes(self._slice(pos + 1, 0x8), 'little')
+                    if end >= size_buf:
+                        raise InvalidFileException("token %02x at: %s has end address %s beyond the end of the file"
+                                                   % (token, pos, end))
+                    next_pos = end + 1
+                    result_type = 'array' if tokenH == 0xA0 else 'dict'
+                    if tokenH == 0xD0:
+                        items = self._dict_items_at(pos, end, typed)
+
+                elif tokenH == 0x10:  # int, fast path of _decode_scalar_at()
+                    next_pos = pos + 1 + (token & 0x0F)
+                    result_type = 'int'
+                    text = int.__repr__(int.from_bytes(buf[pos + 1:next_pos], 'little', signed=True))
+
+                elif tokenH == 0x70 and token != 0x7F:  # short ascii string, fast path of _decode_scalar_at()
+                    next_pos = pos + 1 + (token & 0x0F)
+                    data = buf[pos + 1:next_pos]
+                    if len(data) != (token & 0x0F):
+                        raise InvalidFileException()
+                    result_type = 'string_ascii'
+                    text = _json_string(str(data, 'ascii').rstrip('\x00'))
+
+                else:
+                    if tokenH == 0x40:
+                        size, start = self._decode_dynamic_size(pos, pos + 1, token & 0x0F)
+                        if self._data_threshold is None or size <= self._data_threshold:
+                            nested_type = self._nested_type(self._slice(start, size))
+                    if nested_type == 'data.bplist17':
+                        result_type, next_pos = nested_type, start + size
+                    else:
+                        decoder = decoders[token]
+                        if decoder is None:
+                            raise TypeError("unsupported type: %02x at: %s" % (token, pos))
+                        result_type, result_value, next_pos = decoder(self, pos, typed)
+
+            except TypeError:
+                # like unhashable keys, unsupported types inside of a dict make the file invalid
+                if any(frame[0] == 0xD0 for frame in stack):
+                    raise InvalidFileException()
+                raise
+            if parent is not None:
+                parent[1] = next_pos if after is None else after
+
+            # write it
+            if typed:
+                write('{' + newlines[level + 1] + '"type"' + key_sep + _json_string(result_type)
+                      + item_sep + newlines[level + 1] + '"value"' + key_sep)
+            if tokenH == 0xA0 or tokenH == 0xD0:
+                if typed:
+                    stack.append([0, level])
+                    level += 1
+                add_newlines(level + 3)
+                opened.add(pos)
+                if tokenH == 0xA0:
+                    stack.append([0xA0, pos + 9, end, level, typed, True, pos])
+                else:
+                    stack.append([0xD0, iter(items.items()), level, typed, True, pos])
+
+            else:
+                if text is not None:
+                    write(text)
+                elif nested_type == 'data.bplist17':
+                    parser = self._spawn(self._slice(start, size))
+                    parser._nested_level = self._nested_level + 1
+                    try:
+                        parser._transcode_at(0x8, fp, out, level + 1 if typed else level, typed, fmt)
+                    except TypeError:
+                        if any(frame[0] == 0xD0 for frame in stack):
+                            raise InvalidFileException()
+                        raise
+                else:
+                    write(_json_scalar(result_value, fmt, newlines[level + 1 if typed else level]))
+                if typed:
+                    write(newlines[level] + '}')
+                if len(out) > 0x1000:
+                    fp.write(''.join(out))
+                    out.clear()
+
+            # the object is complete (or a container was opened), close
+            # finished containers and find the next object to write
+            while stack:
+                frame = stack[-1]
+                if frame[0] == 0xA0:
+                    pos = frame[1]
+                    if pos <= frame[2]:
+                        level, typed = frame[3] + 1, frame[4]
+                        write(('[' if frame[5] else item_sep) + newlines[level])
+                        frame[5] = False
+                        break
+                    if pos != (frame[2] + 1):
+                        raise _end_address_error(0xA0, frame[6], frame[2], pos)
+                    write('[]' if frame[5] else newlines[frame[3]] + ']')
+                    opened.remove(frame[6])
+                elif frame[0] == 0xD0:
+                    item = next(frame[1], None)
+                    if item is not None:
+                        key, pos = item
+                        level, typed = frame[2] + 1, frame[3]
+                        write(('{' if frame[4] else item_sep) + newlines[level] + _json_string(key if type(key) is str else _json_key(key)) + key_sep)
+                        frame[4] = False
+                        break
+                    write('{}' if frame[4] else newlines[frame[2]] + '}')
+                    opened.remove(frame[5])
+                else:
+                    write(newlines[frame[1]] + '}')
+                stack.pop()
+            else:
+                return
+
+    def _dict_items_at(self, addr, end, with_type_info=False):
+        """
+        return a dict of the keys of the dict at addr and the addresses of
+        their values, flattened like _transformDictionary() does.
+        """
+        buf = self._buf
+        items = {}
+        try:
+            pos = addr + 9
+            while pos <= end:
+                key, pos = self._decode_key_at(pos)
+                items[key] = pos
+                pos = self._skip_object_at(pos)
+            if pos != (end + 1):
+                raise _end_address_error(buf[addr], addr, end, pos)
+            if with_type_info:
+                return items
+
+            class_value = self._decode_key_at(items["$class"])[0]
+            if class_value == "NSDictionary" or class_value == "NSMutableDictionary":
+                transformed_items = {"$class": items["$class"]}
+                keys = self._decode_object_at(items["NS.keys"])[0]
+                objects = self._array_offsets_at(items["NS.objects"])
+                for index in range(len(keys)):
+                    transformed_items[keys[index]] = objects[index]
+                return transformed_items
+            return items
+        except TypeError:
+            # unhashable keys and unsupported types make the file invalid
+            raise InvalidFileException()
+
+    def _decode_key_at(self, addr):
+        """_decode_object_at() without type info, with a fast path for (references to) short ascii strings"""
+        buf = self._buf
+        target = addr
+        token = buf[addr]
+        if (token & 0xF0) == 0x80:
+            size, pos = self._decode_dynamic_size(addr, addr + 1, token & 0x0F)
+            target = int.from_bytes(buf[pos:pos + size], 'little')
+            token = buf[target]
+        if (token & 0xF0) != 0x70 or token == 0x7F:
+            return self._decode_object_at(addr, with_type_info=False)
+        key = str(self._slice(target + 1, token & 0x0F), 'ascii').rstrip('\x00')
+        return key, (addr + 1 + (token & 0x0F) if target == addr else pos + size)
+
+    def _array_offsets_at(self, addr):
+        """return the addresses of the elements of the array at addr (or behind a reference at addr)"""
+        addr = self._resolve_reference_at(addr)
+        if self._buf[addr] & 0xF0 != 0xA0:
+            raise InvalidFileException()
+        end = int.from_bytes(self._slice(addr + 1, 0x8), 'little')
+        offsets = []
+        pos = addr + 9
+        while pos <= end:
+            offsets.append(pos)
+            pos = self._skip_object_at(pos)
+        return offsets
+
+    def _decode_object_at(self, addr, with_type_info=False, observer=None):
+        """
+        read the object at addr from the buffer set by parse_buffer().
+
+        Returns a tuple of the object and the address directly behind it.
+        Arrays, dicts and references are decoded with an explicit stack
+        instead of recursion, so the nesting depth of a document is not
+        bounded by the recursion limit.
+
+        With an observer (see _StatsObserver and _SourceObserver), the fast
+        paths are skipped: the observer is told about every reference and
+        array/dict that is read, decodes the scalars and completes the
+        arrays and dicts.
+        """
+        buf = self._buf
+        size_buf = len(buf)
+        decoders = _SCALAR_DECODERS
+        fast = observer is None
+        if fast:
+            cache, numpy_arrays = self._reference_cache, self._numpy_arrays
+            list_type, dict_type = list, self._dict_type
+            bulk, int_token, ascii_token = _BULK_FORMATS, 0x10, 0x70
+        else:
+            cache, numpy_arrays = observer.cache, observer.numpy_arrays
+            list_type, dict_type = observer.list_type, observer.dict_type
+            # no fast paths, the observer decodes every scalar
+            bulk, int_token, ascii_token = _NO_BULK_FORMATS, -1, -1
+        # unbound, the containers of an observer may track modifications
+        append, setitem = list.append, self._dict_type.__setitem__
+        # The innermost open array/dict or followed reference is kept in
+        # local variables, the outer ones are pushed to the stack:
+        #   kind        0xA0/0xD0 for an array/dict, 0x80 for a reference, 0 on top level
+        #   end         end address of the array/dict, resume address after a reference
+        #   container   list/dict under construction, address of a reference
+        #   ctyped      with_type_info of the array/dict/reference
+        #   key         pending dict key
+        #   start       address of the array/dict
+        stack = []
+        push, pop = stack.append, stack.pop
+        kind, end, container, ctyped, key, start = 0, -1, None, with_type_info, _MISSING, addr
+        following = set() # target addresses of the references on the stack
+        pos = addr
+        typed = with_type_info # with_type_info for the object at pos, dict keys are read without
+        try:
+            while True:
+                token = buf[pos]
+                tokenH = token & 0xF0
+
+                if tokenH == 0x80:  # Referenced Object
+                    reference = pos
+                    if token != 0x8F:
+                        size, pos = token & 0x0F, pos + 1
+                    else:
+                        size, pos = self._decode_dynamic_size(pos, pos + 1, 0x0F)
+                    address = int.from_bytes(buf[pos:pos + size], 'little')
+                    pos += size
+                    if not fast:
+                        observer.reference(reference, pos, address, following)
+                    result = _MISSING
+                    if cache is not None:
+                        result = cache.get((address, typed))
+                    if result is _MISSING:
+                        target = buf[address]
+                        targetH = target & 0xF0
+                        if targetH == 0x80 or targetH == 0xA0 or targetH == 0xD0:
+                            if address in following:
+                                raise InvalidFileException("reference at: %s to %s, which contains it"
+                                                           % (reference, address))
+                            following.add(address)
+                            push((kind, end, container, ctyped, key, start))
+                            kind, end, container, ctyped, key = 0x80, pos, address, typed, _MISSING
+                            pos = address
+                            continue
+                        # scalars can be decoded right away
+                        if targetH == ascii_token and target != 0x7F:  # short ascii string, like below
+                            tokenL = target & 0x0F
+                            data = buf[address + 1:address + 1 + tokenL]
+                            if len(data) != tokenL:
+                                raise InvalidFileException("token %02x at: %s runs past the end of the file"
+                                                           % (target, address))
+                            result = str(data, 'ascii').rstrip('\x00')
+                            if typed:
+                                result = self._with_type_info('string_ascii', result)
+                        elif fast:
+                            result_type, result_value, _ = self._decode_scalar_at(address, with_type_info=typed)
+                            result = self._with_type_info(result_type, result_value) if typed else result_value
+                        else:
+                            result = observer.scalar(address, typed)[0]
+                        if cache is not None:
+                            cache.put((address, typed), result)
+                    # the referenced object already combines (type, value) if with_type_info == True
+
+                elif tokenH == 0xA0 or tokenH == 0xD0:  # array, dict
+                    endAddress = int.from_bytes(buf[pos + 1:pos + 9], 'little')
+                    if endAddress >= size_buf:
+                        raise InvalidFileException("token %02x at: %s has end address %s beyond the end of the file"
+                                                   % (token, pos, endAddress))
+                    result = _MISSING
+                    if numpy_arrays and tokenH == 0xA0:
+                        result = self._decode_ndarray_at(pos, endAddress) if fast else observer.ndarray(pos, endAddress)
+                    if result is _MISSING:
+                        if not fast:
+                            observer.open(tokenH, pos, endAddress, following)
+                        push((kind, end, container, ctyped, key, start))
+                        kind, end, ctyped, key, start = tokenH, endAddress, typed, _MISSING, pos
+                        container = list_type() if tokenH == 0xA0 else dict_type()
+                        pos += 9
+                    else:
+                        pos = endAddress + 1
+                        if typed:
+                            result = self._with_type_info('array', result)
+
+                elif kind == 0xA0 and bulk[token] is not None and pos + bulk[token][0].size <= end \
+                        and buf[pos + bulk[token][0].size] == token:
+                    # at least two numbers of the same type and width in a row
+                    values, pos = self._decode_run_at(pos, end, typed)
+                    container.extend(values)
+                    result = _MISSING
+
+                elif tokenH == int_token:  # int, fast path of _decode_scalar_at()
+                    tokenL = token & 0x0F
+                    result = int.from_bytes(buf[pos + 1:pos + 1 + tokenL], 'little', signed=True)
+                    pos += 1 + tokenL
+                    if typed:
+                        result = self._with_type_info('int', result)
+
+                elif tokenH == ascii_token and token != 0x7F:  # short ascii string, fast path of _decode_scalar_at()
+                    tokenL = token & 0x0F
+                    data = buf[pos + 1:pos + 1 + tokenL]
+                    if len(data) != tokenL:
+                        raise InvalidFileException("token %02x at: %s runs past the end of the file" % (token, pos))
+                    result = str(data, 'ascii').rstrip('\x00')
+                    pos += 1 + tokenL
+                    if typed:
+                        result = self._with_type_info('string_ascii', result)
+
+                elif fast:
+                    decoder = decoders[token]
+                    if decoder is None:
+                        raise TypeError("unsupported type: %02x at: %s" % (token, pos))
+                    result_type, result_value, pos = decoder(self, pos, typed)
+                    result = self._with_type_info(result_type, result_value) if typed else result_value
+
+                else:
+                    result, pos = observer.scalar(pos, typed)
+
+                while True:
+                    if result is not _MISSING:
+                        # hand the completed object to its parent
+                        if kind == 0xA0:
+                            if fast:
+                                container.append(result)
+                            else:
+                                append(container, result)
+                        elif kind == 0xD0:
+                            if key is _MISSING:
+                                key = result
+                            elif fast:
+                                container[key] = result
+                                key = _MISSING
+                            else:
+                                setitem(container, key, result)
+                                key = _MISSING
+                        elif kind == 0x80:
+                            if cache is not None:
+                                cache.put((container, ctyped), result)
+                            pos = end
+                            following.remove(container)
+                            kind, end, container, ctyped, key, start = pop()
+                            continue
+                        else:
+                            return result, pos
+                        result = _MISSING
+
+                    # read the next child of the innermost container or close it
+                    if pos <= end:
+                        typed = ctyped and (kind == 0xA0 or key is not _MISSING)
+                        break
+                    if pos != (end + 1):
+                        raise _end_address_error(kind, start, end, pos)
+                    if not fast:
+                        result = observer.close(kind, start, pos, container, ctyped)
+                    elif kind == 0xA0:
+                        result = self._with_type_info('array', container) if ctyped else container
+                    else:
+                        result_value = self._transformDictionary(container, with_type_info=ctyped)
+                        result = self._with_type_info('dict', result_value) if ctyped else result_value
+                    kind, end, container, ctyped, key, start = pop()
+
+        except TypeError:
+            # like unhashable keys, unsupported types inside of a dict make the file invalid
+            if kind == 0xD0 or any(frame[0] == 0xD0 for frame in stack):
+                raise InvalidFileException()
+            raise
+
+    def _decode_source_at(self, addr, with_type_info=False):
+        """
+        _decode_object_at() for parsers with preserve_layout. Arrays, dicts
+        and typed nodes are decoded as _SourceNode objects, see
+        _SourceObserver.
+        """
+        return self._decode_object_at(addr, with_type_info=with_type_info, observer=_SourceObserver(self, addr))
+
+    def _with_source_type_info(self, result_type, result_value, source):
+        """_with_type_info() for _decode_source_at(), the node gets source as _source"""
+        if self._node_factory is not None:
+            result = _SourceTypedNode(result_type, result_value, source)
+        else:
+            dict_type = self._dict_type
+            result = _source_type(dict_type)()
+            dict_type.__setitem__(result, 'type', result_type)
+            dict_type.__setitem__(result, 'value', result_value)
+            result._source = source
+            result._parent = None
+        if isinstance(result_value, _SourceNode):
+            result_value._parent = result
+        return result
+
+    def _decode_object_at_with_stats(self, addr, with_type_info=False):
+        """_decode_object_at() for parsers with collect_stats set, see _StatsObserver"""
+        return self._decode_object_at(addr, with_type_info=with_type_info, observer=_StatsObserver(self))
+
+    def _decode_run_at(self, pos, end, with_type_info=False):
+        """
+        decode the run of objects with the same token as the one at pos, up
+        to the end address of their array, in a single struct call.
+
+        The token has to have an entry in _BULK_FORMATS. Returns a tuple of
+        the list of values and the address directly behind the run.
+        """
+        buf = self._buf
+        fmt, result_type = _BULK_FORMATS[buf[pos]]
+        stride = fmt.size
+        token = bytes(buf[pos:pos + 1])
+        # tokens of a run are stride bytes apart, compare them in growing windows
+        limit = (end + 1 - pos) // stride
+        count = 0
+        window = 8
+        while count < limit:
+            n = min(window, limit - count)
+            start = pos + count * stride
+            tokens = bytes(buf[start:start + n * stride:stride])
+            run = n - len(tokens.lstrip(token))
+            count += run
+            if run < n:
+                break
+            window *= 2
+        if with_type_info:
+            wrap = self._with_type_info
+            values = [wrap(result_type, value) for value, in fmt.iter_unpack(buf[pos:pos + count * stride])]
+        else:
+            values = [value for value, in fmt.iter_unpack(buf[pos:pos + count * stride])]
+        return values, pos + count * stride
+
+    def _decode_ndarray_at(self, addr, endAddress):
+        """
+        return the array at addr as numpy array if it only contains numbers
+        of one type (see numpy_arrays), otherwise _MISSING.
+        """
+        buf = self._buf
+        start = addr + 9
+        if start > endAddress:
+            return _MISSING
+        token = buf[start]
+        entry = _NUMPY_FORMATS[token]
+        if entry is not None:
+            element_dtype, result_dtype = entry
+            size = endAddress + 1 - start
+            if size % element_dtype.itemsize == 0:
+                # all elements of the same width, read token and value columns at once
+                elements = numpy.frombuffer(buf, dtype=element_dtype, count=size // element_dtype.itemsize, offset=start)
+                if (elements['token'] == token).all():
+                    return elements['value'].astype(result_dtype)
+
+        # ints and uints of different widths
+        tokenH = token & 0xF0
+        if tokenH != 0x10 and tokenH != 0xF0:
+            return _MISSING
+        signed = tokenH == 0x10
+        byteorder = 'little' if signed else 'big'
+        values = []
+        pos = start
+        while pos <= endAddress:
+            token = buf[pos]
+            tokenL = token & 0x0F
+            if (token & 0xF0) != tokenH or tokenL > 8:
+                return _MISSING
+            values.append(int.from_bytes(buf[pos + 1:pos + 1 + tokenL], byteorder, signed=signed))
+            pos += 1 + tokenL
+        if pos != (endAddress + 1):
+            raise InvalidFileException()
+        return numpy.array(values, dtype='int64' if signed else 'uint64')
+
+    def _decode_scalar_at(self, addr, with_type_info=False):
+        """
+        decode the scalar (anything but a reference, array or dict) at addr.
+
+        Returns a tuple of the type name, the value and the address directly
+        behind the object. with_type_info only applies to nested bplist17
+        documents. The decoder is looked up by token in _SCALAR_DECODERS.
+        """
+        decoder = _SCALAR_DECODERS[self._buf[addr]]
+        if decoder is None:
+            raise TypeError("unsupported type: %s at: %s" % (self._buf[addr:addr + 1].hex(), addr))
+        return decoder(self, addr, with_type_info)
+
+    def _decode_int_at(self, addr, with_type_info):
+        tokenL = self._buf[addr] & 0x0F
+        return 'int', int.from_bytes(self._buf[addr + 1:addr + 1 + tokenL], 'little', signed=True), addr + 1 + tokenL
+
+    def _decode_float_at(self, addr, with_type_info):
+        return 'float', struct.unpack_from('<f', self._buf, addr + 1)[0], addr + 5
+
+    def _decode_double_at(self, addr, with_type_info):
+        return 'double', struct.unpack_from('<d', self._buf, addr + 1)[0], addr + 9
+
+    def _decode_data_at(self, addr, with_type_info):
+        size, pos = self._decode_dynamic_size(addr, addr + 1, self._buf[addr] & 0x0F)
+        bytesData = self._slice(pos, size)
+
+        if self._data_threshold is not None and size > self._data_threshold:
+            return 'data.reference', DataReference(pos, size), pos + size
+
+        result_type = self._nested_type(bytesData)
+        if result_type is None:
+            result_type, result_value = _DATA_MODES[self._data_mode](bytesData)
+        elif self._lazy_nested:
+            result_value = _LazyNestedPlist(self, result_type, bytesData, with_type_info)
+        else:
+            try:
+                result_value = self._decode_nested(result_type, bytesData, with_type_info)
+            except InvalidFileException:
+                if result_type == 'data.bplist17':
+                    raise
+                # not a bplist00 after all, keep the data
+                result_type, result_value = _DATA_MODES[self._data_mode](bytesData)
+        return result_type, result_value, pos + size
+
+    def _decode_utf16_at(self, addr, with_type_info):  # unicode string
+        size, pos = self._decode_dynamic_size(addr, addr + 1, self._buf[addr] & 0x0F)
+        size *= 2
+        return 'string_utf16le', str(self._slice(pos, size), 'utf-16le'), pos + size
+
+    def _decode_ascii_at(self, addr, with_type_info):
+        size, pos = self._decode_dynamic_size(addr, addr + 1, self._buf[addr] & 0x0F)
+        return 'string_ascii', str(self._slice(pos, size), 'ascii').rstrip('\x00'), pos + size
+
+    def _decode_true_at(self, addr, with_type_info):
+        return 'bool', True, addr + 1
+
+    def _decode_false_at(self, addr, with_type_info):
+        return 'bool', False, addr + 1
+
+    def _decode_null_at(self, addr, with_type_info):
+        return 'null', None, addr + 1
+
+    def _decode_uint_at(self, addr, with_type_info):
+        tokenL = self._buf[addr] & 0x0F
+        return 'uint', int.from_bytes(self._buf[addr + 1:addr + 1 + tokenL], 'big', signed=False), addr + 1 + tokenL
+
+    def _nested_type(self, data):
+        """return 'data.bplist17' or 'data.bplist00' if data is a document to parse, else None"""
+        if data[:0x6] == b'bplist' and self._nested_level < self._max_nested_depth \
+                and (data[0x6:0x8] == b'17' or (data[0x6:0x8] == b'00' and self._nested_bplist00)):
+            return sys.intern('data.bplist' + str(data[0x6:0x8], 'ascii'))
+        return None
+
+    def _decode_nested(self, result_type, data, with_type_info=False):
+        """parse the plist of result_type ('data.bplist17' or 'data.bplist00') in the window data of the buffer"""
+        if result_type == 'data.bplist00':
+            try:
+                # plistlib reads from a file object, so this one is copied
+                return plistlibLoads(bytes(data), fmt=FMT_BINARY, dict_type=self._dict_type)
+            except (InvalidFileException, OSError, IndexError, struct.error, OverflowError,
+                    ValueError, TypeError, KeyError):
+                raise InvalidFileException()
+        parser = self._spawn(data)
+        parser._nested_level = self._nested_level + 1
+        if self._preserve_layout:
+            return parser._decode_source_at(0x8, with_type_info=with_type_info)[0]
+        if self.stats is not None:
+            return parser._decode_object_at_with_stats(0x8, with_type_info=with_type_info)[0]
+        return parser._decode_object_at(0x8, with_type_info=with_type_info)[0]
+
+    def _decode_lazy_at(self, addr, with_type_info=False):
+        """
+        read the object at addr like _decode_object_at(), but return arrays
+        and dicts as proxies that decode their content on first access.
+        """
+        addr = self._resolve_reference_at(addr)
+        tokenH = self._buf[addr] & 0xF0
+        if tokenH == 0xA0:
+            result_type = 'array'
+            result_value = _LazyArray(self, addr, with_type_info)
+        elif tokenH == 0xD0:
+            result_type = 'dict'
+            result_value = _LazyDict(self, addr, with_type_info)
+        else:
+            return self._decode_object_at(addr, with_type_info=with_type_info)[0]
+
+        if with_type_info:
+            return self._with_type_info(result_type, result_value)
+        else:
+            return result_value
+
+    def _skip_object_at(self, addr):
+        """return the address directly behind the object at addr without decoding it"""
+        buf = self._buf
+        token = buf[addr]
+        tokenH, tokenL = token & 0xF0, token & 0x0F
+
+        if tokenH == 0x10 or tokenH == 0xF0: # int, uint
+            return addr + 1 + tokenL
+        elif token == 0x22:
+            return addr + 5
+        elif token == 0x23:
+            return addr + 9
+        elif tokenH == 0x40 or tokenH == 0x70 or tokenH == 0x80: # data, ascii string, reference
+            size, pos = self._decode_dynamic_size(addr, addr + 1, tokenL)
+            return pos + size
+        elif tokenH == 0x60: # unicode string
+            size, pos = self._decode_dynamic_size(addr, addr + 1, tokenL)
+            return pos + size * 2
+        elif tokenH == 0xA0 or tokenH == 0xD0:
+            return int.from_bytes(self._slice(addr + 1, 0x8), 'little') + 1
+        elif token == 0xB0 or token == 0xC0 or token == 0xE0:
+            return addr + 1
+        else:
+            raise TypeError("unsupported type: %02x at: %s" % (token, addr))
+
+    def _decode_dynamic_size(self, addr, pos, tokenL):
+        """read the size of the object at addr if its token is followed by one, returns (size, pos)"""
+        if tokenL == 0xF:
+            token2 = self._buf[pos]
+            pos += 1
+            length = token2 & 0xF # extract last 4 bits from token2 as length
+            if length != 0 and ((token2 & 0xF0) == 0x10) :
+                size = int.from_bytes(self._buf[pos:pos + length], 'little')
+                pos += length
+            else:
+                raise TypeError("unsupported type: %s" % self._buf[addr:pos].hex())
+        else:
+            size = tokenL
+        return size, pos
+
+    def _slice(self, pos, size):
+        """return a zero-copy view of size bytes at pos"""
+        data = self._buf[pos:pos + size]
+        if len(data) != size:
+            raise InvalidFileException()
+        return data
+
+    def _with_type_info(self, result_type, result_value):
+        if self._node_factory is not None:
+            return self._node_factory(result_type, result_value)
+        result = self._dict_type()
+        result['type'] = result_type
+        result['value'] = result_value
+        return result
+
+    def _transformDictionary(self, dictionary, with_type_info=False):
+        transformed_dict = {}
+        if with_type_info:
+             return dictionary
+        else:
+            class_value = dictionary["$class"]
+            if class_value == "NSDictionary" or class_value == "NSMutableDictionary":
+                transformed_dict["$class"] = class_value
+                keys = dictionary["NS.keys"]
+                objects = dictionary["NS.objects"]
+                for index in range(len(keys)):
+                    transformed_dict[keys[index]] = objects[index]
+                
+                return transformed_dict
+            else:
+                return dictionary
+    
+        
+
+# token -> _BinaryPlist17Parser method decoding a scalar, see _decode_scalar_at()
+_SCALAR_DECODERS = [None] * 0x100
+for _tokenL in range(0x10):
+    _SCALAR_DECODERS[0x10 | _tokenL] = _BinaryPlist17Parser._decode_int_at
+    _SCALAR_DECODERS[0x40 | _tokenL] = _BinaryPlist17Parser._decode_data_at
+    _SCALAR_DECODERS[0x60 | _tokenL] = _BinaryPlist17Parser._decode_utf16_at
+    _SCALAR_DECODERS[0x70 | _tokenL] = _BinaryPlist17Parser._decode_ascii_at
+    _SCALAR_DECODERS[0xF0 | _tokenL] = _BinaryPlist17Parser._decode_uint_at
+_SCALAR_DECODERS[0x22] = _BinaryPlist17Parser._decode_float_at
+_SCALAR_DECODERS[0x23] = _BinaryPlist17Parser._decode_double_at
+_SCALAR_DECODERS[0xB0] = _BinaryPlist17Parser._decode_true_at
+_SCALAR_DECODERS[0xC0] = _BinaryPlist17Parser._decode_false_at
+_SCALAR_DECODERS[0xE0] = _BinaryPlist17Parser._decode_null_at
+del _tokenL
+
+# token -> (struct format, type name) for runs of numbers in arrays, see _decode_run_at()
+_BULK_FORMATS = [None] * 0x100
+for _token, _format, _type in ((0x11, '<xb', 'int'), (0x12, '<xh', 'int'), (0x14, '<xi', 'int'), (0x18, '<xq', 'int'),
+                               (0x22, '<xf', 'float'), (0x23, '<xd', 'double'),
+                               (0xF1, '>xB', 'uint'), (0xF2, '>xH', 'uint'), (0xF4, '>xI', 'uint'), (0xF8, '>xQ', 'uint')):
+    _BULK_FORMATS[_token] = (struct.Struct(_format), _type)
+del _token, _format, _type
+
+# no runs for _decode_object_at() with an observer
+_NO_BULK_FORMATS = [None] * 0x100
+
+# token -> (dtype of token and value, dtype of the result) for numpy_arrays, see _decode_ndarray_at()
+_NUMPY_FORMATS = [None] * 0x100
+if numpy is not None:
+    for _token, _format, _result in ((0x11, '<i1', 'int64'), (0x12, '<i2', 'int64'), (0x14, '<i4', 'int64'), (0x18, '<i8', 'int64'),
+                                     (0x22, '<f4', 'float32'), (0x23, '<f8', 'float64'),
+                                     (0xF1, '>u1', 'uint64'), (0xF2, '>u2', 'uint64'), (0xF4, '>u4', 'uint64'), (0xF8, '>u8', 'uint64')):
+        _NUMPY_FORMATS[_token] = (numpy.dtype([('token', 'u1'), ('value', _format)]), numpy.dtype(_result))
+    del _token, _format, _result
+
+_MISSING = object()
+
+_LAZY_ERRORS = (OSError, IndexError, struct.error, OverflowError, ValueError)
+
+def _end_address_error(token, start, end, pos):
+    """the InvalidFileException for an array/dict whose children end at pos, not at its end address"""
+    return InvalidFileException("token %02x at: %s has end address %s, but its children end at: %s"
+                                % (token, start, end, pos - 1))
+
+def _json_float(value):
+    """like the json module writes floats"""
+    if value != value:
+        return 'NaN'
+    if value == math.inf:
+        return 'Infinity'
+    if value == -math.inf:
+        return '-Infinity'
+    return float.__repr__(value)
+
+def _json_key(key):
+    """the string the json module writes for the dict key key"""
+    if isinstance(key, str):
+        return key
+    if isinstance(key, float):
+        return _json_float(key)
+    if key is True:
+        return 'true'
+    if key is False:
+        return 'false'
+    if key is None:
+        return 'null'
+    if isinstance(key, int):
+        return int.__repr__(key)
+    raise TypeError("keys must be str, int, float, bool or None, not %s" % type(key).__name__)
+
+def _json_scalar(value, fmt, newline):
+    """
+    the JSON of a decoded scalar for _BinaryPlist17Parser._transcode_at().
+    Other objects (like nested bplist00 documents) are written by the
+    json module and indented by newline.
+    """
+    value_type = type(value)
+    if value_type is str:
+        return _json_string(value)
+    if value is None:
+        return 'null'
+    if value is True:
+        return 'true'
+    if value is False:
+        return 'false'
+    if value_type is int:
+        return int.__repr__(value)
+    if value_type is float:
+        return _json_float(value)
+    indent, item_sep, key_sep, default = fmt
+    return json.dumps(value, indent=indent, separators=(item_sep, key_sep), default=default).replace('\n', newline)
+
+class TypedNode(Mapping):
+    """
+    Typed value of a parser created with typed_nodes=True. It reads like
+    the {'type': ..., 'value': ...} dict of with_type_info and compares
+    equal to it, as_dict() converts it for serialization.
+    """
+
+    __slots__ = ('type', 'value')
+
+    def __init__(self, type, value):
+        self.type = type
+        self.value = value
+
+    def __getitem__(self, key):
+        if key == 'type':
+            return self.type
+        if key == 'value':
+            return self.value
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(('type', 'value'))
+
+    def __len__(self):
+        return 2
+
+    def __eq__(self, other):
+        if isinstance(other, TypedNode):
+            return self.type == other.type and self.value == other.value
+        if isinstance(other, Mapping):
+            return len(other) == 2 and 'type' in other and 'value' in other \
+                and self.type == other['type'] and self.value == other['value']
+        return NotImplemented
+
+    def __repr__(self):
+        return '%s(%r, %r)' % (type(self).__name__, self.type, self.value)
+
+    def __reduce__(self):
+        return (TypedNode, (self.type, self.value))
+
+    def __deepcopy__(self, memo):
+        return TypedNode(self.type, copy.deepcopy(self.value, memo))
+
+    def as_dict(self, dict_type=dict):
+        """return the node as dict, children are left as they are"""
+        result = dict_type()
+        result['type'] = self.type
+        result['value'] = self.value
+        return result
+
+def _typed_parts(value):
+    """return (type, value) of a typed node, either a TypedNode or a dict"""
+    if type(value) is TypedNode:
+        return value.type, value.value
+    return value.get('type'), value.get('value')
+
+class _SourceNode:
+    """
+    Base of the arrays, dicts and typed nodes returned by parsers with
+    preserve_layout. _source is (_SourceDocument, start, end) of the bytes
+    the node was decoded from, or None once the node or anything below it
+    was modified, _parent is the node it was decoded as a child of.
+    Copies (and pickles) are plain objects of the base type.
+    """
+
+    __slots__ = ()
+
+    def _touch(self):
+        """forget the source of this node and all nodes above it"""
+        self._source = None
+        node = self._parent
+        while node is not None and node._source is not None:
+            node._source = None
+            node = node._parent
+
+def _touching(method):
+    """wrap a method of list or a dict type, which modifies the object, in one calling _touch() first"""
+    def mutate(self, *args, **kwargs):
+        self._touch()
+        return method(self, *args, **kwargs)
+    mutate.__name__ = method.__name__
+    return mutate
+
+_LIST_MUTATORS = ('__setitem__', '__delitem__', '__iadd__', '__imul__', 'append', 'extend',
+                  'insert', 'pop', 'remove', 'clear', 'sort', 'reverse')
+_DICT_MUTATORS = ('__setitem__', '__delitem__', '__ior__', 'pop', 'popitem', 'clear',
+                  'update', 'setdefault')
+
+# list or dict type -> its _SourceNode subclass, see _source_type()
+_SOURCE_TYPES = {}
+
+def _source_type(base):
+    """return the _SourceNode subclass of base, which is list or a dict type"""
+    result = _SOURCE_TYPES.get(base)
+    if result is None:
+        is_list = issubclass(base, list)
+        namespace = {name: _touching(getattr(base, name))
+                     for name in (_LIST_MUTATORS if is_list else _DICT_MUTATORS) if hasattr(base, name)}
+        namespace['__slots__'] = ('_source', '_parent')
+        def __reduce_ex__(self, protocol):
+            return base, (list(self) if is_list else list(self.items()),)
+        namespace['__reduce_ex__'] = __reduce_ex__
+        result = _SOURCE_TYPES[base] = type('_Source' + base.__name__[:1].upper() + base.__name__[1:], (_SourceNode, base), namespace)
+    return result
+
+class _SourceTypedNode(_SourceNode, TypedNode):
+    """TypedNode of a parser with preserve_layout and typed_nodes"""
+
+    __slots__ = ('_source', '_parent')
+
+    def __init__(self, type, value, source=None):
+        object.__setattr__(self, 'type', type)
+        object.__setattr__(self, 'value', value)
+        object.__setattr__(self, '_source', source)
+        object.__setattr__(self, '_parent', None)
+
+    def __setattr__(self, name, value):
+        if name == 'type' or name == 'value':
+            self._touch()
+        object.__setattr__(self, name, value)
+
+class _SourceDocument:
+    """
+    A document parsed with preserve_layout: its buffer, a parser on it and
+    the sorted addresses of its arrays/dicts and references, which the
+    writer rebases when it copies a range of the document.
+    """
+
+    __slots__ = ('buf', 'parser', 'containers', 'references')
+
+    def __init__(self, buf, parser, containers, references):
+        self.buf = buf
+        self.parser = parser
+        self.containers = containers
+        self.references = references
+
+def _shift_at(marks, shifts, offset, address):
+    """offset from a source address to its copy, see _BinaryPlist17Writer._pack_source()"""
+    i = bisect.bisect_right(marks, address)
+    return shifts[i - 1] if i else offset
+
+class _StatsObserver:
+    """
+    Observer of _BinaryPlist17Parser._decode_object_at() for parsers with
+    collect_stats set, which updates parser.stats for every object. Arrays
+    and dicts count their 9 byte header, objects behind references are
+    counted each time they are decoded.
+    """
+
+    def __init__(self, parser):
+        self.parser = parser
+        self.stats = parser.stats
+        self.cache = parser._reference_cache
+        self.numpy_arrays = parser._numpy_arrays
+        self.list_type, self.dict_type = list, parser._dict_type
+        self.depth = 0 # open arrays and dicts
+
+    def reference(self, start, end, address, following):
+        self.stats._count('reference', end - start)
+        self.stats.dereferences += 1
+
+    def open(self, kind, start, end, following):
+        stats = self.stats
+        stats._count('array' if kind == 0xA0 else 'dict', 9)
+        self.depth += 1
+        if self.depth > stats.max_depth:
+            stats.max_depth = self.depth
+
+    def ndarray(self, start, end):
+        """_decode_ndarray_at(), a numpy array is counted as a whole, including the elements"""
+        stats = self.stats
+        clock = time.perf_counter()
+        result = self.parser._decode_ndarray_at(start, end)
+        if result is not _MISSING:
+            stats._count('array', end + 1 - start, time.perf_counter() - clock)
+            if self.depth + 1 > stats.max_depth:
+                stats.max_depth = self.depth + 1
+        return result
+
+    def scalar(self, addr, typed):
+        """return the scalar at addr and the address behind it"""
+        parser = self.parser
+        clock = time.perf_counter()
+        result_type, result_value, pos = parser._decode_scalar_at(addr, with_type_info=typed)
+        self.stats._count(result_type, pos - addr, time.perf_counter() - clock)
+        if (result_type == 'data.bplist17' or result_type == 'data.bplist00') and not parser._lazy_nested:
+            self.stats.nested_parses += 1
+        return (parser._with_type_info(result_type, result_value) if typed else result_value), pos
+
+    def close(self, kind, start, end, container, typed):
+        """return the completed array/dict container, which spans start:end"""
+        parser = self.parser
+        self.depth -= 1
+        if kind == 0xA0:
+            return parser._with_type_info('array', container) if typed else container
+        clock = time.perf_counter()
+        result_value = parser._transformDictionary(container, with_type_info=typed)
+        self.stats._count('dict', 0, time.perf_counter() - clock, objects=0)
+        return parser._with_type_info('dict', result_value) if typed else result_value
+
+class _SourceObserver:
+    """
+    Observer of _BinaryPlist17Parser._decode_object_at() for parsers with
+    preserve_layout. Arrays, dicts and typed nodes are decoded as
+    _SourceNode objects that remember (document, start, end) of their bytes
+    in _source and the node they are a child of in _parent. The objects
+    behind references are decoded for every reference, so each node has one
+    parent.
+
+    Nodes holding something that can change without them noticing (a
+    bplist00 or lazily parsed document) or references outside of the root
+    object get no _source, and neither do the nodes around them.
+    """
+
+    cache = None
+    numpy_arrays = False
+
+    def __init__(self, parser, addr):
+        self.parser = parser
+        self.root_start, self.root_end = addr, parser._skip_object_at(addr)
+        # addresses of the arrays, dicts and references read in order, not
+        # those read again by following a reference
+        self.containers, self.references = array.array('q'), array.array('q')
+        self.document = _SourceDocument(parser._buf, parser, self.containers, self.references)
+        self.list_type, self.dict_type = _source_type(list), _source_type(parser._dict_type)
+        # open arrays and dicts, of which the outermost unclean ones get no _source
+        self.depth = self.unclean = 0
+
+    def reference(self, start, end, address, following):
+        if not following:
+            self.references.append(start)
+        if not self.root_start <= address < self.root_end:
+            self.unclean = self.depth
+
+    def open(self, kind, start, end, following):
+        if not following:
+            self.containers.append(start)
+        self.depth += 1
+
+    def scalar(self, addr, typed):
+        """return the scalar at addr and the address behind it"""
+        parser = self.parser
+        result_type, result_value, pos = parser._decode_scalar_at(addr, typed)
+        if result_type == 'data.bplist00' or isinstance(result_value, _LazyNestedPlist):
+            self.unclean = self.depth
+            return (parser._with_source_type_info(result_type, result_value, None) if typed else result_value), pos
+        if typed:
+            return parser._with_source_type_info(result_type, result_value, (self.document, addr, pos)), pos
+        return result_value, pos
+
+    def close(self, kind, start, end, container, typed):
+        """return the completed array/dict container, which spans start:end"""
+        parser = self.parser
+        source = (self.document, start, end) if self.depth > self.unclean else None
+        self.depth -= 1
+        if self.unclean > self.depth:
+            self.unclean = self.depth
+        if kind == 0xA0:
+            result_type, result_value = 'array', container
+            children = container
+        else:
+            result_type = 'dict'
+            result_value = parser._transformDictionary(container, with_type_info=typed)
+            if result_value is not container:
+                # NSDictionary, the objects become children of the flattened dict
+                flattened = self.dict_type()
+                setitem = parser._dict_type.__setitem__
+                for k, v in result_value.items():
+                    setitem(flattened, k, v)
+                result_value = flattened
+            children = result_value.values()
+        for child in children:
+            if isinstance(child, _SourceNode):
+                child._parent = result_value
+        result_value._source = source
+        result_value._parent = None
+        return parser._with_source_type_info(result_type, result_value, source) if typed else result_value
+
+class _LazyArray(Sequence):
+    """
+    Read-only proxy for an array of a document parsed with lazy=True.
+
+    The offsets of the elements are collected on first use; an element is
+    decoded when it is indexed or iterated and cached afterwards.
+    """
+
+    __slots__ = ('_parser', '_addr', '_with_type_info', '_offsets', '_items')
+
+    def __init__(self, parser, addr, with_type_info):
+        self._parser = parser
+        self._addr = addr
+        self._with_type_info = with_type_info
+        self._offsets = None
+        self._items = None
+
+    def _load(self):
+        parser = self._parser
+        try:
+            endAddress = int.from_bytes(parser._slice(self._addr + 1, 0x8), 'little')
+            offsets = []
+            pos = self._addr + 9
+            while pos <= endAddress:
+                offsets.append(pos)
+                pos = parser._skip_object_at(pos)
+        except InvalidFileException:
+            raise
+        except _LAZY_ERRORS:
+            raise InvalidFileException()
+        if pos != (endAddress + 1):
+            raise InvalidFileException()
+        self._offsets = offsets
+        self._items = [_MISSING] * len(offsets)
+
+    def __len__(self):
+        if self._offsets is None:
+            self._load()
+        return len(self._offsets)
+
+    def __getitem__(self, index):
+        if self._offsets is None:
+            self._load()
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self._offsets)))]
+        item = self._items[index] # raises IndexError for invalid indices
+        if item is _MISSING:
+            try:
+                item = self._parser._decode_lazy_at(self._offsets[index], with_type_info=self._with_type_info)
+            except InvalidFileException:
+                raise
+            except _LAZY_ERRORS:
+                raise InvalidFileException()
+            self._items[index] = item
+        return item
+
+    def __eq__(self, other):
+        if isinstance(other, (_LazyArray, list)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __repr__(self):
+        if self._offsets is None:
+            return '<%s at %#x>' % (type(self).__name__, self._addr)
+        return '<%s at %#x with %d items>' % (type(self).__name__, self._addr, len(self._offsets))
+
+    def materialize(self):
+        """return the array as a list, decoding all nested proxies"""
+        return _materialize(self)
+
+    def _materialize(self, opened):
+        return [_materialize(item, opened) for item in self]
+
+
+class _LazyDict(Mapping):
+    """
+    Read-only proxy for a dict of a document parsed with lazy=True.
+
+    Keys are decoded on first use, values only when they are looked up and
+    cached afterwards. Without type info, NSDictionary objects are presented
+    with their NS.keys/NS.objects flattened, like _transformDictionary() does.
+    """
+
+    __slots__ = ('_parser', '_addr', '_with_type_info', '_entries', '_values', '_transformed')
+
+    def __init__(self, parser, addr, with_type_info):
+        self._parser = parser
+        self._addr = addr
+        self._with_type_info = with_type_info
+        self._entries = None
+        self._values = None
+        self._transformed = False
+
+    def _load(self):
+        parser = self._parser
+        try:
+            endAddress = int.from_bytes(parser._slice(self._addr + 1, 0x8), 'little')
+            entries = {}
+            pos = self._addr + 9
+            try:
+                while pos <= endAddress:
+                    key, pos = parser._decode_object_at(pos, with_type_info=False)
+                    entries[key] = pos
+                    pos = parser._skip_object_at(pos)
+            except TypeError:
+                raise InvalidFileException()
+            if pos != (endAddress + 1):
+                raise InvalidFileException()
+
+            self._values = {}
+            if not self._with_type_info:
+                class_value = parser._decode_lazy_at(entries["$class"])
+                if class_value == "NSDictionary" or class_value == "NSMutableDictionary":
+                    keys = parser._decode_object_at(entries["NS.keys"])[0]
+                    objects = parser._decode_lazy_at(entries["NS.objects"])
+                    entries = {"$class": None}
+                    self._values["$class"] = class_value
+                    for index in range(len(keys)):
+                        entries[keys[index]] = (objects, index)
+                    self._transformed = True
+        except InvalidFileException:
+            raise
+        except _LAZY_ERRORS:
+            raise InvalidFileException()
+        self._entries = entries
+
+    def __len__(self):
+        if self._entries is None:
+            self._load()
+        return len(self._entries)
+
+    def __iter__(self):
+        if self._entries is None:
+            self._load()
+        return iter(self._entries)
 
-class _BinaryPlist17Parser:
+    def __contains__(self, key):
+        if self._entries is None:
+            self._load()
+        return key in self._entries
+
+    def __getitem__(self, key):
+        if self._entries is None:
+            self._load()
+        value = self._values.get(key, _MISSING)
+        if value is _MISSING:
+            entry = self._entries[key] # raises KeyError for unknown keys
+            try:
+                if self._transformed:
+                    objects, index = entry
+                    value = objects[index]
+                else:
+                    value = self._parser._decode_lazy_at(entry, with_type_info=self._with_type_info)
+            except InvalidFileException:
+                raise
+            except _LAZY_ERRORS:
+                raise InvalidFileException()
+            self._values[key] = value
+        return value
+
+    def __repr__(self):
+        if self._entries is None:
+            return '<%s at %#x>' % (type(self).__name__, self._addr)
+        return '<%s at %#x with %d keys>' % (type(self).__name__, self._addr, len(self._entries))
+
+    def materialize(self):
+        """return the dict as dict_type (or dict for NSDictionary objects), decoding all nested proxies"""
+        return _materialize(self)
+
+    def _materialize(self, opened):
+        result = {} if self._transformed else self._parser._dict_type()
+        for key in self:
+            result[key] = _materialize(self[key], opened)
+        return result
+
+class _LazyNestedPlist:
     """
-    Read or write a bplist17 file.
-    Raise InvalidFileException in case of error, otherwise return the
-    root object.
+    Placeholder for a plist in a data object of a document parsed with
+    lazy_nested=True. format is 'data.bplist17' or 'data.bplist00', data
+    the window of the parent buffer it is stored in. The document is parsed
+    when value is accessed first.
     """
 
-    def __init__(self, dict_type):
-        self._dict_type = dict_type
+    __slots__ = ('_parser', 'format', 'data', '_with_type_info', '_value')
 
-    def parse(self, fp, with_type_info=False):
-        try:
-            # The basic file format:
-            # MAGIC (6 bytes)
-            # VERSION (2 bytes)
-            
-            # ROOT Object
-            
-            self._fp = fp
-            # self._fp.seek(-32, os.SEEK_END)
-            self._fp.seek(0)
-            magic = self._fp.read(0x6)
-            # print(magic)
-            version = self._fp.read(0x2)
-            # print(version)
+    def __init__(self, parser, format, data, with_type_info):
+        self._parser = parser
+        self.format = format
+        self.data = data
+        self._with_type_info = with_type_info
+        self._value = _MISSING
 
-            return self._read_object_at(0x8, with_type_info=with_type_info)
+    @property
+    def value(self):
+        if self._value is _MISSING:
+            try:
+                self._value = self._parser._decode_nested(self.format, self.data, self._with_type_info)
+            except InvalidFileException:
+                raise
+            except _LAZY_ERRORS:
+                raise InvalidFileException()
+        return self._value
 
-        except (OSError, IndexError, struct.error, OverflowError,
-                ValueError):
-            raise InvalidFileException()
+    def __eq__(self, other):
+        if isinstance(other, _LazyNestedPlist):
+            return self.format == other.format and self.data == other.data
+        return self.value == other
 
-    # def _get_size(self, tokenL):
-    #     """ return the size of the next object."""
-    #     if tokenL == 0xF:
-    #         m = self._fp.read(1)[0] & 0x3
-    #         s = 1 << m
-    #         f = '>' + _BINARY_FORMAT[s]
-    #         return struct.unpack(f, self._fp.read(s))[0]
+    __hash__ = None
 
-    #     return tokenL
+    def __repr__(self):
+        return '<%s %s of %d bytes>' % (type(self).__name__, self.format, len(self.data))
 
-    # def _read_ints(self, n, size):
-    #     data = self._fp.read(size * n)
-    #     if size in _BINARY_FORMAT:
-    #         return struct.unpack(f'>{n}{_BINARY_FORMAT[size]}', data)
-    #     else:
-    #         if not size or len(data) != size * n:
-    #             raise InvalidFileException()
-    #         return tuple(int.from_bytes(data[i: i + size], 'big')
-    #                      for i in range(0, size * n, size))
+    def materialize(self):
+        """return the parsed document, decoding all nested proxies"""
+        return _materialize(self.value)
 
-    # def _read_refs(self, n):
-    #     return self._read_ints(n, self._ref_size)
+def _materialize(value, opened=None):
+    """
+    replace lazy proxies in value by the lists and dicts they stand for.
+    opened holds (parser, address) of the arrays and dicts being
+    materialized, an array or dict containing itself makes the file invalid.
+    """
+    if isinstance(value, (_LazyArray, _LazyDict)):
+        if opened is None:
+            opened = set()
+        key = (value._parser, value._addr)
+        if key in opened:
+            raise InvalidFileException() # the object contains itself, through a reference
+        opened.add(key)
+        result = value._materialize(opened)
+        opened.remove(key)
+        return result
+    if isinstance(value, _LazyNestedPlist):
+        return _materialize(value.value, opened)
+    if isinstance(value, dict) and isinstance(value.get('value'), (_LazyArray, _LazyDict, _LazyNestedPlist)):
+        # typed wrapper produced by _with_type_info()
+        result = type(value)()
+        result['type'] = value['type']
+        result['value'] = _materialize(value['value'], opened)
+        return result
+    if isinstance(value, TypedNode) and isinstance(value.value, (_LazyArray, _LazyDict, _LazyNestedPlist)):
+        return TypedNode(value.type, _materialize(value.value, opened))
+    return value
 
-    def _read_object_at(self, addr, with_type_info=False):
-        """
-        read the object by reference.
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
 
-        May recursively read sub-objects (content of an array/dict/set)
-        """
-        # print("Entered _read_object_at: ", addr)
-        totalReadBytes = []
-        self._fp.seek(addr)
-        token = self._fp.read(1)[0]
-        totalReadBytes.append(token)
-        tokenH, tokenL = token & 0xF0, token & 0x0F
+# data object that was not decoded, see data_threshold of _BinaryPlist17Parser
+DataReference = namedtuple('DataReference', ['offset', 'length'])
 
-        # elif token == 0x0f:
-        #     result = b''
+# difference between two documents, see _BinaryPlist17Parser.diff()
+Difference = namedtuple('Difference', ['path', 'kind', 'old', 'new'])
 
-        if tokenH == 0x10:  # int
-            # Integer (length tokenL)
-            result_type = 'int'
-            result_value = int.from_bytes(self._fp.read(tokenL), 'little', signed=True)
+# data_mode of _BinaryPlist17Parser: function returning (type, value) for a memoryview
+_DATA_MODES = {
+    'hex': lambda data: ('data.hexstring', data.hex()),
+    'base64': lambda data: ('data.base64', base64.b64encode(data).decode('ascii')),
+    'bytes': lambda data: ('data.bytes', bytes(data)),
+    'memoryview': lambda data: ('data.memoryview', data.toreadonly()),
+}
 
-        elif token == 0x22: # real
-            result_type = 'float'
-            result_value = struct.unpack('<f', self._fp.read(4))[0]
+class _StreamReader:
+    """
+    Forward-only reader on a binary stream for
+    _BinaryPlist17Parser.parse_stream(), pos is the address of the next
+    byte. Reads whatever the stream has available (read1()) in chunks of at
+    most chunk_size bytes, so decoding starts before the stream ends.
+    """
 
-        elif token == 0x23: # real
-            result_type = 'double'
-            result_value = struct.unpack('<d', self._fp.read(8))[0]
+    def __init__(self, fp, chunk_size=1 << 16):
+        self._read = getattr(fp, 'read1', fp.read)
+        self._chunk_size = chunk_size
+        self._buffer = b''
+        self._offset = 0
+        self.pos = 0
 
-        elif tokenH == 0x40:  # data
-            size = self._read_dynamic_size(totalReadBytes, tokenL)
-            bytesData = self._fp.read(size)
-            
-            nestedData = BytesIO(bytesData)
-
-            nestedData.seek(0)
-            magic = nestedData.read(0x6)
-            # print(magic)
-            version = nestedData.read(0x2)
-            # print(version)
-            nestedData.seek(0)
-            
-            if len(bytesData) != size:
-                raise InvalidFileException()
-            
-            result_type = 'data.hexstring'
-            result_value = ''.join('{:02x}'.format(x) for x in bytesData)
-            
-            if magic == b'bplist':
-                if version == b'00':
-                    # parse bplist00
-                    #TODO Fix BPlist00 parser
-                    # type = 'data.bplist00'
-                    # result = plistlibLoad(nestedData, fmt=PlistFormat.FMT_XML)
-                    result_value = result_value
-                elif version == b'17':
-                    result_type = 'data.bplist17'
-                    result_value = _BinaryPlist17Parser(dict).parse(nestedData, with_type_info=with_type_info)
-
-        elif tokenH == 0x60:  # unicode string
-            size = self._read_dynamic_size(totalReadBytes, tokenL) * 2
-            data = self._fp.read(size)
-            if len(data) != size:
-                raise InvalidFileException()
-            result_type = 'string_utf16le'
-            result_value = data.decode('utf-16le')
-        
-        elif tokenH == 0x70:  # ascii string
-            size = self._read_dynamic_size(totalReadBytes, tokenL)
-            data = self._fp.read(size)
-            if len(data) != size:
+    def read(self, size):
+        """return the next size bytes, raise InvalidFileException if the stream ends before"""
+        offset = self._offset
+        if offset + size > len(self._buffer):
+            self._fill(size)
+            offset = 0
+        self._offset = offset + size
+        self.pos += size
+        return self._buffer[offset:offset + size]
+
+    def _fill(self, size):
+        parts = [self._buffer[self._offset:]]
+        missing = size - len(parts[0])
+        while missing > 0:
+            chunk = self._read(max(missing, self._chunk_size))
+            if not chunk:
                 raise InvalidFileException()
-            result_type = 'string_ascii'
-            result_value = data.decode('ascii').rstrip('\x00')
-
-        elif tokenH == 0x80:  # Referenced Object
-            size = self._read_dynamic_size(totalReadBytes, tokenL)
-            address = int.from_bytes(self._fp.read(size), 'little')
-            currentAddr = self._fp.tell()
-            result = self._read_object_at(address, with_type_info=with_type_info)
-            self._fp.seek(currentAddr)
-            return result # return early, because the result of _read_object_at() is the final result
-                          # i.e. it already combines (type, value) if with_type_info == True
-
-        elif tokenH == 0xA0:  # array
-            endAddress = int.from_bytes(self._fp.read(0x8), 'little')
-            result_type = 'array'
-            result_value = []
-            while(self._fp.tell() <= endAddress):
-                result_value.append(self._read_object_at(self._fp.tell(), with_type_info=with_type_info))
-            
-            if self._fp.tell() != (endAddress + 1):
-                raise InvalidFileException() # TODO: Descriptive Exception
+            parts.append(chunk)
+            missing -= len(chunk)
+        self._buffer = b''.join(parts)
+        self._offset = 0
 
-        elif token == 0xB0:
-            result_type = 'bool'
-            result_value = True
+# token -> size of the fixed size scalars behind their token, for parse_stream()
+_STREAM_SCALAR_SIZES = [0] * 0x100
+for _tokenL in range(0x10):
+    _STREAM_SCALAR_SIZES[0x10 | _tokenL] = _tokenL
+    _STREAM_SCALAR_SIZES[0xF0 | _tokenL] = _tokenL
+_STREAM_SCALAR_SIZES[0x22] = 4
+_STREAM_SCALAR_SIZES[0x23] = 8
+del _tokenL
 
-        elif token == 0xC0:
-            result_type = 'bool'
-            result_value = False
+class _ReferenceCache:
+    """
+    Cache of decoded objects keyed by (address, with_type_info).
 
-        elif tokenH == 0xD0:  # dict
-            endAddress = int.from_bytes(self._fp.read(0x8), 'little')
-            result_type = 'dict'
-            result_value = self._dict_type()
+    Unbounded by default, with maxsize it evicts the least recently used
+    entry. Entries are only valid for a single document, counters are kept
+    until reset() is called.
+    """
+
+    def __init__(self, maxsize=None, copy_hits=False):
+        self.maxsize = maxsize
+        self.copy_hits = copy_hits
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entries = self._entries
+        result = entries.get(key, _MISSING)
+        if result is _MISSING:
+            self.misses += 1
+            return _MISSING
+        self.hits += 1
+        if self.maxsize is not None:
+            entries.move_to_end(key)
+        if self.copy_hits:
+            return copy.deepcopy(result)
+        return result
+
+    def put(self, key, value):
+        entries = self._entries
+        entries[key] = value
+        if self.maxsize is not None and len(entries) > self.maxsize:
+            entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def reset(self):
+        self.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def info(self):
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self._entries))
+
+class Plist17Stats:
+    """
+    Counters of a parser or writer created with collect_stats=True. They
+    add up over all documents until clear() is called.
+
+        objects         number of objects per type name (as in the typed
+                        output, plus 'reference')
+        bytes           encoded bytes per type, arrays and dicts count their
+                        9 byte header only
+        type_seconds    time spent in the decoder/encoder of each type,
+                        for dicts the NSDictionary transformation
+        dereferences    0x80 references followed by the parser or written
+                        by the writer
+        nested_parses   data objects parsed as nested bplist17 documents
+        max_depth       deepest nesting of arrays and dicts
+        bytes_saved     bytes saved by deduplication per kind (writer)
+        documents       number of parsed or written documents
+        seconds         total time of parse_buffer()/write()
+    """
+
+    __slots__ = ('objects', 'bytes', 'type_seconds', 'dereferences', 'nested_parses',
+                 'max_depth', 'bytes_saved', 'documents', 'seconds')
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.objects = {}
+        self.bytes = {}
+        self.type_seconds = {}
+        self.dereferences = 0
+        self.nested_parses = 0
+        self.max_depth = 0
+        self.bytes_saved = {}
+        self.documents = 0
+        self.seconds = 0.0
+
+    def _count(self, type, size, seconds=0.0, objects=1):
+        self.objects[type] = self.objects.get(type, 0) + objects
+        self.bytes[type] = self.bytes.get(type, 0) + size
+        if seconds:
+            self.type_seconds[type] = self.type_seconds.get(type, 0.0) + seconds
+
+    def update(self, other):
+        """add the counters of other, e.g. of another parser"""
+        for type in set(other.objects) | set(other.type_seconds):
+            self._count(type, other.bytes.get(type, 0), other.type_seconds.get(type, 0.0),
+                        objects=other.objects.get(type, 0))
+        self.dereferences += other.dereferences
+        self.nested_parses += other.nested_parses
+        self.max_depth = max(self.max_depth, other.max_depth)
+        for kind, saved in other.bytes_saved.items():
+            self.bytes_saved[kind] = self.bytes_saved.get(kind, 0) + saved
+        self.documents += other.documents
+        self.seconds += other.seconds
+
+    def as_dict(self):
+        return {name: copy.copy(getattr(self, name)) for name in self.__slots__}
+
+    def format(self):
+        """return the counters as a table"""
+        lines = ['%-16s %10s %12s %10s' % ('type', 'objects', 'bytes', 'ms')]
+        for type in sorted(set(self.objects) | set(self.type_seconds)):
+            lines.append('%-16s %10i %12i %10.3f' % (type, self.objects.get(type, 0), self.bytes.get(type, 0),
+                                                     self.type_seconds.get(type, 0.0) * 1000))
+        lines.append('documents: %i, total time: %.3f ms' % (self.documents, self.seconds * 1000))
+        lines.append('references: %i, nested documents: %i, max depth: %i'
+                     % (self.dereferences, self.nested_parses, self.max_depth))
+        if self.bytes_saved:
+            lines.append('bytes saved by deduplication: %s'
+                         % ', '.join('%s %i' % item for item in sorted(self.bytes_saved.items())))
+        return '\n'.join(lines)
+
+    def __repr__(self):
+        return 'Plist17Stats(%r)' % self.as_dict()
+
+
+class Plist17Index:
+    """
+    Structural index of a bplist17 document, see
+    _BinaryPlist17Parser.build_index().
+
+    Every encoded object (including dict keys and 0x80 references) has an
+    ordinal, its position in document order; the root object is 0. The
+    index consists of arrays over the ordinals:
+
+        offsets         address of the object
+        tokens          its token byte (a bytearray)
+        ends            address directly behind the object, for arrays and
+                        dicts behind their last element
+        parents         ordinal of the array or dict containing the object,
+                        -1 for the root object
+        child_starts    children of ordinal i are children[child_starts[i]:child_starts[i + 1]]
+        children        ordinals grouped by parent, in document order
+
+    size and mtime_ns identify the indexed document (mtime_ns is 0 unless
+    it was indexed from a path). Indexes are saved to and loaded from
+    sidecar files, by default the document path plus SUFFIX.
+    """
+
+    SUFFIX = '.index'
+
+    __slots__ = ('offsets', 'tokens', 'ends', 'parents', 'child_starts', 'children',
+                 'size', 'mtime_ns')
+
+    def __init__(self, offsets, tokens, ends, parents, size, mtime_ns=0):
+        self.offsets = offsets
+        self.tokens = tokens
+        self.ends = ends
+        self.parents = parents
+        self.size = size
+        self.mtime_ns = mtime_ns
+        # group the ordinals by parent (a counting sort, ordinals stay sorted)
+        child_starts = array.array(offsets.typecode, bytes(offsets.itemsize * (len(offsets) + 1)))
+        for ordinal in range(1, len(parents)):
+            child_starts[parents[ordinal] + 1] += 1
+        for i in range(1, len(child_starts)):
+            child_starts[i] += child_starts[i - 1]
+        children = array.array(offsets.typecode, bytes(offsets.itemsize * max(0, len(offsets) - 1)))
+        fill = child_starts[:]
+        for ordinal in range(1, len(parents)):
+            parent = parents[ordinal]
+            children[fill[parent]] = ordinal
+            fill[parent] += 1
+        self.child_starts = child_starts
+        self.children = children
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __repr__(self):
+        return 'Plist17Index(objects=%i, size=%i)' % (len(self), self.size)
+
+    def type_at(self, ordinal):
+        """return the type name of the object with ordinal, as in Plist17Stats"""
+        return _INDEX_TYPE_NAMES[self.tokens[ordinal]]
+
+    def children_of(self, ordinal):
+        """return the ordinals of the elements of an array, or of the keys and values of a dict"""
+        return self.children[self.child_starts[ordinal]:self.child_starts[ordinal + 1]]
+
+    def ordinal_at(self, address):
+        """return the ordinal of the object at address"""
+        ordinal = bisect.bisect_left(self.offsets, address)
+        if ordinal == len(self.offsets) or self.offsets[ordinal] != address:
+            raise InvalidFileException()
+        return ordinal
+
+    def histogram(self):
+        """return the number of objects per type name, without decoding anything"""
+        counts = {}
+        for token, count in Counter(self.tokens).items():
+            name = _INDEX_TYPE_NAMES[token]
+            counts[name] = counts.get(name, 0) + count
+        return counts
+
+    def is_current(self, path):
+        """whether the file at path still has the size and modification time of the indexed one"""
+        status = os.stat(path)
+        return status.st_size == self.size and status.st_mtime_ns == self.mtime_ns
+
+    def save(self, path):
+        """write the index to path (atomically)"""
+        header = _INDEX_HEADER.pack(_INDEX_MAGIC, len(self), self.size, self.mtime_ns,
+                                    self.offsets.itemsize)
+        temp_path = os.fspath(path) + '.tmp'
+        with open(temp_path, 'wb') as file:
+            file.write(header)
+            file.write(self.tokens)
+            for values in (self.offsets, self.ends, self.parents, self.child_starts, self.children):
+                if sys.byteorder == 'big':
+                    values = values[:]
+                    values.byteswap()
+                file.write(values.tobytes())
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """read an index written by save()"""
+        with open(path, 'rb') as file:
+            data = file.read()
+        try:
+            magic, count, size, mtime_ns, width = _INDEX_HEADER.unpack_from(data)
+            if magic != _INDEX_MAGIC or width not in (4, 8):
+                raise ValueError("not a bplist17 index: %s" % path)
+            unsigned, signed = ('I', 'i') if width == 4 else ('Q', 'q')
+            index = cls.__new__(cls)
+            index.size, index.mtime_ns = size, mtime_ns
+            pos = _INDEX_HEADER.size
+            index.tokens = bytearray(data[pos:pos + count])
+            pos += count
+            for name, typecode, length in (('offsets', unsigned, count), ('ends', unsigned, count),
+                                           ('parents', signed, count), ('child_starts', unsigned, count + 1),
+                                           ('children', unsigned, max(0, count - 1))):
+                values = array.array(typecode)
+                values.frombytes(data[pos:pos + width * length])
+                if len(values) != length:
+                    raise ValueError("truncated bplist17 index: %s" % path)
+                if sys.byteorder == 'big':
+                    values.byteswap()
+                setattr(index, name, values)
+                pos += width * length
+        except struct.error:
+            raise ValueError("not a bplist17 index: %s" % path)
+        return index
+
+    @classmethod
+    def for_file(cls, path, parser=None):
+        """
+        return the index of the bplist17 file at path, from its sidecar file
+        if that is current, otherwise the file is indexed (with parser, or a
+        default one) and the sidecar is written.
+        """
+        index_path = os.fspath(path) + cls.SUFFIX
+        try:
+            index = cls.load(index_path)
+            if index.is_current(path):
+                return index
+        except (OSError, ValueError):
+            pass
+        if parser is None:
+            parser = _BinaryPlist17Parser(dict_type=dict)
+        index = parser.build_index(path)
+        index.save(index_path)
+        return index
+
+_INDEX_MAGIC = b'bp17idx1'
+# magic, number of objects, document size, document mtime_ns, width of the address arrays
+_INDEX_HEADER = struct.Struct('<8sQQQB')
+
+# token -> type name for Plist17Index.histogram()
+_INDEX_TYPE_NAMES = ['unknown'] * 0x100
+for _tokenL in range(0x10):
+    _INDEX_TYPE_NAMES[0x10 | _tokenL] = 'int'
+    _INDEX_TYPE_NAMES[0x40 | _tokenL] = 'data'
+    _INDEX_TYPE_NAMES[0x60 | _tokenL] = 'string_utf16le'
+    _INDEX_TYPE_NAMES[0x70 | _tokenL] = 'string_ascii'
+    _INDEX_TYPE_NAMES[0x80 | _tokenL] = 'reference'
+    _INDEX_TYPE_NAMES[0xF0 | _tokenL] = 'uint'
+for _token, _type in ((0x22, 'float'), (0x23, 'double'), (0xA0, 'array'), (0xB0, 'bool'),
+                      (0xC0, 'bool'), (0xD0, 'dict'), (0xE0, 'null')):
+    _INDEX_TYPE_NAMES[_token] = _type
+del _tokenL, _token, _type
+
+# patterns of _container_digests() and _children_at(): _DIFF_SCALARS matches a
+# scalar with a size given by its token (or by one byte behind it), _DIFF_TOKENS
+# a (possibly empty) run of them (group s), followed by an array or dict header,
+# a reference or a token with a larger size behind it, if any
+_sizes = {}
+for _tokenL in range(0x10):
+    _sizes.setdefault(_tokenL, []).extend((0x10 | _tokenL, 0xF0 | _tokenL))
+    if _tokenL != 0xF:
+        _sizes[_tokenL] += (0x40 | _tokenL, 0x70 | _tokenL)
+        _sizes.setdefault(2 * _tokenL, []).append(0x60 | _tokenL)
+_sizes[0] += (0xB0, 0xC0, 0xE0)
+_sizes[4].append(0x22)
+_sizes[8].append(0x23)
+_DIFF_SCALARS = re.compile(rb'(?s)' + b'|'.join(
+    [b'[%s].{%i}' % (b''.join(b'\\x%02x' % token for token in tokens), size) for size, tokens in sorted(_sizes.items())]
+    # strings and data objects with a one byte size behind their token
+    + [b'\\x%02x\\x11(?:%s)' % (token, b'|'.join(b'\\x%02x.{%i}' % (size, size * width) for size in range(0x100)))
+       for token, width in ((0x7F, 1), (0x6F, 2), (0x4F, 1))]))
+_DIFF_TOKENS = re.compile(
+    rb'(?s)(?=(?P<s>(?:%s)*))(?P=s)'
+    rb'(?:(?P<container>[\xa0-\xaf\xd0-\xdf].{8})|(?P<reference>%s)|(?P<long>[\x4f\x6f\x7f\x8f]))?' % (
+        _DIFF_SCALARS.pattern[4:], b'|'.join(b'\\x%02x.{%i}' % (0x80 | size, size) for size in range(0xF))))
+del _tokenL, _sizes
+
+
+def _open_buffer(source):
+    """
+    Return a flat byte memoryview on source and the mmap backing it, if any.
+
+    source is a bytes-like object, the path of a file to map or a binary
+    file object. Files opened with open() are mapped if possible, BytesIO
+    objects are used without copying, other streams (e.g. of gzip, whose
+    fileno() is the one of the compressed file) are read into memory.
+    """
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(mapped), mapped
+
+    if hasattr(source, 'read'):
+        if isinstance(source, BytesIO):
+            return _open_buffer(source.getbuffer())
+        raw = source.raw if isinstance(source, BufferedReader) else source
+        if isinstance(raw, FileIO) and raw.seekable():
             try:
-                while(self._fp.tell() <= endAddress):
-                    key = self._read_object_at(self._fp.tell(), with_type_info=False)
-                    value = self._read_object_at(self._fp.tell(), with_type_info=with_type_info)
-                    result_value[key] = value
-            except TypeError:
-                raise InvalidFileException()
-            
-            if self._fp.tell() != (endAddress + 1):
-                raise InvalidFileException() # TODO: Descriptive Exception
-            
-            result_value = self._transformDictionary(result_value, with_type_info=with_type_info)
-        
-        elif token == 0xE0:
-            result_type = 'null'
-            result_value = None
+                mapped = mmap.mmap(raw.fileno(), 0, access=mmap.ACCESS_READ)
+                return memoryview(mapped), mapped
+            except (OSError, ValueError):
+                # e.g. an empty file
+                pass
+        # file-like objects without seekable() can still seek, like for the
+        # first versions of parse()
+        seekable = getattr(source, 'seekable', None)
+        if seekable() if seekable is not None else hasattr(source, 'seek'):
+            source.seek(0)
+        return _open_buffer(source.read())
 
-        elif tokenH == 0xF0:
-            result_type = 'uint'
-            result_value = int.from_bytes(self._fp.read(tokenL), 'big', signed=False)
+    buf = memoryview(source)
+    if buf.ndim != 1 or buf.itemsize != 1:
+        buf = buf.cast('B')
+    return buf, None
 
-        else:
-            # raise InvalidFileException()
-            raise TypeError("unsupported type: %s at: %s" % (''.join('{:02x}'.format(x) for x in totalReadBytes), addr))
+def _same_bytes(a, b, chunk_size=1 << 20):
+    """a == b for byte memoryviews, without comparing them item by item"""
+    if len(a) != len(b):
+        return False
+    for pos in range(0, len(a), chunk_size):
+        if a[pos:pos + chunk_size].tobytes() != b[pos:pos + chunk_size].tobytes():
+            return False
+    return True
 
-        if with_type_info:
-            result = self._dict_type()
-            result['type'] = result_type
-            result['value'] = result_value
-            return result
-        else:
-            return result_value
+def _close_buffer(buf, mapped):
+    if buf is not None:
+        buf.release()
+    if mapped is not None:
+        try:
+            mapped.close()
+        except BufferError:
+            # slices are still referenced (e.g. by a traceback), the mapping
+            # is closed as soon as they are garbage collected
+            pass
 
-    def _read_dynamic_size(self, totalReadBytes, tokenL):
-        if tokenL == 0xF:
-            token2 = self._fp.read(1)[0]
-            totalReadBytes.append(token2)
-            length = token2 & 0xF # extract last 4 bits from token2 as length
-            if length != 0 and ((token2 & 0xF0) == 0x10) :
-                size = int.from_bytes(self._fp.read(length), 'little')
-            else:
-                raise TypeError("unsupported type: %s" % ''.join('{:02x}'.format(x) for x in totalReadBytes))
-        else:
-            size = tokenL
-        return size
-    
-    def _transformDictionary(self, dictionary, with_type_info=False):
-        transformed_dict = {}
-        if with_type_info:
-             return dictionary
-        else:
-            class_value = dictionary["$class"]
-            if class_value == "NSDictionary" or class_value == "NSMutableDictionary":
-                transformed_dict["$class"] = class_value
-                keys = dictionary["NS.keys"]
-                objects = dictionary["NS.objects"]
-                for index in range(len(keys)):
-                    transformed_dict[keys[index]] = objects[index]
-                
-                return transformed_dict
-            else:
-                return dictionary
-    
-        
+
+DedupInfo = namedtuple('DedupInfo', ['objects', 'bytes_saved'])
+SizeInfo = namedtuple('SizeInfo', ['objects', 'bytes'])
+
+# kind of deduplicated object for the type names used in known_objects
+_DEDUP_CATEGORIES = {
+    'string': 'string',
+    'string_ascii': 'string',
+    'string_utf16le': 'string',
+    'data': 'data',
+    'array': 'array',
+    'dict': 'dict',
+}
+
+# type names of untyped values for Plist17Stats, as written by _pack_without_type_info()
+_STATS_TYPE_NAMES = {
+    dict: 'dict',
+    list: 'array',
+    tuple: 'array',
+    bool: 'bool',
+    int: 'int',
+    float: 'float',
+    str: 'string_ascii',
+    bytes: 'data',
+    bytearray: 'data',
+    memoryview: 'data',
+    DataReference: 'data',
+    _LazyNestedPlist: 'data',
+    type(None): 'null',
+}
+if numpy is not None:
+    _STATS_TYPE_NAMES[numpy.ndarray] = 'array'
+
+def _scalar_key(value):
+    """hashable key of a scalar value for _BinaryPlist17Writer._structural_key()"""
+    if isinstance(value, float):
+        return ('float', value.hex()) # keeps -0.0 and 0.0 apart
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return ('data', bytes(value))
+    if isinstance(value, _LazyNestedPlist):
+        return ('data', bytes(value.data))
+    if numpy is not None and isinstance(value, numpy.ndarray):
+        return ('ndarray', value.dtype.str, value.shape, value.tobytes())
+    return (type(value).__name__, value) # keeps True and 1 apart
+
+def _fits_float(value):
+    """whether the float value survives being written as float (0x22) instead of double"""
+    try:
+        return struct.pack('<d', struct.unpack('<f', struct.pack('<f', value))[0]) == struct.pack('<d', value)
+    except OverflowError:
+        return False
+
+def _int_width(value):
+    """the number of bytes of the shortest two's complement of the int value, at least one"""
+    return ((~value if value < 0 else value).bit_length() + 8) // 8
+
+def _encode_ndarray(value, optimize=False):
+    """
+    encode the elements of a one-dimensional numpy array like
+    _BinaryPlist17Writer._pack_*() does (with optimize, if set)
+    """
+    kind = value.dtype.kind
+    n = len(value)
+    if kind == 'b':
+        return numpy.where(value, 0xB0, 0xC0).astype('u1').tobytes()
+    if kind == 'f':
+        token, value_format = (0x23, '<f8') if value.dtype.itemsize > 4 else (0x22, '<f4')
+        elements = numpy.empty(n, dtype=[('token', 'u1'), ('value', value_format)])
+        elements['token'] = token
+        elements['value'] = value
+        return elements.tobytes()
+
+    if kind == 'u':
+        # uints in as few bytes as _pack_uint() uses, i.e. each element is
+        # its token followed by the last width bytes of its big-endian uint64
+        values = value.astype('>u8')
+        widths = numpy.ones(n, dtype='u1')
+        for width in range(1, 8):
+            widths += values >= (1 << (8 * width))
+        rows = numpy.empty((n, 9), dtype='u1')
+        rows[:, 0] = 0xF0 | widths
+        rows[:, 1:] = values.view('u1').reshape(n, 8)
+        columns = numpy.arange(9)
+        return rows[(columns == 0) | (columns > 8 - widths[:, None])].tobytes()
+
+    # ints in as few bytes as _pack_int() uses, i.e. each element is its
+    # token followed by the first width bytes of its little-endian int64
+    values = value.astype('<i8')
+    widths = numpy.ones(n, dtype='u1')
+    magnitudes = numpy.where(values < 0, ~values, values) if optimize else values
+    for width in range(1, 8):
+        widths += magnitudes >= (1 << (8 * width - 1))
+    if not optimize:
+        widths[values < 0] = 8
+    tokens = 0x10 | widths
+    rows = numpy.empty((n, 9), dtype='u1')
+    rows[:, 0] = tokens
+    rows[:, 1:] = values.view('u1').reshape(n, 8)
+    return rows[numpy.arange(9) <= widths[:, None]].tobytes()
 
 class _BinaryPlist17Writer:
-    def __init__(self, fp):
+    def __init__(self, fp, deduplicate=None, buffer_size=None, collect_stats=False,
+                 data_source=None, optimize=False):
+        """
+        deduplicate selects the kinds of objects ('string', 'data', 'array'
+        and 'dict') that are written once and referenced (0x80) whenever an
+        identical object is written again, by default strings and dicts.
+
+        By default write() encodes the whole document in memory and writes
+        it at once. With buffer_size set, encoded objects are written to fp
+        as soon as more than buffer_size bytes are pending, and the end
+        addresses of arrays and dicts that were flushed already are patched
+        by seeking back, so fp has to be seekable. The output is the same.
+
+        If collect_stats is set, write() counts objects, bytes and encoding
+        time per type in self.stats (see Plist17Stats).
+
+        Data objects can be given in every form the parser returns them
+        (see data_mode of _BinaryPlist17Parser). DataReference values are
+        read from data_source, the buffer of the document they were parsed
+        from.
+
+        With optimize, the output is made as small as possible without
+        changing what the parser returns for it: ints are written in as few
+        bytes as they need (negative ones included), floats without type
+        info as float if that is lossless and as double otherwise, strings
+        without type info as UTF-16 if they are not ASCII, and ASCII strings
+        without their NUL terminator. All kinds of objects are deduplicated
+        (unless deduplicate is given), but a repeated object is only written
+        as reference if that is shorter than another copy of it. Typed
+        values keep their type, and objects of a document parsed with
+        preserve_layout are copied as they are unless modified.
+        size_info() reports the encoded size per type.
+        """
+        if deduplicate is None:
+            deduplicate = _DEDUP_CATEGORIES.values() if optimize else ('string', 'dict')
+        unknown = set(deduplicate) - set(_DEDUP_CATEGORIES.values())
+        if unknown:
+            raise ValueError("unsupported deduplication type(s): %s" % ', '.join(sorted(unknown)))
         self._fp = fp
+        self._deduplicate = frozenset(deduplicate)
+        self._buffer_size = buffer_size
+        self._data_source = data_source
+        self._optimize = optimize
         self.known_objects = {}
+        self._dedup_stats = {}
+        self.stats = Plist17Stats() if collect_stats else None
+        # counters of the last write(), for size_info()
+        self._write_stats = None
+        if collect_stats or optimize:
+            # instrumented versions replace the methods on this instance only
+            self._pack = self._pack_with_stats
+            self._pack_reference = self._pack_reference_with_stats
+            self._stats_frames = []
+
+    def deduplication_info(self):
+        """return a DedupInfo(objects, bytes_saved) per kind of object for the last write()"""
+        info = {category: DedupInfo(0, 0) for category in sorted(self._deduplicate)}
+        for type, (objects, bytes_saved) in self._dedup_stats.items():
+            category = _DEDUP_CATEGORIES[type]
+            info[category] = DedupInfo(info[category].objects + objects, info[category].bytes_saved + bytes_saved)
+        return info
+
+    def size_info(self):
+        """
+        return a SizeInfo(objects, bytes) per type ('reference' for
+        references) of the last write(), or None unless the writer was
+        created with optimize or collect_stats. Arrays and dicts count their
+        9 byte header only, so the sizes add up to the size of the document
+        without its 8 byte header.
+        """
+        stats = self._write_stats
+        if stats is None:
+            return None
+        return {type: SizeInfo(stats.objects[type], stats.bytes[type]) for type in sorted(stats.objects)}
     
     def write(self, value, with_type_info=False):
-        plist_bytes = 'bplist17'.encode()
-        current_position = len(plist_bytes)
-        value_bytes = self._pack(value=value, position=current_position, with_type_info=with_type_info)
+        if self.stats is not None or self._optimize:
+            return self._write_with_stats(value, with_type_info=with_type_info)
+        self._begin_document()
+        self._pack(value=value, with_type_info=with_type_info)
+        self._end_document()
+        return self._fp
 
-        self._fp.write(plist_bytes + value_bytes)
+    def _write_with_stats(self, value, with_type_info=False):
+        stats = self._write_stats = Plist17Stats()
+        start = time.perf_counter()
+        self._stats_frames = []
+        try:
+            self._begin_document()
+            self._pack(value=value, with_type_info=with_type_info)
+            self._end_document()
+        finally:
+            stats.seconds += time.perf_counter() - start
+        stats.documents += 1
+        for kind, info in self.deduplication_info().items():
+            stats.bytes_saved[kind] = stats.bytes_saved.get(kind, 0) + info.bytes_saved
+        if self.stats is not None:
+            self.stats.update(stats)
         return self._fp
-    
-    def _pack_dict(self, value, position, with_type_info):
-        element_bytes = bytes()
-        curr_position = position + 9
-        for key, val in value.items():
-            element_bytes = element_bytes + self._pack(key, position=curr_position+len(element_bytes), with_type_info=False)
-            element_bytes = element_bytes + self._pack(val, position=curr_position+len(element_bytes), with_type_info=with_type_info)
-    
-        previous_instance_position = self._get_previous_instance_position(json.dumps(value), position=position, type='dict')
+
+    def _begin_document(self):
+        self.known_objects = {}
+        self._dedup_stats = {}
+        self._instance_sizes = {}
+        self._structural_keys = {}
+        self._interned = {}
+        self._source_copies = {}
+        if self._buffer_size is not None and not self._fp.seekable():
+            raise ValueError("writing with a buffer_size requires a seekable output")
+        self._base = self._fp.tell() if self._buffer_size is not None else 0
+        self._flushed = 0
+        # objects are encoded into a growing buffer, the end addresses of
+        # arrays and dicts are patched in once their children are written
+        self._out = bytearray('bplist17'.encode())
+
+    def _end_document(self):
+        self._flush()
+        self._out = None
+        self._structural_keys = self._interned = self._source_copies = None
+
+    def _tell(self):
+        """return the position the next object is written at"""
+        return self._flushed + len(self._out)
+
+    def _emit(self, data):
+        buffer_size = self._buffer_size
+        if buffer_size is None:
+            self._out += data
+        elif len(data) >= buffer_size:
+            # e.g. large data objects, bypass the buffer
+            self._flush()
+            self._fp.write(data)
+            self._flushed += len(data)
+        else:
+            self._out += data
+            if len(self._out) >= buffer_size:
+                self._flush()
+
+    def _flush(self):
+        """write the pending bytes to fp"""
+        if self._out:
+            self._fp.write(self._out)
+            self._flushed += len(self._out)
+            self._out = bytearray()
+
+    def _patch(self, position, data):
+        """overwrite already emitted bytes at position"""
+        flushed = self._flushed
+        if position < flushed:
+            # (partly) written to fp already
+            in_file = data[:flushed - position]
+            self._fp.seek(self._base + position)
+            self._fp.write(in_file)
+            self._fp.seek(self._base + flushed)
+            data = data[len(in_file):]
+            position = flushed
+        position -= flushed
+        self._out[position:position + len(data)] = data
+
+    def _pack_dict(self, value, with_type_info):
+        previous_instance_position = self._find_previous_instance(value, type='dict', with_type_info=with_type_info)
         if previous_instance_position is not None :
-            return self._pack_addr(previous_instance_position)
-        size = len(element_bytes)
-        endposition = curr_position +  size - 1
-        header_bytes = b'\xD0' + endposition.to_bytes(length=8, byteorder='little')
-        return header_bytes + element_bytes
-
-    def _pack_array(self, value, position, with_type_info):
-        element_bytes = bytes()
-        curr_position = position + 9
-        for element in value:
-            element_bytes = element_bytes + self._pack(element, position=curr_position+len(element_bytes), with_type_info=with_type_info)
-        
-        size = len(element_bytes)
-        endposition = curr_position +  size - 1
-        header_bytes = b'\xA0' + endposition.to_bytes(length=8, byteorder='little')
+            self._pack_reference(previous_instance_position, type='dict')
+            return
+
+        position = self._tell()
+        self._emit(b'\xD0' + bytes(8)) # end address follows below
+        if isinstance(value, _SourceNode):
+            self._pack_children(value, with_type_info)
+        else:
+            for key, val in value.items():
+                self._pack(key, with_type_info=False)
+                self._pack(val, with_type_info=with_type_info)
+        endposition = self._tell() - 1
+        self._patch(position + 1, endposition.to_bytes(length=8, byteorder='little'))
+        self._remember_size(position, type='dict')
+
+    def _pack_array(self, value, with_type_info):
+        previous_instance_position = self._find_previous_instance(value, type='array', with_type_info=with_type_info)
+        if previous_instance_position is not None :
+            self._pack_reference(previous_instance_position, type='array')
+            return
 
-        return header_bytes + element_bytes
+        position = self._tell()
+        self._emit(b'\xA0' + bytes(8)) # end address follows below
+        if isinstance(value, _SourceNode):
+            self._pack_children(value, with_type_info)
+        else:
+            for element in value:
+                self._pack(element, with_type_info=with_type_info)
+        endposition = self._tell() - 1
+        self._patch(position + 1, endposition.to_bytes(length=8, byteorder='little'))
+        self._remember_size(position, type='array')
     
+    def _pack_ndarray(self, value):
+        """
+        write a numpy array like the list of its elements. One-dimensional
+        arrays of bools, ints and floats are encoded in one step, with
+        unsigned ints as uint, float64 as double and smaller floats as float.
+        Unlike the floats of a list written without type info, which are
+        written as float, float64 elements thus keep their precision.
+        """
+        if value.ndim != 1 or value.dtype.kind not in 'biuf':
+            self._pack_array(value.tolist(), with_type_info=False)
+            return
+        previous_instance_position = self._find_previous_instance(value, type='array')
+        if previous_instance_position is not None :
+            self._pack_reference(previous_instance_position, type='array')
+            return
+
+        position = self._tell()
+        self._emit(b'\xA0' + bytes(8)) # end address follows below
+        self._emit(_encode_ndarray(value, optimize=self._optimize))
+        endposition = self._tell() - 1
+        self._patch(position + 1, endposition.to_bytes(length=8, byteorder='little'))
+        self._remember_size(position, type='array')
+
     def _pack_int(self, value):
 
         if value < 0:
             if value < -2**63:
                 raise ValueError("value: %i out of range of int64" % value)
+            elif self._optimize:
+                buff_size = _int_width(value)
             else:
                 buff_size = 8
+        elif self._optimize:
+            buff_size = _int_width(value)
         else:
             buff_size = math.ceil((math.log(value + 1, 2) + 1) / 8)
 
@@ -309,9 +3202,10 @@ class _BinaryPlist17Writer:
         return value_bytes
 
     def _pack_uint(self, value):
-        buff_size = max(1, math.ceil((math.log(value + 1, 2)) / 8))
+        # unlike ints, uints are big-endian (see _decode_uint_at())
+        buff_size = max(1, (value.bit_length() + 7) // 8)
 
-        value_bytes = self._calc_datatype_prefix(datatype=0xF0, size=buff_size) + value.to_bytes(buff_size, byteorder='little', signed=False)
+        value_bytes = self._calc_datatype_prefix(datatype=0xF0, size=buff_size) + value.to_bytes(buff_size, byteorder='big', signed=False)
         return value_bytes
 
     def _pack_float(self, value):
@@ -330,7 +3224,9 @@ class _BinaryPlist17Writer:
         return b'\xE0'
 
     def _pack_str_ascii(self, value):
-        str_bytes = value.encode(encoding='utf-8') + b'\x00'
+        str_bytes = value.encode(encoding='utf-8')
+        if not self._optimize:
+            str_bytes += b'\x00'
         return self._calc_datatype_prefix(datatype=0x70, size=len(str_bytes)) + str_bytes
     
     def _pack_str_utf16le(self, value):
@@ -340,114 +3236,450 @@ class _BinaryPlist17Writer:
     def _pack_data(self, value):
         return self._calc_datatype_prefix(datatype=0x40, size=len(value)) + value
     
+    def _pack_string(self, value, type):
+        """write value as string of type ('string' or 'string_ascii' for ascii, or 'string_utf16le'), deduplicated"""
+        previous_instance_position = self._find_previous_instance(value, type=type)
+        if previous_instance_position is not None :
+            self._pack_reference(previous_instance_position, type=type)
+            return
+        position = self._tell()
+        if type == 'string_utf16le' or (type == 'string' and self._optimize and not value.isascii()):
+            self._emit(self._pack_str_utf16le(value=value))
+        else:
+            self._emit(self._pack_str_ascii(value=value))
+        self._remember_size(position, type=type)
+
+    def _pack_data_once(self, value):
+        previous_instance_position = self._find_previous_instance(value, type='data')
+        if previous_instance_position is not None :
+            self._pack_reference(previous_instance_position, type='data')
+            return
+        position = self._tell()
+        # like _pack_data(), without copying value
+        self._emit(self._calc_datatype_prefix(datatype=0x40, size=len(value)))
+        self._emit(value)
+        self._remember_size(position, type='data')
+
     def _pack_addr(self, value):
         addr_length = math.ceil(math.log(value + 1, 2) / 8)
         addr_bytes = value.to_bytes(length=addr_length, byteorder='little')
         return self._calc_datatype_prefix(datatype=0x80, size=addr_length) + addr_bytes
     
     def _get_previous_instance_position(self, value, position, type):
-        if isinstance(value, (str, bytes)):
-            objects_with_type = self.known_objects.get(type)
-            if objects_with_type is None:
-                objects_with_type = {}
-                self.known_objects[type] = objects_with_type
-            
-            previous_instance_position = objects_with_type.get(value, None)
-            if previous_instance_position is not None:
-                return previous_instance_position
+        objects_with_type = self.known_objects.get(type)
+        if objects_with_type is None:
+            objects_with_type = {}
+            self.known_objects[type] = objects_with_type
+
+        previous_instance_position = objects_with_type.get(value, None)
+        if previous_instance_position is not None:
+            return previous_instance_position
+        else:
+            self.known_objects[type][value] = position
+            return None
+
+    def _find_previous_instance(self, value, type, with_type_info=False):
+        """
+        return the position of an identical object of type that was written
+        before, or None if there is none (or type is not deduplicated). In
+        the latter case value is remembered at the current position.
+        """
+        if _DEDUP_CATEGORIES[type] not in self._deduplicate:
+            return None
+        if type == 'array' or type == 'dict':
+            key = self._structural_key(value, with_type_info=with_type_info, container=True)
+        elif type == 'data':
+            # digest instead of a copy of the data, blobs may be large
+            key = (len(value), hashlib.blake2b(value, digest_size=16).digest())
+        else:
+            key = value
+        position = self._get_previous_instance_position(key, position=self._tell(), type=type)
+        if position is not None and self._optimize and position in self._instance_sizes \
+                and len(self._pack_addr(position)) >= self._instance_sizes[position]:
+            # another copy is not longer than the reference
+            return None
+        return position
+
+    def _remember_size(self, position, type):
+        """record the size of the first instance written at position, for deduplication_info()"""
+        if _DEDUP_CATEGORIES[type] in self._deduplicate:
+            self._instance_sizes[position] = self._tell() - position
+
+    def _pack_reference(self, position, type):
+        addr_bytes = self._pack_addr(position)
+        self._emit(addr_bytes)
+        stats = self._dedup_stats.get(type)
+        if stats is None:
+            stats = self._dedup_stats[type] = [0, 0]
+        stats[0] += 1
+        stats[1] += self._instance_sizes[position] - len(addr_bytes)
+
+    def _pack_source(self, document, start, end, reference=True):
+        """
+        write the object at start:end of a document parsed with
+        preserve_layout by copying its bytes, or a reference to an earlier
+        copy of it (unless reference is False). The end addresses of arrays
+        and dicts and the 0x80 references in it are rebased, references to
+        objects which were not copied are replaced by a copy of them.
+        """
+        if reference:
+            position = self._map_source(document, start)
+            if position is not None:
+                # copied before, e.g. the object behind a reference
+                self._emit(self._pack_addr(position))
+                return
+        buf, parser = document.buf, document.parser
+        out_start = self._tell()
+        offset = shift = out_start - start
+        # source addresses behind references whose size changed, and the
+        # offset of the output from the source from there on
+        marks, shifts = [], []
+        # the copy is collected in out, which starts at out_base of the output
+        out, out_base = bytearray(), out_start
+        cursor = start
+        references = document.references
+        for i in range(bisect.bisect_left(references, start), bisect.bisect_left(references, end)):
+            ref = references[i]
+            size, pos = parser._decode_dynamic_size(ref, ref + 1, buf[ref] & 0x0F)
+            target = int.from_bytes(buf[pos:pos + size], 'little')
+            behind = pos + size
+            if start <= target < ref:
+                new_target = target + _shift_at(marks, shifts, offset, target)
+            else:
+                new_target = self._map_source(document, target)
+            out += buf[cursor:ref]
+            cursor = behind
+            if new_target is not None:
+                out += self._pack_addr(new_target)
+            else:
+                self._emit(out)
+                self._pack_source(document, target, parser._skip_object_at(target))
+                out, out_base = bytearray(), self._tell()
+            if out_base + len(out) - behind != shift:
+                shift = out_base + len(out) - behind
+                marks.append(behind)
+                shifts.append(shift)
+        out += buf[cursor:end]
+
+        if marks or offset:
+            containers = document.containers
+            for i in range(bisect.bisect_left(containers, start), bisect.bisect_left(containers, end)):
+                container = containers[i]
+                container_end = int.from_bytes(buf[container + 1:container + 9], 'little') + 1
+                position = container + _shift_at(marks, shifts, offset, container) + 1 - out_base
+                new_end = (container_end + _shift_at(marks, shifts, offset, container_end) - 1).to_bytes(8, 'little')
+                if position >= 0:
+                    out[position:position + 8] = new_end
+                else:
+                    # emitted before an object behind a reference was copied
+                    self._patch(position + out_base, new_end)
+        self._emit(out)
+
+        copies = self._source_copies.get(document)
+        if copies is None:
+            copies = self._source_copies[document] = ([], [])
+        starts, entries = copies
+        if not starts or start > starts[-1]:
+            starts.append(start)
+            entries.append((end, offset, marks, shifts))
+        else:
+            i = bisect.bisect_right(starts, start)
+            starts.insert(i, start)
+            entries.insert(i, (end, offset, marks, shifts))
+
+    def _pack_children(self, value, with_type_info):
+        """
+        write the elements of the array or the items of the dict value,
+        which was parsed with preserve_layout. Unmodified children in a row
+        are copied at once, together with the keys between them if these
+        are unchanged.
+        """
+        is_dict = isinstance(value, dict)
+        # the first child of the next copy, and (document, start, end) of it
+        first = run = None
+        for item in (value.items() if is_dict else value):
+            if is_dict:
+                key, child = item
+            else:
+                child = item
+            source = child._source if isinstance(child, _SourceNode) else None
+            if run is not None:
+                if source is not None and source[0] is run[0]:
+                    if is_dict:
+                        # the key in between is part of the copy
+                        following = False
+                        if run[0].buf[run[2]] & 0xF0 in (0x60, 0x70, 0x80):
+                            try:
+                                source_key, behind = run[0].parser._decode_key_at(run[2])
+                                following = source_key == key and type(source_key) is type(key) and behind == source[1]
+                            except _LAZY_ERRORS + (TypeError, KeyError):
+                                pass
+                    else:
+                        following = source[1] == run[2]
+                    if following:
+                        run[2] = source[2]
+                        first = None
+                        continue
+                if first is not None:
+                    self._pack(first, with_type_info=with_type_info)
+                else:
+                    self._pack_source(*run, reference=False)
+                run = None
+            if is_dict:
+                self._pack(key, with_type_info=False)
+            if source is not None:
+                first, run = child, list(source)
+            else:
+                self._pack(child, with_type_info=with_type_info)
+        if run is not None:
+            if first is not None:
+                self._pack(first, with_type_info=with_type_info)
+            else:
+                self._pack_source(*run, reference=False)
+
+    def _map_source(self, document, address):
+        """return the position the object at address of document was copied to, or None"""
+        copies = self._source_copies.get(document)
+        if copies is None:
+            return None
+        starts, entries = copies
+        i = bisect.bisect_right(starts, address) - 1
+        if i < 0:
+            return None
+        end, offset, marks, shifts = entries[i]
+        if address >= end:
+            return None
+        i = bisect.bisect_right(marks, address)
+        return address + (shifts[i - 1] if i else offset)
+
+    def _pack_with_stats(self, value, with_type_info):
+        """_pack() for writers with collect_stats or optimize set, counts value without its children"""
+        stats = self._write_stats
+        frames = self._stats_frames
+        if with_type_info:
+            type_name = _typed_parts(value)[0]
+        else:
+            type_name = _STATS_TYPE_NAMES.get(type(value), type(value).__name__)
+            if self._optimize:
+                if type_name == 'float' and not _fits_float(value):
+                    type_name = 'double'
+                elif type_name == 'string_ascii' and not value.isascii():
+                    type_name = 'string_utf16le'
+        # only arrays and dicts have children, so all open frames are theirs
+        if (type_name == 'array' or type_name == 'dict') and len(frames) >= stats.max_depth:
+            stats.max_depth = len(frames) + 1
+        # bytes and time of the children, whether value was written as reference
+        frame = [0, 0.0, False]
+        frames.append(frame)
+        position = self._tell()
+        start = time.perf_counter()
+        try:
+            _BinaryPlist17Writer._pack(self, value, with_type_info)
+        finally:
+            frames.pop()
+        seconds = time.perf_counter() - start
+        size = self._tell() - position
+        if frames:
+            frames[-1][0] += size
+            frames[-1][1] += seconds
+        stats._count('reference' if frame[2] else type_name, size - frame[0], seconds - frame[1])
+
+    def _pack_reference_with_stats(self, position, type):
+        _BinaryPlist17Writer._pack_reference(self, position, type)
+        self._write_stats.dereferences += 1
+        self._stats_frames[-1][2] = True
+
+    def _structural_key(self, value, with_type_info, container=False):
+        """
+        return an int which is equal for two values exactly if they have the
+        same encoding (references aside).
+
+        The key of an array or dict is interned from the keys of its
+        children, so each node is hashed once, bottom-up, and keys are
+        memoized per object. With with_type_info, value is a typed node, or
+        for container=True, the children of value are.
+        """
+        if isinstance(value, _SourceNode) and value._source is not None:
+            # written by copying its source, see _pack_source()
+            structure = ('source', with_type_info and not container) + value._source
+            return self._interned.setdefault(structure, len(self._interned))
+        if container or (not with_type_info and isinstance(value, (dict, list, tuple))):
+            if numpy is not None and isinstance(value, numpy.ndarray):
+                return self._interned.setdefault(_scalar_key(value), len(self._interned))
+            entry = self._structural_keys.get(id(value))
+            if entry is not None:
+                return entry[1]
+            structural_key = self._structural_key
+            if isinstance(value, dict):
+                parts = ['dict', with_type_info]
+                children = []
+                for k, v in value.items():
+                    parts.append(k if type(k) is str else structural_key(k, False))
+                    children.append(v)
+            else:
+                parts = ['array', with_type_info]
+                children = value
+            for v in children:
+                # strings are their own key, containers and typed nodes have int keys
+                t = type(v)
+                if t is str:
+                    parts.append(v)
+                elif with_type_info or t is dict or t is list or t is tuple or isinstance(v, (dict, list, tuple)):
+                    parts.append(structural_key(v, with_type_info))
+                else:
+                    parts.append(_scalar_key(v))
+            key = self._interned.setdefault(tuple(parts), len(self._interned))
+            # keep value alive, so its id is not reused by another object during write()
+            self._structural_keys[id(value)] = (value, key)
+            return key
+
+        if with_type_info:
+            type_def, contained_value = _typed_parts(value)
+            if type_def == 'array' or type_def == 'dict':
+                structure = ('typed', type_def, self._structural_key(contained_value, True, container=True))
+            elif isinstance(contained_value, _LazyNestedPlist):
+                structure = ('typed', type_def, _scalar_key(contained_value.data))
+            elif type_def == 'data.bplist17':
+                # the nested document is a typed node itself
+                structure = ('typed', type_def, self._structural_key(contained_value, True))
+            elif type_def == 'data.bplist00':
+                structure = ('typed', type_def, self._structural_key(contained_value, False))
             else:
-                self.known_objects[type][value] = position
-                return None
+                structure = ('typed', type_def, _scalar_key(contained_value))
+        else:
+            structure = _scalar_key(value)
+        return self._interned.setdefault(structure, len(self._interned))
 
-    def _pack(self, value, position, with_type_info):
+    def _pack(self, value, with_type_info):
         if with_type_info:
-            return self._pack_with_type_info(value=value, position=position)
+            self._pack_with_type_info(value=value)
         else:
-            return self._pack_without_type_info(value=value, position=position)
+            self._pack_without_type_info(value=value)
         
-    def _pack_without_type_info(self, value, position):
+    def _pack_without_type_info(self, value):
         if isinstance(value, dict):
+            if isinstance(value, _SourceNode) and value._source is not None:
+                self._pack_source(*value._source)
+                return
             transformed_value = self._transformDictionary(value, with_type_info=False)
-            return self._pack_dict(value=transformed_value, position=position, with_type_info=False)
+            self._pack_dict(value=transformed_value, with_type_info=False)
+
+        elif isinstance(value, DataReference):
+            self._pack_data_once(self._data_bytes('data.reference', value))
 
         elif isinstance(value, (list, tuple)):
-            return self._pack_array(value=value, position=position, with_type_info=False)
+            if isinstance(value, _SourceNode) and value._source is not None:
+                self._pack_source(*value._source)
+                return
+            self._pack_array(value=value, with_type_info=False)
         
         elif isinstance(value, bool):
-            return self._pack_bool(value=value)
+            self._emit(self._pack_bool(value=value))
 
         elif isinstance(value, int):
-            return self._pack_int(value=value)
+            self._emit(self._pack_int(value=value))
 
         elif isinstance(value, float):
             # TODO float or double depending on parsing/specification TBD
-            return self._pack_float(value=value)
-            # return self._pack_double(value=value)
+            # (numpy float64 arrays are written as doubles, see _pack_ndarray())
+            if self._optimize and not _fits_float(value):
+                self._emit(self._pack_double(value=value))
+            else:
+                self._emit(self._pack_float(value=value))
 
         elif isinstance(value, str):
-            previous_instance_position = self._get_previous_instance_position(value, position=position, type='string')
-            if previous_instance_position is not None :
-                return self._pack_addr(previous_instance_position)
             # TODO ascii or utf-16le depending on parsing/specification TBD
-            return self._pack_str_ascii(value=value)
+            self._pack_string(value, type='string')
         
-        elif isinstance(value, (bytes, bytearray)):
-            return self._pack_data(value=value)
+        elif isinstance(value, (bytes, bytearray, memoryview)):
+            self._pack_data_once(self._data_bytes('data.bytes', value))
 
         elif value is None:
-            return self._pack_null()
+            self._emit(self._pack_null())
+
+        elif isinstance(value, _LazyNestedPlist):
+            self._pack_data_once(value.data)
+
+        elif numpy is not None and isinstance(value, numpy.ndarray):
+            self._pack_ndarray(value)
 
         else:
             raise TypeError("unsupported value type: %s" % (type(value)))
         
             
-    def _pack_with_type_info(self, value, position):
-        type_def = value.get('type')
-        contained_value = value.get('value')
+    def _pack_with_type_info(self, value):
+        if isinstance(value, _SourceNode) and value._source is not None:
+            self._pack_source(*value._source)
+            return
+        type_def, contained_value = _typed_parts(value)
 
         types = type_def.split('.')
         
         if types[0] == 'int':
-            return self._pack_int(value=contained_value)
+            self._emit(self._pack_int(value=contained_value))
         elif types[0] == 'float':
-            return self._pack_float(value=contained_value)
+            self._emit(self._pack_float(value=contained_value))
         elif types[0] == 'double':
-            return self._pack_double(value=contained_value)
+            self._emit(self._pack_double(value=contained_value))
         elif types[0] == 'data':
-            # TODO handle data
-            print('handle data')
-            if types[1] == 'hexstring':
-                return self._pack_data(bytes.fromhex(contained_value))
-            else:
-                print('handle %s' % type_def)
+            self._pack_data_once(self._data_bytes(type_def, contained_value))
         elif types[0] == 'string_utf16le':
-            previous_instance_position = self._get_previous_instance_position(contained_value, position=position, type=types[0])
-            if previous_instance_position is not None :
-                return self._pack_addr(previous_instance_position)
-            return self._pack_str_utf16le(value=contained_value)
+            self._pack_string(contained_value, type=types[0])
         elif types[0] == 'string_ascii':
-            previous_instance_position = self._get_previous_instance_position(contained_value, position=position, type=types[0])
-            if previous_instance_position is not None :
-                return self._pack_addr(previous_instance_position)
-            return self._pack_str_ascii(value=contained_value)
+            self._pack_string(contained_value, type=types[0])
         elif types[0] == 'array':
-            return self._pack_array(value=contained_value, position=position, with_type_info=True)
+            if numpy is not None and isinstance(contained_value, numpy.ndarray):
+                self._pack_ndarray(contained_value)
+            else:
+                self._pack_array(value=contained_value, with_type_info=True)
         elif types[0] == 'bool':
-            return self._pack_bool(value=contained_value)
+            self._emit(self._pack_bool(value=contained_value))
         elif types[0] == 'dict':
-            return self._pack_dict(value=contained_value, position=position, with_type_info=True)
+            self._pack_dict(value=contained_value, with_type_info=True)
         elif types[0] == 'null':
-            return self._pack_null()
+            self._emit(self._pack_null())
         elif types[0] == 'uint':
-            return self._pack_uint(value=contained_value)
+            self._emit(self._pack_uint(value=contained_value))
         else:
             raise TypeError('unsupported value type %s' % types[0])
     
+    def _data_bytes(self, type_def, value):
+        """return the content of a data object of type type_def ('data.hexstring', ...) as bytes-like object"""
+        if type_def == 'data.hexstring':
+            return bytes.fromhex(value)
+        elif type_def == 'data.base64':
+            return base64.b64decode(value, validate=True)
+        elif type_def == 'data.bytes' or type_def == 'data.memoryview':
+            if isinstance(value, memoryview) and (value.ndim != 1 or value.itemsize != 1):
+                value = value.cast('B')
+            if not isinstance(value, (bytes, bytearray, memoryview)):
+                raise TypeError("value of %s must be bytes-like, not %s" % (type_def, type(value).__name__))
+            return value
+        elif type_def == 'data.bplist17' or type_def == 'data.bplist00':
+            if isinstance(value, _LazyNestedPlist):
+                # not parsed, so not modified either
+                return value.data
+            if type_def == 'data.bplist00':
+                return plistlibDumps(value, fmt=FMT_BINARY, sort_keys=False)
+            fp = BytesIO()
+            _BinaryPlist17Writer(fp, deduplicate=self._deduplicate, optimize=self._optimize).write(value, with_type_info=True)
+            return fp.getvalue()
+        elif type_def == 'data.reference':
+            if self._data_source is None:
+                raise ValueError("writing a DataReference requires a data_source")
+            offset, length = value
+            data = memoryview(self._data_source)[offset:offset + length]
+            if len(data) != length:
+                raise ValueError("DataReference(%i, %i) is out of range of the data_source" % (offset, length))
+            return data
+        else:
+            raise TypeError('unsupported value type %s' % type_def)
+
     def _calc_datatype_prefix(self, datatype, size):
         if size < 0xF:
             return (datatype | size).to_bytes(length=1, byteorder='little')
         else:
-            return (datatype | 0x0F).to_bytes(length=1, byteorder='little') + self._pack(size, position=0, with_type_info=False)
+            return (datatype | 0x0F).to_bytes(length=1, byteorder='little') + self._pack_int(size)
         
     def _transformDictionary(self, dictionary: dict, with_type_info=False):
         transformed_dict = {}
@@ -468,3 +3700,142 @@ class _BinaryPlist17Writer:
                 return transformed_dict
             else:
                 return dictionary
+
+
+
+class _BinaryPlist17Builder:
+    """
+    Write a bplist17 document object by object instead of from a complete
+    Python tree, e.g.
+
+        builder = _BinaryPlist17Builder(fp)
+        builder.begin_dict()
+        builder.key('$class')
+        builder.string_ascii('Records')
+        builder.key('records')
+        builder.begin_array()
+        for record in records:
+            builder.value(record)
+        builder.end()
+        builder.end()
+        builder.close()
+
+    Objects are encoded with the _pack_* methods of _BinaryPlist17Writer in
+    its streaming mode (see buffer_size there), so fp has to be seekable.
+    Containers opened with begin_dict()/begin_array() are not deduplicated,
+    values passed to value() are, according to deduplicate. Strings are
+    deduplicated by default, as deduplicating arrays and dicts has to keep
+    a key for each of them.
+    """
+
+    def __init__(self, fp, deduplicate=('string',), buffer_size=1 << 16):
+        self._writer = _BinaryPlist17Writer(fp, deduplicate=deduplicate, buffer_size=buffer_size)
+        self._writer._begin_document()
+        # open containers as [token, position, key expected]
+        self._stack = []
+        self._root_written = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+    def _before_value(self):
+        if self._stack:
+            frame = self._stack[-1]
+            if frame[2]:
+                raise ValueError("expected a key in the dict at %i, not a value" % frame[1])
+            if frame[0] == 0xD0:
+                frame[2] = True
+        elif self._root_written:
+            raise ValueError("the document already has a root object")
+        else:
+            self._root_written = True
+
+    def begin_dict(self):
+        self._begin(0xD0)
+
+    def begin_array(self):
+        self._begin(0xA0)
+
+    def _begin(self, token):
+        self._before_value()
+        writer = self._writer
+        self._stack.append([token, writer._tell(), token == 0xD0])
+        writer._emit(token.to_bytes(1, 'little') + bytes(8)) # end address is patched by end()
+
+    def end(self):
+        """close the innermost array or dict"""
+        if not self._stack:
+            raise ValueError("no open array or dict")
+        token, position, key_expected = self._stack[-1]
+        if token == 0xD0 and not key_expected:
+            raise ValueError("the dict at %i has a key without value" % position)
+        self._stack.pop()
+        writer = self._writer
+        endposition = writer._tell() - 1
+        writer._patch(position + 1, endposition.to_bytes(length=8, byteorder='little'))
+
+    def key(self, key):
+        """write the key of the next dict entry, followed by its value"""
+        if not self._stack or self._stack[-1][0] != 0xD0 or not self._stack[-1][2]:
+            raise ValueError("a key can only be written in a dict, before a value")
+        self._stack[-1][2] = False
+        self._writer._pack(key, with_type_info=False)
+        self._writer._structural_keys.clear()
+
+    def value(self, value, with_type_info=False):
+        """write a complete value, like _BinaryPlist17Writer.write() does"""
+        self._before_value()
+        self._writer._pack(value, with_type_info=with_type_info)
+        # the objects of value are done, don't keep them alive
+        self._writer._structural_keys.clear()
+
+    def int(self, value):
+        self._before_value()
+        self._writer._emit(self._writer._pack_int(value))
+
+    def uint(self, value):
+        self._before_value()
+        self._writer._emit(self._writer._pack_uint(value))
+
+    def float(self, value):
+        self._before_value()
+        self._writer._emit(self._writer._pack_float(value))
+
+    def double(self, value):
+        self._before_value()
+        self._writer._emit(self._writer._pack_double(value))
+
+    def bool(self, value):
+        self._before_value()
+        self._writer._emit(self._writer._pack_bool(value))
+
+    def null(self):
+        self._before_value()
+        self._writer._emit(self._writer._pack_null())
+
+    def string_ascii(self, value):
+        self._before_value()
+        self._writer._pack_string(value, type='string_ascii')
+
+    def string_utf16le(self, value):
+        self._before_value()
+        self._writer._pack_string(value, type='string_utf16le')
+
+    def data(self, value):
+        self._before_value()
+        self._writer._pack_data_once(value)
+
+    def close(self):
+        """finish the document, all arrays and dicts have to be closed"""
+        if self._stack:
+            raise ValueError("%i array(s)/dict(s) are still open" % len(self._stack))
+        if not self._root_written:
+            raise ValueError("the document has no root object")
+        self._writer._end_document()
+
+    def deduplication_info(self):
+        return self._writer.deduplication_info()
@@ -27,10 +27,14 @@ setup(
     url='https://github.com/hwingb/plist17lib',
     py_modules=['plist17lib'],
     packages=find_packages(),
+    extras_require={
+        'numpy': ['numpy'],
+    },
     entry_points={
         'console_scripts': [
                 'bplist17-parser=cli.run_parser:main',
                 'bplist17-writer=cli.create_binary:main',
+                'bplist17-diff=cli.run_diff:main',
             ]
     }
 )
\ No newline at end of file
@@ -0,0 +1,26 @@
+import json
+
+import pytest
+
+from cli.create_binary import create_from_json
+
+
+def test_failed_conversion_leaves_no_output(tmp_path):
+    json_path = tmp_path / 'item.json'
+    json_path.write_text(json.dumps({'type': 'dict', 'value': {
+        'count': {'type': 'int', 'value': 1},
+        'broken': {'type': 'no such type', 'value': 1},
+    }}))
+    plist_path = tmp_path / 'item.bplist17'
+    plist_path.write_bytes(b'previous output')
+    with pytest.raises(TypeError):
+        create_from_json(str(json_path), str(plist_path), True)
+    assert not plist_path.exists()
+
+
+def test_conversion_writes_output(tmp_path):
+    json_path = tmp_path / 'item.json'
+    json_path.write_text(json.dumps({'$class': 'Item', 'count': 1}))
+    plist_path = tmp_path / 'item.bplist17'
+    create_from_json(str(json_path), str(plist_path), False)
+    assert plist_path.read_bytes().startswith(b'bplist17')
@@ -0,0 +1,30 @@
+from io import BytesIO, StringIO
+
+import pytest
+from plistlib import InvalidFileException
+
+from plist17lib import _BinaryPlist17Parser
+
+
+# an array with end address 0x12 whose int child ends at 0x13
+OVERRUN = b'bplist17' + b'\xa0' + (0x12).to_bytes(8, 'little') + b'\x12\x01\x00'
+
+
+@pytest.mark.parametrize('read', [
+    lambda p: p.parse_buffer(OVERRUN),
+    lambda p: p.parse_stream(BytesIO(OVERRUN)),
+    lambda p: p.build_index(OVERRUN),
+    lambda p: list(p.iter_events(OVERRUN)),
+    lambda p: p.transcode(OVERRUN, StringIO()),
+])
+def test_end_address_mismatch_names_the_token_and_offsets(read):
+    with pytest.raises(InvalidFileException) as info:
+        read(_BinaryPlist17Parser(dict_type=dict))
+    assert str(info.value) == 'token a0 at: 8 has end address 18, but its children end at: 19'
+
+
+def test_reference_cycle_names_the_reference():
+    # an array whose only child is a reference to the array itself
+    document = b'bplist17' + b'\xa0' + (0x12).to_bytes(8, 'little') + b'\x81\x08'
+    with pytest.raises(InvalidFileException, match='reference at: 17 to 8, which contains it'):
+        _BinaryPlist17Parser(dict_type=dict).parse_buffer(document)
@@ -0,0 +1,47 @@
+import json
+import plistlib
+from io import BytesIO
+
+from plist17lib import _BinaryPlist17Parser, _BinaryPlist17Writer
+from cli.run_parser import convert_file
+from cli.create_binary import create_from_json
+
+
+def keyed_archive():
+    """a bplist00 NSKeyedArchiver document with a UID and data in it"""
+    return plistlib.dumps({
+        '$archiver': 'NSKeyedArchiver',
+        '$objects': ['$null', {'payload': b'\x01\x02', '$class': plistlib.UID(2)}, {'$classname': 'Item'}],
+        '$top': {'root': plistlib.UID(1)},
+        '$version': 100000,
+    }, fmt=plistlib.FMT_BINARY, sort_keys=False)
+
+
+def document(archive):
+    fp = BytesIO()
+    _BinaryPlist17Writer(fp).write({'type': 'dict', 'value': {
+        'archive': {'type': 'data.hexstring', 'value': archive.hex()},
+        'count': {'type': 'int', 'value': 1},
+    }}, with_type_info=True)
+    return fp.getvalue()
+
+
+def test_nested_bplist00_round_trips_through_typed_json(tmp_path):
+    archive = keyed_archive()
+    source = tmp_path / 'archive.bplist17'
+    source.write_bytes(document(archive))
+
+    convert_file(str(source), str(tmp_path / 'archive.json'), True)
+    with open(tmp_path / 'archive.json') as f:
+        assert json.load(f)['value']['archive'] == {'type': 'data.hexstring', 'value': archive.hex()}
+    create_from_json(str(tmp_path / 'archive.json'), str(tmp_path / 'copy.bplist17'), True)
+
+    assert (tmp_path / 'copy.bplist17').read_bytes() == source.read_bytes()
+
+
+def test_nested_bplist00_is_parsed_on_request():
+    archive = keyed_archive()
+    p = _BinaryPlist17Parser(dict_type=dict, nested_bplist00=True)
+    result = p.parse_buffer(document(archive), with_type_info=True)['value']['archive']
+    assert result['type'] == 'data.bplist00'
+    assert result['value'] == plistlib.loads(archive)
@@ -0,0 +1,43 @@
+import io
+
+from plist17lib import _BinaryPlist17Parser, _BinaryPlist17Writer
+
+VALUE = {'$class': 'Item', 'name': 'first', 'sizes': [1, 2, 3]}
+
+
+def document():
+    fp = io.BytesIO()
+    _BinaryPlist17Writer(fp).write(VALUE)
+    return fp.getvalue()
+
+
+class Reader:
+    """a minimal read-only file-like object, without seekable()"""
+
+    def __init__(self, data):
+        self._data = io.BytesIO(data)
+
+    def read(self, size=-1):
+        return self._data.read(size)
+
+
+class SeekingReader(Reader):
+    """like Reader, with seek() but still without seekable()"""
+
+    def seek(self, offset, whence=0):
+        return self._data.seek(offset, whence)
+
+
+def test_parse_reads_file_like_objects_without_seekable():
+    p = _BinaryPlist17Parser(dict_type=dict)
+    assert p.parse(Reader(document())) == VALUE
+    assert p.parse_buffer(Reader(document())) == VALUE
+    out = io.StringIO()
+    p.transcode(Reader(document()), out)
+    assert out.getvalue() == '{"$class": "Item", "name": "first", "sizes": [1, 2, 3]}'
+
+
+def test_parse_seeks_to_the_start_without_seekable():
+    reader = SeekingReader(document())
+    reader.read(3)
+    assert _BinaryPlist17Parser(dict_type=dict).parse(reader) == VALUE
@@ -0,0 +1,37 @@
+from io import BytesIO
+
+import pytest
+
+from plist17lib import _BinaryPlist17Writer
+from cli import run_diff
+
+
+def write(path, value):
+    fp = BytesIO()
+    _BinaryPlist17Writer(fp).write(value)
+    path.write_bytes(fp.getvalue())
+    return str(path)
+
+
+def exit_status(argv):
+    with pytest.raises(SystemExit) as exit_info:
+        run_diff.main(argv)
+    return exit_info.value.code
+
+
+def test_exit_status_tells_equal_from_different_files(tmp_path, capsys):
+    old = write(tmp_path / 'old.bplist17', {'$class': 'Item', 'count': 1})
+    new = write(tmp_path / 'new.bplist17', {'$class': 'Item', 'count': 2})
+    assert exit_status([old, old]) == 0
+    assert exit_status([old, new]) == 1
+    assert '~ count: 1 -> 2' in capsys.readouterr().out
+
+
+def test_invalid_file_exits_with_2(tmp_path, capsys):
+    old = write(tmp_path / 'old.bplist17', {'$class': 'Item', 'count': 1})
+    invalid = tmp_path / 'invalid.bplist17'
+    invalid.write_bytes(b'bplist17\xa0\xff')
+    assert exit_status([old, str(invalid)]) == 2
+    captured = capsys.readouterr()
+    assert captured.out == ''
+    assert 'Failed to compare the files' in captured.err
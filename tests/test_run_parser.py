@@ -0,0 +1,24 @@
+import json
+import os
+import subprocess
+import sys
+from io import BytesIO
+
+from plist17lib import _BinaryPlist17Writer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+VALUE = {'$class': 'Item', 'name': 'first', 'sizes': [1, 2, 3]}
+
+
+def document():
+    fp = BytesIO()
+    _BinaryPlist17Writer(fp).write(VALUE)
+    return fp.getvalue()
+
+
+def test_stats_of_piped_stdin():
+    # stdin is a pipe, which can't seek
+    process = subprocess.run([sys.executable, '-m', 'cli.run_parser', '-i', '-', '-o', '-', '--stats'],
+                             input=document(), capture_output=True, cwd=ROOT, check=True)
+    assert json.loads(process.stdout) == VALUE
+    assert b'documents: 1,' in process.stderr
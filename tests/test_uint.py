@@ -0,0 +1,52 @@
+from io import BytesIO
+
+from plist17lib import _BinaryPlist17Parser, _BinaryPlist17Writer, _BinaryPlist17Builder
+
+# An array of the uints 42, 256, 0xdeadbeef and 2**64 - 1, with each FX
+# token followed by X bytes of the value, most significant byte first
+UINTS = [42, 256, 0xdeadbeef, 2**64 - 1]
+UINT_ARRAY = bytes.fromhex(
+    '62706c6973743137'              # bplist17
+    'a0' '2300000000000000'         # array, ends at 0x23
+    'f1' '2a'
+    'f2' '0100'
+    'f4' 'deadbeef'
+    'f8' 'ffffffffffffffff'
+)
+
+
+def write(value, with_type_info=False):
+    fp = BytesIO()
+    _BinaryPlist17Writer(fp).write(value, with_type_info=with_type_info)
+    return fp.getvalue()
+
+
+def test_parser_reads_uints_big_endian():
+    p = _BinaryPlist17Parser(dict_type=dict)
+    assert p.parse_buffer(UINT_ARRAY) == UINTS
+    assert p.parse_buffer(UINT_ARRAY, with_type_info=True) == \
+        {'type': 'array', 'value': [{'type': 'uint', 'value': value} for value in UINTS]}
+
+
+def test_writer_writes_uints_big_endian():
+    typed = {'type': 'array', 'value': [{'type': 'uint', 'value': value} for value in UINTS]}
+    assert write(typed, with_type_info=True) == UINT_ARRAY
+
+
+def test_multi_byte_uints_round_trip():
+    p = _BinaryPlist17Parser(dict_type=dict)
+    for value in (0, 255, 256, 0x1234, 2**32, 2**48 + 7, 2**63, 2**64 - 1):
+        typed = {'type': 'uint', 'value': value}
+        assert p.parse_buffer(write(typed, with_type_info=True), with_type_info=True) == typed
+
+        fp = BytesIO()
+        with _BinaryPlist17Builder(fp) as builder:
+            builder.uint(value)
+        assert p.parse_buffer(fp.getvalue()) == value
+
+
+def test_runs_of_uints_round_trip():
+    # runs of the same token are decoded in bulk
+    p = _BinaryPlist17Parser(dict_type=dict)
+    typed = {'type': 'array', 'value': [{'type': 'uint', 'value': 0x1000 + i} for i in range(10)]}
+    assert p.parse_buffer(write(typed, with_type_info=True)) == [0x1000 + i for i in range(10)]